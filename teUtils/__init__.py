@@ -5,12 +5,13 @@
 
     teUtils provides a number of useful modules to the tellurium modeling package.
 
-    This repo includes a number of useful utilities for Tellurium users. These are included in five modules:
+    This repo includes a number of useful utilities for Tellurium users. These are included in the modules below.
+    Each module is imported the first time it is used, so import teUtils itself is quick.
 
     odePrint
     --------
 
-    This provides a number of methods convert SBML into the equations representing the model. 
+    This provides a number of methods convert SBML into the equations representing the model, as text, as a vectorized NumPy function or as compiled C.
    
     plotting
     --------
@@ -39,6 +40,46 @@
     
     Currently a single method to make it trival to import a csv file 
 
+    sensitivity
+    -----------
+
+    Global sensitivity analysis, first order and total Sobol indices and Morris elementary effects
+
+    workerPool
+    ----------
+
+    A pool of worker processes that run simulations on a model compiled once in the parent process
+
+    ensembles
+    ---------
+
+    Streaming mean, variance and quantile statistics for large ensembles of time course simulations
+
+    simulationCache
+    ---------------
+
+    A memory and disk cache of simulation results keyed by the model and the simulation inputs
+
+    telemetry
+    ---------
+
+    Per-simulation timing, integrator step counts and failures for scans and simulation grids
+
+    controlAnalysis
+    ---------------
+
+    Scaled control coefficient matrices computed once and shared by the control coefficient plots
+
+    monitor
+    -------
+
+    A live text dashboard of progress, throughput, failures and ASCII bar charts for batch jobs on headless machines
+
+    workQueue
+    ---------
+
+    An executor that runs scans on worker processes on several machines over TCP.
+
 '''
 
 try:
@@ -48,18 +89,21 @@ except:
 
 __version__ = _version.__version__
 
-try:
-    from . import odePrint
-    from . import plotting
-    from . import prettyTabular
-    from . import buildNetworks
-    from . import parameterScanning
-    from . import fileUtils
-except:
-    from teUtils import odePrint
-    from teUtils import plotting
-    from teUtils import prettyTabular
-    from teUtils import buildNetworks
-    from teUtils import parameterScanning
-    from teUtils import fileUtils
-    #from teUtils import model_fitter
+# Submodules are imported on first use, so that importing teUtils does not load
+# tellurium, matplotlib or libsbml unless a module that needs them is used
+_submodules = ['odePrint', 'plotting', 'prettyTabular', 'buildNetworks', 'parameterScanning', 'fileUtils',
+               'sensitivity', 'workerPool', 'ensembles', 'simulationCache', 'telemetry', 'controlAnalysis',
+               'monitor', 'workQueue']
+
+__all__ = _submodules
+
+
+def __getattr__(name):
+    if name in _submodules:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module 'teUtils' has no attribute '" + name + "'")
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules)
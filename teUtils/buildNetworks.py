@@ -1,19 +1,24 @@
 # -*- coding: utf-8 -*-
 """ A module for creating random network models """
 
-import tellurium as _te
 import random as _random
-importRoadrunnerFail = False;
-try:
-  import roadrunner
-except:
-    importRoadrunnerFail = True
-    
 from   dataclasses import dataclass
 
 __all__ = ['Settings', 'restoreDefaultProbabilities', 'getLinearChain', 'getRandomNetworkDataStructure', 'getRandomNetwork']
 
 
+def _disableRoadrunnerWarnings (disableConsoleLogging=True):
+    # roadrunner is imported here rather than at module level so that generating networks
+    # does not pay for loading it, and works when it is not installed
+    try:
+      import roadrunner
+    except ImportError:
+      return
+    if disableConsoleLogging:
+       roadrunner.Logger_disableConsoleLogging()
+    roadrunner.Config_setValue (roadrunner.Config.ROADRUNNER_DISABLE_WARNINGS, True)
+
+
 # General settings for the package
 @dataclass
 class Settings:
@@ -519,9 +524,7 @@ def getRandomNetworkDataStructure (nSpecies, nReactions, isReversible=False, ran
 
 
     """   
-    if not importRoadrunnerFail:
-        #roadrunner.Logger_disableConsoleLogging()
-        roadrunner.Config_setValue (roadrunner.Config.ROADRUNNER_DISABLE_WARNINGS, True)
+    _disableRoadrunnerWarnings (disableConsoleLogging=False)
 
     if randomSeed != -1:
        _random.seed (randomSeed)
@@ -580,9 +583,7 @@ def getRandomNetwork (nSpecies, nReactions, isReversible=False, returnStoichiome
                [ 0., -1.,  0., -1.,  0.,  1.,  0.],
                [ 0.,  0., -1.,  0.,  1.,  0.,  0.]])
     """    
-    if not importRoadrunnerFail:
-       roadrunner.Logger_disableConsoleLogging()
-       roadrunner.Config_setValue (roadrunner.Config.ROADRUNNER_DISABLE_WARNINGS, True)
+    _disableRoadrunnerWarnings()
 
     if randomSeed != -1:
        _random.seed (randomSeed)
@@ -612,10 +613,9 @@ def getRandomNetwork (nSpecies, nReactions, isReversible=False, returnStoichiome
 if __name__ == '__main__' :
    # import heat map code 
    import teUtils as _teUtils
+   import tellurium as _te
    
-   if not importRoadrunnerFail:
-      roadrunner.Logger_disableConsoleLogging()
-      roadrunner.Config_setValue (roadrunner.Config.ROADRUNNER_DISABLE_WARNINGS, True)
+   _disableRoadrunnerWarnings()
     
    mod = getLinearChain (9, rateLawType='MassAction', keqRatio=2)
    print (mod)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+""" Metabolic control analysis results shared between plots
+
+ControlAnalysis computes the scaled flux and concentration control coefficient matrices
+of a model once and keeps them, with their row and column ids, until the state of the
+model changes. Pass it in place of the roadrunner instance to the control coefficient
+plots in teUtils.plotting so that several plots of a large model compute the matrices
+only once.
+
+batchControlCoefficients computes the matrices for many parameter sets in worker
+processes, for plotting their distributions with plotting.plotControlCoefficientSummary.
+"""
+
+import numpy as _np
+
+__all__ = ['ControlAnalysis', 'batchControlCoefficients']
+
+
+class ControlAnalysis:
+    """ Cached scaled control coefficient matrices of a roadrunner model.
+
+    Each matrix is computed the first time it is used, so a caller that only needs the
+    flux control coefficients never computes the concentration control coefficients. Each
+    later use checks a fingerprint of the model state (parameter values, species
+    concentrations, compartment volumes) and recomputes the matrix if any of them has
+    changed since.
+
+    Args:
+      r (reference): Roadrunner instance
+
+    Example:
+
+     .. code-block:: python
+
+        ca = tu.controlAnalysis.ControlAnalysis (r)
+        tu.plotting.plotFluxControlHeatMap (ca)
+        tu.plotting.plotFluxControlBar (ca, 'J1')
+        r.k1 = 0.5
+        # Recomputed because a parameter has changed
+        tu.plotting.plotConcentrationControlHeatMap (ca)
+    """
+
+    def __init__(self, r):
+        self.r = r
+        # (fingerprint, values, row ids, column ids) of each matrix, keyed by 'Flux' or 'Concentration'.
+        # Each matrix has its own fingerprint so that a plot of one never computes the other.
+        self._matrices = {}
+
+    def _getFingerprint(self):
+        model = self.r.model
+        values = _np.concatenate([model.getGlobalParameterValues(), model.getFloatingSpeciesConcentrations(),
+                                  model.getBoundarySpeciesConcentrations(), model.getCompartmentVolumes()])
+        # The reaction ids catch a model that has been reloaded or edited
+        return tuple(self.r.getReactionIds()), values.tobytes()
+
+    def _getMatrix(self, kind):
+        fingerprint = self._getFingerprint()
+        cached = self._matrices.get(kind)
+        if cached is not None and fingerprint == cached[0]:
+            return cached
+        matrix = getattr(self.r, 'getScaled' + kind + 'ControlCoefficientMatrix')()
+        # Taken after the computation, which moves the model to steady state
+        after = self._getFingerprint()
+        # Solving for the steady state again can move the concentrations in the last digits,
+        # a matrix that was current before the computation is still current after it
+        for other, values in self._matrices.items():
+            if values[0] == fingerprint:
+                self._matrices[other] = (after,) + values[1:]
+        cached = (after, _np.array(matrix), list(matrix.rownames), list(matrix.colnames))
+        self._matrices[kind] = cached
+        return cached
+
+    def invalidate(self):
+        """ Discard the cached matrices, the next use recomputes them """
+        self._matrices = {}
+
+    @property
+    def concentrationControl(self):
+        """ Scaled concentration control coefficients, numpy array of shape (species, reactions) """
+        return self._getMatrix('Concentration')[1]
+
+    @property
+    def fluxControl(self):
+        """ Scaled flux control coefficients, numpy array of shape (fluxes, reactions) """
+        return self._getMatrix('Flux')[1]
+
+    @property
+    def speciesIds(self):
+        """ Ids of the rows of concentrationControl """
+        return self._getMatrix('Concentration')[2]
+
+    @property
+    def fluxIds(self):
+        """ Ids of the rows of fluxControl """
+        return self._getMatrix('Flux')[2]
+
+    @property
+    def reactionIds(self):
+        """ Ids of the reactions along the columns of both matrices """
+        # Read from whichever matrix is already up to date, the flux matrix if neither is
+        fingerprint = self._getFingerprint()
+        for cached in self._matrices.values():
+            if cached[0] == fingerprint:
+                return cached[3]
+        return self._getMatrix('Flux')[3]
+
+
+def _controlChunk(r, parameters, valueSets):
+    # Each steady state starts from the previous one in the chunk, which is usually close by
+    concentrationControl, fluxControl, converged = [], [], []
+    r.reset()
+    for values in valueSets:
+        for parameter, value in zip(parameters, values):
+            r[parameter] = value
+        result = None
+        for attempt in range(2):
+            try:
+                r.steadyState()
+                result = (_np.array(r.getScaledConcentrationControlCoefficientMatrix()),
+                          _np.array(r.getScaledFluxControlCoefficientMatrix()))
+                break
+            except Exception:
+                # Start again from the initial conditions
+                r.reset()
+        converged.append(result is not None)
+        if result is None:
+            result = (None, None)
+        concentrationControl.append(result[0])
+        fluxControl.append(result[1])
+    return concentrationControl, fluxControl, converged
+
+
+def _stack(matrices, shape):
+    return _np.array([_np.full(shape, _np.nan) if m is None else m for m in matrices]).reshape((-1,) + shape)
+
+
+def batchControlCoefficients(r, parameters, valueSets, maxWorkers=None, executor=None, chunkSize=None, pool=None):
+    """ Compute the scaled control coefficient matrices at the steady state of each parameter set.
+
+    The parameter sets are split into chunks that run on a teUtils.workerPool.ModelPool, so
+    the model is compiled once. Within a chunk each steady state search starts from the
+    steady state of the previous set, falling back to the initial conditions if it fails.
+    Sets whose steady state cannot be found are filled with NaN and marked in 'converged'.
+    Sorting valueSets so that neighbouring rows are close together makes the warm starts
+    more effective.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The names of the parameters to set
+      valueSets (numpy array): Array of shape (number of sets, len (parameters)), one row per set
+      maxWorkers (integer): Optional: Number of worker processes, use 1 to compute in this process
+      executor (concurrent.futures.Executor): Optional: Executor to use instead of a new process pool
+      chunkSize (integer): Optional: Number of sets sent to a worker at a time
+      pool (ModelPool): Optional: An existing pool for this model
+
+    Returns:
+      dictionary: with keys
+
+        - 'concentrationControl': numpy array of shape (sets, species, reactions)
+        - 'fluxControl': numpy array of shape (sets, fluxes, reactions)
+        - 'speciesIds', 'fluxIds', 'reactionIds': the ids along the matrix axes
+        - 'converged': boolean numpy array, False where no steady state was found
+
+    Example:
+
+     .. code-block:: python
+
+        values = np.random.uniform (0.5, 2, size=(5000, 2))
+        result = tu.controlAnalysis.batchControlCoefficients (r, ['k1', 'k2'], values)
+        tu.plotting.plotControlCoefficientSummary (result, kind='flux')
+    """
+    import os
+    from teUtils import workerPool
+
+    valueSets = _np.atleast_2d(_np.asarray(valueSets, dtype=float))
+    # Work on a restored copy so r is left as it was. Restoring a state into an instance that
+    # has already computed control coefficients is not safe in roadrunner, a new instance is.
+    import roadrunner
+    copy = roadrunner.RoadRunner()
+    copy.loadStateS(r.saveStateS())
+    ca = ControlAnalysis(copy)
+    speciesIds, fluxIds, reactionIds = ca.speciesIds, ca.fluxIds, ca.reactionIds
+
+    if maxWorkers == 1 and executor is None and pool is None:
+        chunks = [_controlChunk(copy, parameters, valueSets)]
+    else:
+        ownPool = pool is None
+        if ownPool:
+            pool = workerPool.ModelPool(r, maxWorkers=maxWorkers, executor=executor)
+        if chunkSize is None:
+            workers = maxWorkers or os.cpu_count() or 1
+            chunkSize = max(1, int(_np.ceil(len(valueSets)/(4*workers))))
+        try:
+            chunks = pool.map(_controlChunk, [(parameters, valueSets[i:i + chunkSize])
+                                              for i in range(0, len(valueSets), chunkSize)])
+        finally:
+            if ownPool:
+                pool.shutdown()
+
+    return {'concentrationControl': _stack([m for chunk in chunks for m in chunk[0]],
+                                           (len(speciesIds), len(reactionIds))),
+            'fluxControl': _stack([m for chunk in chunks for m in chunk[1]], (len(fluxIds), len(reactionIds))),
+            'speciesIds': speciesIds, 'fluxIds': fluxIds, 'reactionIds': reactionIds,
+            'converged': _np.array([c for chunk in chunks for c in chunk[2]], dtype=bool)}
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+""" Streaming statistics for ensembles of time course simulations
+
+EnsembleStatistics updates the mean, variance and quantiles at every time point as each
+simulation finishes, so the memory used depends only on the number of time points and
+variables, not on the number of simulations. Means and variances use Welford's algorithm,
+quantiles use the P-square streaming estimator of Jain and Chlamtac.
+"""
+
+import random as _random
+
+import numpy as _np
+
+from teUtils import workerPool as _workerPool
+
+__all__ = ['EnsembleStatistics', 'randomEnsemble']
+
+
+class EnsembleStatistics:
+    """ Incrementally updated mean, variance and quantile bands of a time course ensemble.
+
+    Args:
+      labels (list of strings): Optional: Names of the variables, used for plot legends
+      quantiles (list of floats): Optional: The quantiles to track, eg (0.05, 0.5, 0.95)
+
+    Example:
+
+     .. code-block:: python
+
+        stats = tu.ensembles.EnsembleStatistics (['S1', 'S2'])
+        for i in range (1000):
+            m = r.simulate (0, 100, 200, ['time', 'S1', 'S2'])
+            stats.update (m)
+        tu.plotting.plotEnsembleBands (stats)
+    """
+
+    def __init__(self, labels=None, quantiles=(0.05, 0.5, 0.95)):
+        self.labels = labels
+        self.quantiles = _np.array(quantiles, dtype=float)
+        self.count = 0
+        self.time = None
+        self._mean = None
+        self._m2 = None
+        self._first = []
+        # P-square marker heights and positions, shape (quantiles, 5, points, variables)
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._increments = _np.column_stack([_np.zeros_like(self.quantiles), self.quantiles/2,
+                                             self.quantiles, (1 + self.quantiles)/2, _np.ones_like(self.quantiles)])
+
+    def update(self, m):
+        """ Add one simulation to the statistics
+
+        Args:
+          m (numpy array): A simulation result with time in the first column and the variables in the remaining columns
+        """
+        m = _np.asarray(m, dtype=float)
+        x = m[:, 1:]
+        self.count += 1
+        if self.time is None:
+            self.time = m[:, 0].copy()
+            self._mean = _np.zeros_like(x)
+            self._m2 = _np.zeros_like(x)
+        delta = x - self._mean
+        self._mean += delta/self.count
+        self._m2 += delta*(x - self._mean)
+
+        if self.count <= 5:
+            self._first.append(x.copy())
+            if self.count == 5:
+                self._startQuantiles()
+        else:
+            self._updateQuantiles(x)
+
+    def _startQuantiles(self):
+        markers = _np.sort(_np.array(self._first), axis=0)
+        nq = len(self.quantiles)
+        self._heights = _np.repeat(markers[_np.newaxis], nq, axis=0)
+        self._positions = _np.broadcast_to(_np.arange(1.0, 6.0)[:, _np.newaxis, _np.newaxis],
+                                           self._heights.shape).copy()
+        self._desired = 1 + 4*self._increments
+        self._first = []
+
+    def _updateQuantiles(self, x):
+        q = self._heights
+        n = self._positions
+        q[:, 0] = _np.minimum(q[:, 0], x)
+        q[:, 4] = _np.maximum(q[:, 4], x)
+        # Cell holding x, markers above it move up one position
+        k = _np.sum(q[:, 1:4] <= x, axis=1)
+        for i in range(1, 5):
+            n[:, i] += k < i
+        self._desired = self._desired + self._increments
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(1, 4):
+                d = self._desired[:, i, _np.newaxis, _np.newaxis] - n[:, i]
+                move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+                if not _np.any(move):
+                    continue
+                s = _np.sign(d)
+                parabolic = q[:, i] + s/(n[:, i + 1] - n[:, i - 1])*(
+                    (n[:, i] - n[:, i - 1] + s)*(q[:, i + 1] - q[:, i])/(n[:, i + 1] - n[:, i]) +
+                    (n[:, i + 1] - n[:, i] - s)*(q[:, i] - q[:, i - 1])/(n[:, i] - n[:, i - 1]))
+                neighbourHeight = _np.where(s > 0, q[:, i + 1], q[:, i - 1])
+                neighbourPosition = _np.where(s > 0, n[:, i + 1], n[:, i - 1])
+                linear = q[:, i] + s*(neighbourHeight - q[:, i])/(neighbourPosition - n[:, i])
+                inside = (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1])
+                q[:, i] = _np.where(move, _np.where(inside, parabolic, linear), q[:, i])
+                n[:, i] = _np.where(move, n[:, i] + s, n[:, i])
+
+    @property
+    def mean(self):
+        """ Mean at each time point, array of shape (points, variables) """
+        return self._mean
+
+    @property
+    def variance(self):
+        """ Sample variance at each time point, array of shape (points, variables) """
+        if self.count < 2:
+            return _np.zeros_like(self._mean)
+        return self._m2/(self.count - 1)
+
+    @property
+    def std(self):
+        """ Sample standard deviation at each time point """
+        return _np.sqrt(self.variance)
+
+    def getQuantile(self, quantile):
+        """ Return the estimate of one of the tracked quantiles, array of shape (points, variables)
+
+        Args:
+          quantile (float): One of the quantiles given when the object was created
+        """
+        index = _np.flatnonzero(_np.isclose(self.quantiles, quantile))
+        if len(index) == 0:
+            raise ValueError('Quantile ' + str(quantile) + ' is not being tracked')
+        if self.count < 5:
+            # Too few simulations for the streaming estimator, use the stored ones directly
+            return _np.quantile(_np.array(self._first), quantile, axis=0)
+        return self._heights[index[0], 2].copy()
+
+
+def randomEnsemble(r, numberOfSimulations, maxRange=10, endTime=200, numPoints=500, species=None,
+      quantiles=(0.05, 0.5, 0.95), pool=None):
+    """ Run simulations with randomly drawn parameter values and return their streaming statistics.
+
+    Each global parameter is drawn uniformly between 0 and maxRange, as in plotting.plotRandSimGrid.
+    Only the statistics are kept, the individual time courses are discarded once they are added.
+
+    Args:
+      r (reference): Roadrunner instance
+      numberOfSimulations (integer): Number of simulations in the ensemble
+      maxRange (float): Optional: Upper range for the randomly drawn parameter values
+      endTime (float): Optional: Time to simulate to
+      numPoints (integer): Optional: Number of points in each simulation
+      species (list of strings): Optional: Variables to record, default is all floating species
+      quantiles (list of floats): Optional: Quantiles to track
+      pool (ModelPool): Optional: Run the simulations in parallel on a teUtils.workerPool.ModelPool created for r
+
+    Returns:
+      EnsembleStatistics
+
+    Example:
+      >>> stats = teUtils.ensembles.randomEnsemble (r, 5000, maxRange=2)
+    """
+    import concurrent.futures
+
+    if species is None:
+        species = sorted(r.getFloatingSpeciesIds())
+    stats = EnsembleStatistics(list(species), quantiles=quantiles)
+    parameterIds = r.getGlobalParameterIds()
+    selections = ['time'] + list(species)
+
+    def task():
+        return (parameterIds, [_random.random()*maxRange for k in parameterIds], endTime, numPoints, selections)
+
+    if pool is None:
+        for i in range(numberOfSimulations):
+            stats.update(_workerPool.simulateTimeCourse(r, *task()))
+        return stats
+
+    # Keep a bounded number of simulations in flight so finished results never pile up
+    maxPending = 64
+    pending = set()
+    submitted = 0
+    while submitted < numberOfSimulations or pending:
+        while submitted < numberOfSimulations and len(pending) < maxPending:
+            pending.add(pool.submit(_workerPool.simulateTimeCourse, *task()))
+            submitted += 1
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            stats.update(future.result())
+    return stats
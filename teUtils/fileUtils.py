@@ -1,4 +1,8 @@
 
+import json
+import os
+import warnings
+
 import numpy as np
 # Variety of useful file utilties, easier to use than the python supplied functionality
 
@@ -42,4 +46,155 @@ def readCsvFile (fileName, includeFirstColumnLabel=False):
                del header[0]
          else:
             raise Exception ('Error: This data file has no column headers')
-         return np.array(list(reader)).astype(float), header
\ No newline at end of file
+         return np.array(list(reader)).astype(float), header
+
+class ScanWriter:
+    """ Append-only writer that streams simulation results to disk as they finish.
+
+    Each simulation is a (numberOfPoints x number of selections) array. Simulations
+    are written into fixed size shards (numpy .npy files opened as memory maps) so
+    the full scan never has to fit in memory. A parameter index table (index.csv)
+    records which shard and offset holds each simulation together with the parameter
+    values used to generate it. Use ScanReader to load the results back.
+
+    Args:
+      directory (string): Directory to write the shards into, it will be created if needed
+      selections (list of strings): Names of the recorded columns, eg ['time', 'S1']
+      parameters (list of strings): Names of the parameters stored in the index table
+      numberOfPoints (integer): Number of rows in each simulation
+      shardSize (integer): Optional: Number of simulations stored per shard file
+
+    Example:
+      >>> w = teUtils.fileUtils.ScanWriter ('scan', ['time', 'S1'], ['k1'], 100)
+      >>> w.append ([0.5], m)
+      >>> w.close()
+    """
+
+    def __init__(self, directory, selections, parameters, numberOfPoints, shardSize=1000):
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            raise Exception('Error: ' + directory + ' already holds scan results')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.selections = list(selections)
+        self.parameters = list(parameters)
+        self.numberOfPoints = numberOfPoints
+        self.shardSize = shardSize
+        self.count = 0
+        self._shard = None
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump({'selections': self.selections, 'parameters': self.parameters,
+                       'numberOfPoints': numberOfPoints, 'shardSize': shardSize}, f)
+        self._index = open(os.path.join(directory, 'index.csv'), 'w')
+        self._index.write(','.join(['simulation', 'shard', 'offset'] + self.parameters) + '\n')
+
+    def _shardName(self, shard):
+        return os.path.join(self.directory, 'shard_{:05d}.npy'.format(shard))
+
+    def append(self, parameterValues, data):
+        """ Write one finished simulation
+
+        Args:
+          parameterValues (list of floats): The parameter values used for this simulation
+          data (numpy array): Array of shape (numberOfPoints, number of selections)
+        """
+        shard, offset = divmod(self.count, self.shardSize)
+        if offset == 0:
+            self.flush()
+            self._shard = np.lib.format.open_memmap(self._shardName(shard), mode='w+', dtype=float,
+                                                    shape=(self.shardSize, self.numberOfPoints, len(self.selections)))
+        self._shard[offset] = data
+        self._index.write(','.join([str(self.count), str(shard), str(offset)] +
+                                   [repr(float(v)) for v in parameterValues]) + '\n')
+        self.count += 1
+
+    def flush(self):
+        """ Push any buffered data to disk """
+        if self._shard is not None:
+            self._shard.flush()
+        self._index.flush()
+
+    def close(self):
+        """ Flush and close the writer, no more simulations can be appended """
+        self.flush()
+        self._shard = None
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScanReader:
+    """ Lazily read scan results written by ScanWriter.
+
+    Shards are opened as read-only memory maps the first time they are needed so
+    only the slices that are actually used get loaded from disk.
+
+    Args:
+      directory (string): Directory that holds the scan results
+
+    Example:
+      >>> results = teUtils.fileUtils.ScanReader ('scan')
+      >>> print (results.parameterValues)
+      >>> m = results[10]              # Simulation 10 as a (points x selections) array
+      >>> s1 = results.getSelection ('S1')  # S1 from every simulation, (points x simulations)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.selections = meta['selections']
+        self.parameters = meta['parameters']
+        self.numberOfPoints = meta['numberOfPoints']
+        self.shardSize = meta['shardSize']
+        with warnings.catch_warnings():
+            # An empty scan only has the header line in the index table
+            warnings.simplefilter('ignore')
+            index = np.loadtxt(os.path.join(directory, 'index.csv'), delimiter=',', skiprows=1, ndmin=2)
+        index = index.reshape(-1, 3 + len(self.parameters))
+        # Shard and offset of each simulation, as recorded by the writer
+        self._locations = index[:, 1:3].astype(int)
+        self.parameterValues = index[:, 3:]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.parameterValues)
+
+    def _getShard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.directory, 'shard_{:05d}.npy'.format(shard)), mmap_mode='r')
+        return self._shards[shard]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if key < 0 or key >= len(self):
+                raise IndexError('Simulation index out of range')
+            shard, offset = self._locations[key]
+            return self._getShard(shard)[offset]
+        return self._read(np.arange(len(self))[key], slice(None))
+
+    def _read(self, indexes, column):
+        # Reads each shard once with fancy indexing and scatters the rows into the result,
+        # returns an array of shape (len (indexes), numberOfPoints) + shape of the column
+        locations = self._locations[indexes]
+        width = () if isinstance(column, (int, np.integer)) else (len(self.selections),)
+        result = np.empty((len(indexes), self.numberOfPoints) + width)
+        for shard in np.unique(locations[:, 0]):
+            rows = locations[:, 0] == shard
+            result[rows] = self._getShard(shard)[locations[rows, 1], :, column]
+        return result
+
+    def getSelection(self, name, simulations=slice(None)):
+        """ Return one selection across simulations as an array of shape (numberOfPoints, simulations)
+
+        Args:
+          name (string): The selection to return, eg 'S1'
+          simulations (slice or list of integers): Optional: The simulations to include, default is all
+        """
+        column = self.selections.index(name)
+        return self._read(np.arange(len(self))[simulations], column).T
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+""" Live terminal monitor for long running scans and ensembles
+
+TerminalMonitor redraws a small text dashboard at a fixed rate from a background thread:
+progress, throughput, estimated time left, failure counts and ASCII bar charts of the
+latest concentrations and reaction rates. The job only updates counters and copies the
+latest values, all formatting and printing happens in the monitor thread, so the cost to
+the job is a few microseconds per simulation.
+"""
+
+import math as _math
+import sys as _sys
+import threading as _threading
+import time as _time
+
+__all__ = ['TerminalMonitor']
+
+
+def _asciiBarLines(ids, values, scale=5, maxWidth=None):
+    # One 'id : ****' line per value, bars longer than maxWidth are cut and end in '>'.
+    # Used by plotting as well, so this module must not import matplotlib.
+    maxString = len(max(ids, key=len))
+    lines = []
+    for id, value in zip(ids, values):
+        if not _math.isfinite(value):
+            # A blown up simulation gives nan or inf, show the value instead of a bar
+            bar = str(value)
+        else:
+            length = _math.trunc(scale*value)
+            bar = length*'*' if maxWidth is None or length <= maxWidth else maxWidth*'*' + '>'
+        lines.append('{:{X}.{Y}} : {}'.format(id, bar, X=maxString, Y=maxString))
+    return lines
+
+
+def _formatSeconds(seconds):
+    seconds = int(seconds)
+    return '{:02d}:{:02d}:{:02d}'.format(seconds//3600, (seconds//60) % 60, seconds % 60)
+
+
+class TerminalMonitor:
+    """ Text dashboard for watching a batch job on a headless machine.
+
+    Either call update after each simulation, or pass the Telemetry object given to a
+    scan or grid function and the monitor reads the counts from its records.
+
+    Args:
+      total (integer): Optional: Number of simulations in the job, used for the progress bar and time left
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry to read the simulation and failure counts from
+      refreshInterval (float): Optional: Seconds between redraws
+      scale (float): Optional: Scale of the ASCII bar charts, as in plotting.plotAsciiConcentrationsBar
+      maxBarWidth (integer): Optional: Longest bar drawn, longer bars are cut
+      stream (file): Optional: Where to draw, default is standard output. The screen is cleared
+          before each redraw if the stream is a terminal.
+
+    Example:
+
+     .. code-block:: python
+
+        with tu.monitor.TerminalMonitor (total=1000) as monitor:
+            for values in valueSets:
+                m = tu.workerPool.simulateTimeCourse (r, ['k1'], values, 100, 200, ['time', 'S1'])
+                monitor.update (r=r)
+    """
+
+    def __init__(self, total=None, telemetry=None, refreshInterval=1.0, scale=5, maxBarWidth=60, stream=None):
+        self.total = total
+        self.telemetry = telemetry
+        self.refreshInterval = refreshInterval
+        self.scale = scale
+        self.maxBarWidth = maxBarWidth
+        self.stream = _sys.stdout if stream is None else stream
+        self.completed = 0
+        self.failed = 0
+        self._concentrations = None
+        self._rates = None
+        self._lock = _threading.Lock()
+        self._stop = _threading.Event()
+        self._start = _time.time()
+        self._thread = _threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, completed=1, failed=0, r=None):
+        """ Record finished simulations and, if r is given, take a copy of its concentrations and rates
+
+        Args:
+          completed (integer): Optional: Number of simulations that finished
+          failed (integer): Optional: Number of those that failed
+          r (reference): Optional: Roadrunner instance whose current values are shown as bar charts
+        """
+        if r is not None:
+            concentrations = (r.getFloatingSpeciesIds(), list(r.getFloatingSpeciesConcentrations()))
+            rates = (r.getReactionIds(), list(r.getReactionRates()))
+        with self._lock:
+            self.completed += completed
+            self.failed += failed
+            if r is not None:
+                self._concentrations = concentrations
+                self._rates = rates
+
+    def setValues(self, concentrations=None, rates=None):
+        """ Show these values as bar charts, each argument is a tuple (ids, values) """
+        with self._lock:
+            if concentrations is not None:
+                self._concentrations = concentrations
+            if rates is not None:
+                self._rates = rates
+
+    def _getCounts(self):
+        if self.telemetry is not None:
+            records = list(self.telemetry.records)
+            return len(records), sum(1 for record in records if record['failed'])
+        with self._lock:
+            return self.completed, self.failed
+
+    def render(self):
+        """ Return the dashboard as a string """
+        completed, failed = self._getCounts()
+        with self._lock:
+            concentrations, rates = self._concentrations, self._rates
+        elapsed = _time.time() - self._start
+        throughput = completed/elapsed if elapsed > 0 else 0.0
+        lines = ['teUtils monitor   elapsed ' + _formatSeconds(elapsed)]
+        if self.total:
+            fraction = min(completed/self.total, 1.0)
+            width = 30
+            lines.append('Progress   [' + '#'*int(fraction*width) + '-'*(width - int(fraction*width)) + '] ' +
+                         '{}/{} {:5.1f}%'.format(completed, self.total, 100*fraction))
+        else:
+            lines.append('Completed  ' + str(completed))
+        status = 'Throughput {:.2f} sims/s   Failures {}'.format(throughput, failed)
+        if self.total and throughput > 0:
+            status += '   Time left ' + _formatSeconds(max(self.total - completed, 0)/throughput)
+        lines.append(status)
+        for title, values in [('Concentrations', concentrations), ('Reaction rates', rates)]:
+            if values is not None and len(values[0]) > 0:
+                lines.append(title)
+                lines.extend(_asciiBarLines(values[0], values[1], self.scale, self.maxBarWidth))
+        return '\n'.join(lines)
+
+    def _draw(self):
+        try:
+            text = self.render()
+        except Exception as error:
+            # Keep the monitor running, the job itself is not affected
+            text = 'teUtils monitor   could not draw: ' + repr(error)
+        isTerminal = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        # Move to the top left and clear the screen before redrawing on a terminal
+        self.stream.write(('\x1b[H\x1b[2J' if isTerminal else '\n') + text + '\n')
+        self.stream.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.refreshInterval):
+            self._draw()
+
+    def close(self):
+        """ Stop the monitor thread and draw the final state """
+        if not self._stop.is_set():
+            self._stop.set()
+            self._thread.join()
+            self._draw()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -9,67 +9,415 @@ Created on Sat Dec 16 10:36:22 2017
 # Let's only support 3.x series
 #from __future__ import absolute_import, division, print_function, unicode_literals
 
-import tellurium as _te
+import collections as _collections
+import hashlib as _hashlib
+import math as _math
+import os as _os
+import threading as _threading
+
 import libsbml
+import numpy as _np
 
-def getODEsFromSBMLFile (fileName):
+def getODEsFromSBMLFile (fileName, outputFile=None):
     """ Given a SBML file name, this function returns the model
     as a string of rules and ODEs
     
     Args:
       fileName (string): The path and name of the SBML file
+      outputFile (string or file): Optional: Write the ODEs line by line to this file
+          name or open file instead of returning them, useful for very large models
 
     Example:
       >>> print (te.getODEsFromSBMLFile ('mymodel.xml'))
     """
 
-    sbmlStr = _te.readFromFile (fileName)
-    extractor = _ODEExtractor (sbmlStr)
-    return extractor._toString()
+    extractor = _cache.getFileExtractor (fileName)
+    return _output (extractor, outputFile)
 
-def getODEsFromSBMLString (sbmlStr):
+def getODEsFromSBMLString (sbmlStr, outputFile=None):
     """ Given a SBML string this fucntion returns the model
     as a string of rules and ODEs
     
     Args:
       sbmlStr (string): A string representing an SBML model
+      outputFile (string or file): Optional: Write the ODEs line by line to this file
+          name or open file instead of returning them, useful for very large models
 
     Example:
        >>> print (te.getODEsFromSBMLString (sbmlStr))
     """
 
-    extractor = _ODEExtractor (sbmlStr)
-    return extractor._toString()
+    extractor = _cache.getExtractor (sbmlStr)
+    return _output (extractor, outputFile)
 
-def getODEsFromModel (sbmlModel):
+def getODEsFromModel (sbmlModel, outputFile=None):
     """Given a roadrunner instance this function returns
     a string of rules and ODEs
     
     Args: 
       sbmlModel (string): A reodarunner instance
+      outputFile (string or file): Optional: Write the ODEs line by line to this file
+          name or open file instead of returning them, useful for very large models
       
     Example:
       >>> r = te.loada ('S1 -> S2; k1*S1; k1=1')
       >>> print (te.getODEsFromModel (r))
+      >>> te.getODEsFromModel (r, outputFile='odes.txt')
     """
 
     from roadrunner import RoadRunner
     if type (sbmlModel) == RoadRunner:
-       extractor = _ODEExtractor (sbmlModel.getSBML())
+       # The SBML still has to be written out to find its hash, but it is only parsed
+       # again if this model has not been seen before
+       extractor = _cache.getExtractor (sbmlModel.getSBML())
     else:
        raise RuntimeError('The argument to getODEsFromModelAsString should be a roadrunner variable')
 
-    return extractor._toString()
+    return _output (extractor, outputFile)
+
+def setCacheLimits (maxEntries=16, maxBytes=64*1024**2):
+    """ Set the size of the cache of extracted models shared by the getODEs functions
+
+    The parsed SBML document, the reaction accumulators and the ODE text of the most
+    recently used models are kept, keyed by a hash of the SBML, so asking again for
+    the ODEs of an unchanged model does not parse it again. The least recently used
+    models are dropped first.
+
+    Args:
+      maxEntries (integer): Optional: Number of models kept, 0 turns the cache off
+      maxBytes (integer): Optional: Limit on the total size of the SBML of the models kept.
+          The parsed documents take a few times this much memory.
+
+    Example:
+      >>> teUtils.odePrint.setCacheLimits (maxEntries=4)
+    """
+
+    _cache.setLimits (maxEntries, maxBytes)
+
+def clearCache ():
+    """ Remove all models from the cache of extracted models """
+
+    _cache.clear()
+
+def getCacheInfo ():
+    """ Return a dictionary with the number of hits, misses, entries and the SBML bytes held by the cache """
+
+    return _cache.info()
+
+def getODEFunctionFromSBMLFile (fileName):
+    """ Given a SBML file name, this function returns the right hand side
+    of the model ODEs as a vectorized NumPy function f(t, y, p)
+
+    Args:
+      fileName (string): The path and name of the SBML file
+
+    Returns:
+      ODEFunction: see ODEFunction for the order of y and p
+
+    Example:
+      >>> f = teUtils.odePrint.getODEFunctionFromSBMLFile ('mymodel.xml')
+      >>> print (f (0, f.initialState))
+    """
+
+    return _getODEFunction (_cache.getFileExtractor (fileName))
+
+def getODEFunctionFromSBMLString (sbmlStr):
+    """ Given a SBML string, this function returns the right hand side
+    of the model ODEs as a vectorized NumPy function f(t, y, p)
+
+    Args:
+      sbmlStr (string): A string representing an SBML model
+
+    Returns:
+      ODEFunction: see ODEFunction for the order of y and p
+
+    Example:
+      >>> f = teUtils.odePrint.getODEFunctionFromSBMLString (sbmlStr)
+    """
+
+    return _getODEFunction (_cache.getExtractor (sbmlStr))
+
+def getODEFunctionFromModel (sbmlModel):
+    """Given a roadrunner instance this function returns the right hand side
+    of its ODEs as a vectorized NumPy function f(t, y, p). The initial state and
+    the parameter values are taken from the roadrunner instance.
+
+    Args:
+      sbmlModel (string): A reodarunner instance
+
+    Returns:
+      ODEFunction: see ODEFunction for the order of y and p
+
+    Example:
+      >>> r = te.loada ('J1: S1 -> S2; k1*S1; k1=1; S1=10')
+      >>> f = teUtils.odePrint.getODEFunctionFromModel (r)
+      >>> # The rates of change for 100000 values of k1 at once
+      >>> p = np.tile (f.parameterValues[:,None], 100000)
+      >>> p[f.parameterIds.index ('k1')] = np.linspace (0.1, 10, 100000)
+      >>> dydt = f (0, f.initialState, p)
+      >>> # Or integrate with SciPy
+      >>> sol = scipy.integrate.solve_ivp (f, (0, 10), f.initialState, vectorized=True)
+    """
+
+    from roadrunner import RoadRunner
+    if type (sbmlModel) != RoadRunner:
+       raise RuntimeError('The argument to getODEFunctionFromModel should be a roadrunner variable')
+    function = _getODEFunction (_cache.getExtractor (sbmlModel.getSBML()))
+    function._setValuesFromModel (sbmlModel)
+    return function
+
+class ODEFunction:
+    """ Right hand side of the ODEs of a model as a NumPy function, dy/dt = f(t, y, p).
+
+    The function is generated as Python source from the reactions, stoichiometries and
+    rules that odePrint extracts from the SBML, so no roadrunner instance is needed to
+    evaluate it. The state y holds the floating species followed by the variables that
+    have rate rules. Species with hasOnlySubstanceUnits set are amounts, the others are
+    concentrations. The parameters p are the global parameters, the compartment volumes
+    and the boundary species that are not set by rules, in that order. Events and delays
+    are not supported and initial assignments are not applied to the initial state.
+
+    Both y and p can have extra trailing dimensions, which are broadcast against each
+    other. So y of shape (n, k) evaluates k states at once (the form scipy.integrate.solve_ivp
+    uses with vectorized=True), and p of shape (m, k) evaluates k parameter sets at once.
+
+    Attributes:
+      stateIds (list of strings): The ids along the first axis of y
+      parameterIds (list of strings): The ids along the first axis of p
+      initialState (numpy array): Initial values of y
+      parameterValues (numpy array): Values of p used when p is not given
+      source (string): The generated Python source
+    """
+
+    def __init__(self, function, source, system):
+        self._function = function
+        self._system = system
+        self.source = source
+        self.stateIds = list (system.stateIds)
+        self.parameterIds = list (system.parameterIds)
+        self.initialState = _np.array (system.initialState, dtype=float)
+        self.parameterValues = _np.array (system.parameterValues, dtype=float)
+
+    def __call__(self, t, y, p=None):
+        """ Return dy/dt, an array with the shape of y broadcast against p """
+        y = _np.asarray (y, dtype=float)
+        p = self.parameterValues if p is None else _np.asarray (p, dtype=float)
+        return self._function (t, y, p, _np.broadcast_shapes (y.shape[1:], p.shape[1:]))
+
+    def _setValuesFromModel(self, r):
+        self.initialState = _np.array ([r[self._system.getValueName (id, initial=True)] for id in self.stateIds], dtype=float)
+        self.parameterValues = _np.array ([r[self._system.getValueName (id)] for id in self.parameterIds], dtype=float)
+
+def getCSource (function):
+    """ Return C source for the right hand side and the analytic Jacobian of the ODEs
+
+    The source defines two functions that loop over a batch of states and parameter sets
+    given as strided double arrays, see compileODEFunction.
+
+    Args:
+      function (ODEFunction): As returned by one of the getODEFunction methods
+
+    Example:
+      >>> print (teUtils.odePrint.getCSource (teUtils.odePrint.getODEFunctionFromModel (r)))
+    """
+
+    return _getCSource (function._system)
+
+def compileODEFunction (function, directory=None, compiler=None, flags=None):
+    """ Compile the right hand side and the Jacobian of the ODEs to a shared library and load it
+
+    The library is built with the local C compiler and kept in a directory keyed by a hash
+    of the source and the compiler options, so a model is only compiled once. The returned
+    function is called like the NumPy one and reads and writes the NumPy buffers in place.
+
+    Args:
+      function (ODEFunction): As returned by one of the getODEFunction methods
+      directory (string): Optional: Where the compiled libraries are kept, default is
+          $XDG_CACHE_HOME/teUtils/odePrint or ~/.cache/teUtils/odePrint
+      compiler (string): Optional: The C compiler, default is $CC or cc
+      flags (list of strings): Optional: Compiler options, default is ['-O2']
+
+    Returns:
+      CompiledODEFunction
+
+    Example:
+      >>> f = teUtils.odePrint.compileODEFunction (teUtils.odePrint.getODEFunctionFromModel (r))
+      >>> sol = scipy.integrate.solve_ivp (f, (0, 10), f.initialState, method='LSODA', jac=f.jacobian)
+    """
+
+    compiler = compiler or _os.environ.get ('CC', 'cc')
+    flags = ['-O2'] if flags is None else list (flags)
+    if directory is None:
+       directory = _os.path.join (_os.environ.get ('XDG_CACHE_HOME') or _os.path.join (_os.path.expanduser ('~'), '.cache'),
+                                  'teUtils', 'odePrint')
+    source = _getCSource (function._system)
+    path = _buildLibrary (source, directory, compiler, flags)
+    compiled = CompiledODEFunction (function._function, function.source, function._system, source, path)
+    compiled.initialState = function.initialState.copy()
+    compiled.parameterValues = function.parameterValues.copy()
+    return compiled
+
+class CompiledODEFunction (ODEFunction):
+    """ An ODEFunction whose right hand side and Jacobian run in a compiled C library.
+
+    It is called like ODEFunction, with y of shape (n,) or (n, k) and p of shape (m,) or
+    (m, k). Float64 arrays, including strided views, are passed to the library without
+    copying, and the results can be written into an existing array with out.
+
+    Attributes:
+      cSource (string): The generated C source
+      library (string): Path of the compiled shared library
+    """
+
+    def __init__(self, function, source, system, cSource, library):
+        import ctypes
+        super().__init__ (function, source, system)
+        self.cSource = cSource
+        self.library = library
+        self._library = ctypes.CDLL (library)
+        pointer, step = ctypes.c_void_p, ctypes.c_long
+        self._parameters = (None, None)
+        self._rhs = self._library.odeprint_rhs
+        self._rhs.restype = None
+        self._rhs.argtypes = [step, ctypes.c_double] + [pointer, step, step]*3
+        self._jacobian = self._library.odeprint_jacobian
+        self._jacobian.restype = None
+        self._jacobian.argtypes = [step, ctypes.c_double] + [pointer, step, step]*2 + [pointer, step, step, step]
+
+    def _prepare(self, y, p):
+        y = _asBuffer (y, len (self.stateIds), 'y')
+        p = _asBuffer (self.parameterValues if p is None else p, len (self.parameterIds), 'p')
+        shape = _np.broadcast_shapes (y.shape[1:], p.shape[1:])
+        return y, p, shape, (shape[0] if shape else 1)
+
+    def __call__(self, t, y, p=None, out=None):
+        """ Return dy/dt, an array with the shape of y broadcast against p """
+        if p is None and out is None and type (y) is _np.ndarray and y.shape == self.initialState.shape and y.dtype == _np.float64:
+            # The common case in a solver, one state and the stored parameter values
+            if self._parameters[0] is not self.parameterValues:
+                self._parameters = (self.parameterValues, _asBuffer (self.parameterValues, len (self.parameterIds), 'p'))
+            parameters = self._parameters[1]
+            out = _np.empty (y.shape)
+            self._rhs (1, t, y.ctypes.data, 0, y.strides[0]//8, *_getSteps (parameters), out.ctypes.data, 0, 1)
+            return out
+        y, p, shape, count = self._prepare (y, p)
+        out = _getOutput (out, (len (self.stateIds),) + shape)
+        self._rhs (count, t, *_getSteps (y), *_getSteps (p), *_getSteps (out))
+        return out
+
+    def jacobian(self, t, y, p=None, out=None):
+        """ Return the Jacobian d(dy/dt)/dy, of shape (n, n) followed by the batch shape """
+        y, p, shape, count = self._prepare (y, p)
+        n = len (self.stateIds)
+        out = _getOutput (out, (n, n) + shape)
+        stride = out.strides[2]//8 if len (shape) > 0 and shape[0] > 1 else 0
+        self._jacobian (count, t, *_getSteps (y), *_getSteps (p), out.ctypes.data, stride,
+                        out.strides[0]//8, out.strides[1]//8)
+        return out
 
 # This is the code that the users doesn't ened to know about
 
+def _output (extractor, outputFile):
+    if outputFile is None:
+       if extractor.text is None:
+          extractor.text = extractor._toString()
+       return extractor.text
+    if extractor.text is not None:
+       _writeText (extractor.text, outputFile)
+    else:
+       extractor._write (outputFile)
+
+def _writeText (text, outputFile):
+    if hasattr(outputFile, 'write'):
+       outputFile.write (text)
+    else:
+       with open(outputFile, 'w') as f:
+           f.write (text)
+
+class _ExtractionCache:
+    # Least recently used cache of extractors keyed by the SHA-256 of the SBML. Files are
+    # looked up by path, modification time and size first so an unchanged file is not read.
+
+    def __init__(self, maxEntries=16, maxBytes=64*1024**2):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._entries = _collections.OrderedDict()
+        self._files = {}
+        self._lock = _threading.Lock()
+
+    def setLimits(self, maxEntries, maxBytes):
+        with self._lock:
+            self.maxEntries = maxEntries
+            self.maxBytes = maxBytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._files.clear()
+            self._bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'bytes': self._bytes}
+
+    def _evict(self):
+        # The newest entry is kept even if it is larger than maxBytes on its own
+        while len(self._entries) > self.maxEntries or (len(self._entries) > 1 and self._bytes > self.maxBytes):
+            key, extractor = self._entries.popitem(last=False)
+            self._bytes -= extractor.size
+        if len(self._files) > 4*max(self.maxEntries, 1):
+            self._files = {fileKey: key for fileKey, key in self._files.items() if key in self._entries}
+
+    def _get(self, sbmlStr):
+        key = _hashlib.sha256(sbmlStr.encode()).hexdigest()
+        with self._lock:
+            extractor = self._entries.get(key)
+            if extractor is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return key, extractor
+            self.misses += 1
+        # Parsed outside the lock, two threads asking for the same new model may both parse it
+        extractor = _ODEExtractor(sbmlStr)
+        with self._lock:
+            if self.maxEntries > 0 and key not in self._entries:
+                self._entries[key] = extractor
+                self._bytes += extractor.size
+                self._evict()
+        return key, extractor
+
+    def getExtractor(self, sbmlStr):
+        return self._get(sbmlStr)[1]
+
+    def getFileExtractor(self, fileName):
+        stat = _os.stat(fileName)
+        fileKey = (_os.path.abspath(fileName), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            key = self._files.get(fileKey)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        with open (fileName) as f:
+            sbmlStr = f.read()
+        key, extractor = self._get(sbmlStr)
+        with self._lock:
+            self._files[fileKey] = key
+        return extractor
+
+_cache = _ExtractionCache()
+
 class _Accumulator:
     def __init__(self, species_id):
         self.reaction_map = {}
         self.reactions = []
         self.species_id = species_id
 
-    def _addReaction(self, reaction, stoich):
+    def _addReaction(self, reaction, stoich, formula=None):
         rid = reaction.getId()
         if rid in self.reaction_map:
             self.reaction_map[rid]['stoich'] += stoich
@@ -77,7 +425,7 @@ class _Accumulator:
             self.reaction_map[rid] = {
                 'reaction': reaction,
                 'id': rid,
-                'formula': self._getFormula(reaction),
+                'formula': self._getFormula(reaction) if formula is None else formula,
                 'stoich': stoich,
             }
             self.reactions.append(rid)
@@ -86,34 +434,18 @@ class _Accumulator:
         return reaction.getKineticLaw().getFormula()
 
     def _toString(self, use_ids=False):
-        lhs = 'd{}/dt'.format(self.species_id)
         terms = []
         for rid in self.reactions:
-            if abs(self.reaction_map[rid]['stoich']) == 1:
-                stoich = ''
-            else:
-                stoich = str(abs(self.reaction_map[rid]['stoich'])) + '*'
-
+            entry = self.reaction_map[rid]
+            value = entry['stoich']
             if len(terms) > 0:
-                if self.reaction_map[rid]['stoich'] < 0:
-                    op = ' - '
-                else:
-                    op = ' + '
+                op = ' - ' if value < 0 else ' + '
             else:
-                if self.reaction_map[rid]['stoich'] < 0:
-                    op = '-'
-                else:
-                    op = ''
-
-            if use_ids:
-                expr = 'v' + self.reaction_map[rid]['id']
-            else:
-                expr = self.reaction_map[rid]['formula']
-
+                op = '-' if value < 0 else ''
+            stoich = '' if abs(value) == 1 else str(abs(value)) + '*'
+            expr = 'v' + entry['id'] if use_ids else entry['formula']
             terms.append(op + stoich + expr)
-
-        rhs = ''.join(terms)
-        return lhs + ' = ' + rhs
+        return 'd' + self.species_id + '/dt = ' + ''.join(terms)
 
 class _ODEExtractor:
 
@@ -121,29 +453,21 @@ class _ODEExtractor:
 
         self.doc = libsbml.readSBMLFromString (sbmlStr)
         self.model = self.doc.getModel()
+        # Used by the extraction cache and the code generators
+        self.size = len(sbmlStr)
+        self.text = None
+        self.system = None
+        self.numpyFunction = None
 
         self.species_map = {}
         self.species_symbol_map = {}
         self.use_species_names = False
         self.use_ids = True
 
-        from collections import defaultdict
         self.accumulators = {}
         self.accumulator_list = []
-
-        def reactionParticipant(participant, stoich):
-            stoich_sign = 1
-            if stoich < 0:
-                stoich_sign = -1
-            if participant.isSetStoichiometry():
-                stoich = participant.getStoichiometry()
-            elif participant.isSetStoichiometryMath():
-                raise RuntimeError('Stoichiometry math not supported')
-            self.accumulators[participant.getSpecies()]._addReaction(r, stoich_sign*stoich)
-
-        newReactant = lambda p: reactionParticipant(p, -1)
-        newProduct  = lambda p: reactionParticipant(p, 1)
-
+        # Kinetic law formulas by reaction id, each formula is only written out once
+        self.formulas = {}
 
         for s in (self.model.getSpecies(i) for i in range(self.model.getNumSpecies())):
             self.species_map[s.getId()] = s
@@ -156,49 +480,770 @@ class _ODEExtractor:
             self.accumulator_list.append(a)
 
         for r in (self.model.getReaction(i) for i in range(self.model.getNumReactions())):
+            formula = r.getKineticLaw().getFormula()
+            self.formulas[r.getId()] = formula
             for reactant in (r.getReactant(i) for i in range(r.getNumReactants())):
-                newReactant(reactant)
+                self._reactionParticipant(r, reactant, -1, formula)
             for product in (r.getProduct(i) for i in range(r.getNumProducts())):
-                newProduct(product)
+                self._reactionParticipant(r, product, 1, formula)
+
+    def _reactionParticipant(self, reaction, participant, stoich, formula):
+        stoich_sign = 1
+        if stoich < 0:
+            stoich_sign = -1
+        if participant.isSetStoichiometry():
+            stoich = participant.getStoichiometry()
+        elif participant.isSetStoichiometryMath():
+            raise RuntimeError('Stoichiometry math not supported')
+        self.accumulators[participant.getSpecies()]._addReaction(reaction, stoich_sign*stoich, formula)
+
+    def _iterRules (self):
+        for rule in (self.model.getRule(i) for i in range(self.model.getNumRules())):
+            if rule.getType() == 0:
+                yield 'd' + rule.getId() + '/dt = ' + rule.getFormula() + '\n'
+            if rule.getType() == 1:
+                yield rule.getId() + ' = ' + rule.getFormula() + '\n'
+
+    def _iterKineticLaws (self):
+        if self.use_ids:
+            yield '\n'
+            for rid, formula in self.formulas.items():
+                yield 'v' + rid + ' = ' + formula.replace(" ", "") + '\n'
+
+    def _iterRatesOfChange (self):
+        for a in self.accumulator_list:
+            if not self.species_map[a.species_id].getBoundaryCondition():
+                yield a._toString(use_ids=self.use_ids) + '\n'
+
+    def _iterLines (self):
+        # The text is produced line by line so that it can be joined or written out in linear time
+        yield from self._iterRules()
+        yield from self._iterKineticLaws()
+        yield '\n'
+        yield from self._iterRatesOfChange()
 
     def _getRules (self):
-        r = ''
-        for i in range (self.model.getNumRules()):
-            if self.model.getRule(i).getType() == 0:
-                r += 'd' + self.model.getRule(i).getId() + '/dt = ' + self.model.getRule(i).getFormula() + '\n'
-            if self.model.getRule(i).getType() == 1:
-                r += self.model.getRule(i).getId() + ' = ' + self.model.getRule(i).getFormula() + '\n'
-        return r
+        return ''.join(self._iterRules())
 
     def _getKineticLaws (self):
-        r = ''
-        if self.use_ids:
-            r += '\n'
-            for rx in (self.model.getReaction(i) for i in range(self.model.getNumReactions())):
-                r += 'v' + rx.getId() + ' = ' + rx.getKineticLaw().getFormula().replace(" ", "")  + '\n'
-        return r
+        return ''.join(self._iterKineticLaws())
 
     def _getRateOfChange (self, index):
         return self.accumulator_list[index]._toString(use_ids=self.use_ids) + '\n'
 
     def _getRatesOfChange (self):
-        r = '\n'
-        for a in self.accumulator_list:
-            r += a._toString(use_ids=self.use_ids) + '\n'
-        return r
+        return '\n' + ''.join(a._toString(use_ids=self.use_ids) + '\n' for a in self.accumulator_list)
 
     def _toString(self):
-        r = self._getRules()
-        r = r + self._getKineticLaws() + '\n'
-        for index in range (self.model.getNumSpecies()):
-            if not self.model.getSpecies (index).getBoundaryCondition():
-               r = r + self._getRateOfChange (index)
-        return r
+        return ''.join(self._iterLines())
+
+    def _write(self, outputFile):
+        if hasattr(outputFile, 'write'):
+            outputFile.writelines(self._iterLines())
+        else:
+            with open(outputFile, 'w') as f:
+                f.writelines(self._iterLines())
+
+class _MathPrinter:
+    # Writes libsbml math as NumPy source. Nodes are told apart with the is* methods and
+    # their names, because ASTNode.getType returns an unusable SWIG pointer when libsbml
+    # is imported before tellurium.
+    functions = {'exp': '_np.exp', 'ln': '_np.log', 'abs': '_np.abs', 'floor': '_np.floor',
+                 'ceil': '_np.ceil', 'ceiling': '_np.ceil', 'sin': '_np.sin', 'cos': '_np.cos',
+                 'tan': '_np.tan', 'sinh': '_np.sinh', 'cosh': '_np.cosh', 'tanh': '_np.tanh',
+                 'arcsin': '_np.arcsin', 'arccos': '_np.arccos', 'arctan': '_np.arctan',
+                 'arcsinh': '_np.arcsinh', 'arccosh': '_np.arccosh', 'arctanh': '_np.arctanh'}
+    reciprocals = {'sec': 'cos', 'csc': 'sin', 'cot': 'tan', 'sech': 'cosh', 'csch': 'sinh', 'coth': 'tanh'}
+    constants = {'pi': '_np.pi', 'exponentiale': '_np.e', 'true': 'True', 'false': 'False'}
+    relations = {'eq': '==', 'neq': '!=', 'gt': '>', 'lt': '<', 'geq': '>=', 'leq': '<='}
+    logicals = {'and': '_np.logical_and', 'or': '_np.logical_or', 'xor': '_np.logical_xor'}
+    infinity = '_np.inf'
+    notANumber = '_np.nan'
+    avogadro = '6.02214076e+23'
+
+    def number(self, value):
+        value = float (value)
+        if value != value:
+            return self.notANumber
+        if value in (float ('inf'), -float ('inf')):
+            return self.infinity if value > 0 else '(-' + self.infinity + ')'
+        return repr (value)
+
+    def call(self, function, args):
+        return function + '(' + ', '.join (args) + ')'
+
+    def power(self, base, exponent):
+        return '(' + base + ' ** ' + exponent + ')'
+
+    def where(self, condition, value, otherwise):
+        return self.call ('_np.where', [condition, value, otherwise])
+
+    def remainder(self, a, b):
+        return self.call ('_np.fmod', [a, b])
+
+    def truncate(self, a):
+        return self.call ('_np.trunc', [a])
+
+    def logical(self, name, args):
+        if name == 'not':
+            return self.call ('_np.logical_not', args)
+        code = args[0]
+        for arg in args[1:]:
+            code = self.call (self.logicals[name], [code, arg])
+        return code
+
+    def extreme(self, name, args):
+        code = args[0]
+        for arg in args[1:]:
+            code = self.call ('_np.maximum' if name == 'max' else '_np.minimum', [code, arg])
+        return code
+
+    def toCode(self, node, names):
+        children = [node.getChild (i) for i in range (node.getNumChildren())]
+        code = lambda child: self.toCode (child, names)
+        if node.isNumber():
+            if node.isInteger():
+                return self.number (node.getInteger())
+            if node.isRational():
+                return self.number (node.getNumerator()/node.getDenominator())
+            return self.number (node.getReal())
+        name = node.getName()
+        if node.isName():
+            url = node.getDefinitionURLString()
+            if url.endswith ('/time'):
+                return 't'
+            if url.endswith ('/avogadro'):
+                return self.avogadro
+            if name not in names:
+                raise RuntimeError('Unknown symbol ' + name + ' in a formula')
+            return names[name]
+        if node.isConstant():
+            return self.constants[name]
+        if node.isOperator():
+            op = node.getCharacter()
+            args = [code (child) for child in children]
+            if op == '^':
+                return self.power (args[0], args[1])
+            if len (args) == 0:
+                return self.number (0 if op == '+' else 1)
+            if op == '-' and len (args) == 1:
+                return '(-' + args[0] + ')'
+            return '(' + (' ' + op + ' ').join (args) + ')'
+        if node.isRelational():
+            args = [code (child) for child in children]
+            return self.logical ('and', ['(' + a + ' ' + self.relations[name] + ' ' + b + ')'
+                                         for a, b in zip (args[:-1], args[1:])])
+        if node.isLogical():
+            return self.logical (name, [code (child) for child in children])
+        if node.isPiecewise():
+            args = [code (child) for child in children]
+            result = args[-1] if len (args) % 2 == 1 else self.notANumber
+            for i in range (len (args) - len (args) % 2 - 2, -1, -2):
+                result = self.where (args[i + 1], args[i], result)
+            return result
+        if node.isUserFunction():
+            return self.call ('f_' + name, [code (child) for child in children])
+        if node.isFunction():
+            args = [code (child) for child in children]
+            if name in self.functions:
+                return self.call (self.functions[name], args)
+            if name in self.reciprocals:
+                return '(1.0 / ' + self.call (self.functions[self.reciprocals[name]], args) + ')'
+            if name in ('log', 'log10'):
+                if len (args) == 1:
+                    args = [self.number (10)] + args
+                return '(' + self.call (self.functions['ln'], args[1:]) + ' / ' + self.call (self.functions['ln'], args[:1]) + ')'
+            if name in ('root', 'sqrt'):
+                if len (args) == 1:
+                    args = [self.number (2)] + args
+                return self.power (args[1], '(1.0 / ' + args[0] + ')')
+            if name in ('power', 'pow'):
+                return self.power (args[0], args[1])
+            if name in ('max', 'min'):
+                return self.extreme (name, args)
+            if name == 'rem':
+                return self.remainder (args[0], args[1])
+            if name == 'quotient':
+                return self.truncate ('(' + args[0] + ' / ' + args[1] + ')')
+        raise RuntimeError('The function ' + str (name) + ' is not supported')
+
+def _getNames(node, names=None):
+    # All the symbols a formula refers to
+    if names is None:
+        names = set()
+    if node.isName():
+        names.add (node.getName())
+    for i in range (node.getNumChildren()):
+        _getNames (node.getChild (i), names)
+    return names
+
+class _ODESystem:
+    # The model as lists of state variables, parameters, ordered assignments, reaction
+    # rates and derivatives, built from an extractor and shared by the code generators
+
+    def __init__(self, extractor):
+        model = extractor.model
+        self.model = model
+        species = [model.getSpecies (i) for i in range (model.getNumSpecies())]
+        parameters = [model.getParameter (i) for i in range (model.getNumParameters())]
+        compartments = [model.getCompartment (i) for i in range (model.getNumCompartments())]
+        self.volumes = {c.getId(): (c.getSize() if c.isSetSize() else 1.0) for c in compartments}
+        self.species = {s.getId(): s for s in species}
+
+        assignmentRules, rateRules = {}, {}
+        for rule in (model.getRule (i) for i in range (model.getNumRules())):
+            if rule.isAlgebraic():
+                raise RuntimeError('Algebraic rules are not supported')
+            (rateRules if rule.isRate() else assignmentRules)[rule.getVariable()] = rule.getMath()
+        if model.getNumEvents() > 0:
+            import warnings
+            warnings.warn ('The events in this model are ignored')
+
+        self.stateIds, self.initialState, self.derivatives = [], [], []
+        for s in species:
+            id = s.getId()
+            if s.getBoundaryCondition() or s.getConstant() or id in assignmentRules or id in rateRules:
+                continue
+            if not s.getHasOnlySubstanceUnits() and s.getCompartment() in rateRules:
+                raise RuntimeError('Species in compartments whose volume changes are not supported')
+            accumulator = extractor.accumulators[id]
+            terms = [(rid, accumulator.reaction_map[rid]['stoich']) for rid in accumulator.reactions]
+            volume = None if s.getHasOnlySubstanceUnits() else s.getCompartment()
+            self.stateIds.append (id)
+            self.initialState.append (self._getSpeciesValue (s))
+            self.derivatives.append (('reactions', terms, volume))
+        for id, math in rateRules.items():
+            self.stateIds.append (id)
+            self.initialState.append (self._getValue (id))
+            self.derivatives.append (('rule', math, None))
+
+        self.parameterIds, self.parameterValues = [], []
+        candidates = ([p.getId() for p in parameters] + [c.getId() for c in compartments] +
+                      [s.getId() for s in species if s.getBoundaryCondition() or s.getConstant()])
+        for id in candidates:
+            if id not in assignmentRules and id not in rateRules:
+                self.parameterIds.append (id)
+                self.parameterValues.append (self._getValue (id))
+
+        self.functions = []
+        for function in (model.getFunctionDefinition (i) for i in range (model.getNumFunctionDefinitions())):
+            self.functions.append ((function.getId(), [function.getArgument (i).getName() for i in range (function.getNumArguments())],
+                                    function.getBody()))
+
+        self.reactions = []
+        for reaction in (model.getReaction (i) for i in range (model.getNumReactions())):
+            law = reaction.getKineticLaw()
+            local = {law.getParameter (i).getId(): law.getParameter (i).getValue() for i in range (law.getNumParameters())}
+            self.reactions.append ((reaction.getId(), law.getMath(), local))
+
+        self.assignments = self._orderAssignments (assignmentRules)
+        self.cSource = None
+
+    def _orderAssignments(self, assignmentRules):
+        # Each assignment is computed after the assignments it depends on
+        ordered, done = [], set()
+        def visit(id, path):
+            if id in done:
+                return
+            if id in path:
+                raise RuntimeError('The assignment rules of ' + id + ' depend on each other')
+            for name in _getNames (assignmentRules[id]):
+                if name in assignmentRules:
+                    visit (name, path | {id})
+            done.add (id)
+            ordered.append ((id, assignmentRules[id]))
+        for id in assignmentRules:
+            visit (id, set())
+        return ordered
+
+    def _getSpeciesValue(self, s):
+        volume = self.volumes.get (s.getCompartment(), 1.0)
+        if s.isSetInitialConcentration():
+            value = s.getInitialConcentration()
+            return value*volume if s.getHasOnlySubstanceUnits() else value
+        if s.isSetInitialAmount():
+            value = s.getInitialAmount()
+            return value if s.getHasOnlySubstanceUnits() else value/volume
+        return 0.0
+
+    def _getValue(self, id):
+        if id in self.species:
+            return self._getSpeciesValue (self.species[id])
+        if id in self.volumes:
+            return self.volumes[id]
+        parameter = self.model.getParameter (id)
+        return parameter.getValue() if parameter is not None and parameter.isSetValue() else 0.0
+
+    def getValueName(self, id, initial=False):
+        # The name roadrunner uses for the value of a symbol in the units of the state
+        if id in self.species and not self.species[id].getHasOnlySubstanceUnits():
+            id = '[' + id + ']'
+        return 'init(' + id + ')' if initial else id
+
+    def getNames(self):
+        names = {id: 's_' + id for id in self.stateIds + self.parameterIds}
+        names.update ({id: 's_' + id for id, math in self.assignments})
+        names.update ({rid: 'v_' + rid for rid, math, local in self.reactions})
+        return names
+
+    def getRateSum(self, terms, printer, names):
+        # The sum of stoichiometry times rate over the reactions that change a species
+        code = ''
+        for rid, stoich in terms:
+            if stoich == 0:
+                continue
+            term = names[rid] if abs (stoich) == 1 else printer.number (abs (stoich)) + '*' + names[rid]
+            code += (' - ' if stoich < 0 else ' + ') + term if code else ('-' if stoich < 0 else '') + term
+        return '(' + code + ')' if code else printer.number (0)
+
+def _getFunctionNames(args):
+    return {arg: 'a_' + arg for arg in args}
+
+def _getNumpySource(system):
+    printer = _MathPrinter()
+    names = system.getNames()
+    lines = []
+    for id, args, body in system.functions:
+        lines.append ('def f_' + id + '(' + ', '.join ('a_' + arg for arg in args) + '):')
+        lines.append ('    return ' + printer.toCode (body, _getFunctionNames (args)))
+        lines.append ('')
+    lines.append ('def rhs(t, y, p, shape):')
+    lines.extend ('    s_' + id + ' = y[' + str (i) + ']' for i, id in enumerate (system.stateIds))
+    lines.extend ('    s_' + id + ' = p[' + str (i) + ']' for i, id in enumerate (system.parameterIds))
+    for id, math in system.assignments:
+        lines.append ('    s_' + id + ' = ' + printer.toCode (math, names))
+    for rid, math, local in system.reactions:
+        reactionNames = dict (names)
+        reactionNames.update ({id: printer.number (value) for id, value in local.items()})
+        lines.append ('    v_' + rid + ' = ' + printer.toCode (math, reactionNames))
+    lines.append ('    dydt = _np.empty((' + str (len (system.stateIds)) + ',) + shape)')
+    for i, (kind, value, volume) in enumerate (system.derivatives):
+        code = system.getRateSum (value, printer, names) if kind == 'reactions' else printer.toCode (value, names)
+        if volume is not None:
+            code += ' / ' + names[volume]
+        lines.append ('    dydt[' + str (i) + '] = ' + code)
+    lines.append ('    return dydt')
+    return '\n'.join (lines) + '\n'
+
+def _getSystem(extractor):
+    if extractor.system is None:
+       extractor.system = _ODESystem (extractor)
+    return extractor.system
+
+def _getODEFunction(extractor):
+    if extractor.numpyFunction is None:
+       system = _getSystem (extractor)
+       source = _getNumpySource (system)
+       namespace = {'_np': _np}
+       exec (compile (source, '<odePrint rhs>', 'exec'), namespace)
+       extractor.numpyFunction = (namespace['rhs'], source)
+    function, source = extractor.numpyFunction
+    return ODEFunction (function, source, extractor.system)
+
+
+class _CPrinter (_MathPrinter):
+    # Writes libsbml math as C source
+    functions = {'exp': 'exp', 'ln': 'log', 'abs': 'fabs', 'floor': 'floor', 'ceil': 'ceil',
+                 'ceiling': 'ceil', 'sin': 'sin', 'cos': 'cos', 'tan': 'tan', 'sinh': 'sinh',
+                 'cosh': 'cosh', 'tanh': 'tanh', 'arcsin': 'asin', 'arccos': 'acos', 'arctan': 'atan',
+                 'arcsinh': 'asinh', 'arccosh': 'acosh', 'arctanh': 'atanh'}
+    constants = {'pi': repr (_math.pi), 'exponentiale': repr (_math.e), 'true': '1.0', 'false': '0.0'}
+    infinity = 'INFINITY'
+    notANumber = 'NAN'
+
+    def power(self, base, exponent):
+        return self.call ('pow', [base, exponent])
+
+    def where(self, condition, value, otherwise):
+        return '(' + condition + ' ? ' + value + ' : ' + otherwise + ')'
+
+    def remainder(self, a, b):
+        return self.call ('fmod', [a, b])
+
+    def truncate(self, a):
+        return self.call ('trunc', [a])
+
+    def logical(self, name, args):
+        if name == 'not':
+            return '(!' + args[0] + ')'
+        if name == 'xor':
+            code = args[0]
+            for arg in args[1:]:
+                code = '(!' + code + ' != !' + arg + ')'
+            return code
+        return '(' + (' && ' if name == 'and' else ' || ').join (args) + ')'
+
+    def extreme(self, name, args):
+        code = args[0]
+        for arg in args[1:]:
+            code = self.call ('fmax' if name == 'max' else 'fmin', [code, arg])
+        return code
+
+def _add(terms):
+    terms = [term for term in terms if term is not None]
+    if len (terms) == 0:
+        return None
+    return terms[0] if len (terms) == 1 else '(' + ' + '.join (terms) + ')'
+
+def _multiply(factors):
+    if any (factor is None for factor in factors):
+        return None
+    factors = [factor for factor in factors if factor != '1.0']
+    if len (factors) == 0:
+        return '1.0'
+    return factors[0] if len (factors) == 1 else '(' + ' * '.join (factors) + ')'
+
+def _negate(a):
+    return None if a is None else '(-' + a + ')'
+
+def _divide(a, b):
+    return None if a is None else '(' + a + ' / ' + b + ')'
+
+class _Differentiator:
+    # Symbolic derivatives of libsbml math, written as code by a printer. A derivative of
+    # None stands for zero, so terms that do not depend on the variable are left out.
+    # dnames maps symbols to the code of their derivatives, which carries the chain rule
+    # through assignment rules and reaction rates.
+
+    def __init__(self, printer, functions):
+        self.printer = printer
+        self.functions = {id: (args, body) for id, args, body in functions}
+
+    def _expand(self, node):
+        # A call of a function definition with the arguments put into its body
+        args, body = self.functions[node.getName()]
+        expanded = body.deepCopy()
+        for i, arg in enumerate (args):
+            expanded.renameSIdRefs (arg, '__odePrintArgument' + str (i))
+        for i in range (len (args)):
+            expanded.replaceArgument ('__odePrintArgument' + str (i), node.getChild (i))
+        return expanded
+
+    def _power(self, base, exponent, dbase, dexponent):
+        if dexponent is None:
+            if dbase is None:
+                return None
+            return _multiply ([exponent, self.printer.power (base, '(' + exponent + ' - 1.0)'), dbase])
+        log = self.printer.call (self.printer.functions['ln'], [base])
+        return _multiply ([self.printer.power (base, exponent),
+                           _add ([_multiply ([dexponent, log]), _divide (_multiply ([exponent, dbase]), base)])])
+
+    def derivative(self, node, names, dnames):
+        printer = self.printer
+        children = [node.getChild (i) for i in range (node.getNumChildren())]
+        if node.isNumber() or node.isConstant() or node.isRelational() or node.isLogical():
+            return None
+        if node.isName():
+            # Time and avogadro have definition URLs and do not depend on the state
+            return None if node.getDefinitionURLString() else dnames.get (node.getName())
+        if node.isUserFunction():
+            return self.derivative (self._expand (node), names, dnames)
+        values = [printer.toCode (child, names) for child in children]
+        d = [self.derivative (child, names, dnames) for child in children]
+        name = node.getName()
+        if node.isOperator():
+            op = node.getCharacter()
+            if op == '+':
+                return _add (d)
+            if op == '-':
+                return _negate (d[0]) if len (d) == 1 else _add ([d[0], _negate (d[1])])
+            if op == '*':
+                return _add ([_multiply ([d[i]] + values[:i] + values[i + 1:]) for i in range (len (d))])
+            if op == '/':
+                if d[1] is None:
+                    return _divide (d[0], values[1])
+                numerator = _add ([_multiply ([d[0], values[1]]), _negate (_multiply ([values[0], d[1]]))])
+                return _divide (numerator, '(' + values[1] + ' * ' + values[1] + ')')
+            if op == '^':
+                return self._power (values[0], values[1], d[0], d[1])
+        if node.isPiecewise():
+            if all (d[i] is None for i in range (0, len (d), 2)):
+                return None
+            zero = printer.number (0)
+            result = (d[-1] or zero) if len (d) % 2 == 1 else zero
+            for i in range (len (d) - len (d) % 2 - 2, -1, -2):
+                result = printer.where (values[i + 1], d[i] or zero, result)
+            return result
+        if node.isFunction():
+            call = lambda function, arg: printer.call (printer.functions[function], [arg])
+            if name in ('power', 'pow'):
+                return self._power (values[0], values[1], d[0], d[1])
+            if name in ('root', 'sqrt'):
+                if len (values) == 1:
+                    values, d = [printer.number (2)] + values, [None] + d
+                if d[0] is not None:
+                    raise RuntimeError('A root with a degree that depends on the state is not supported')
+                return self._power (values[1], '(1.0 / ' + values[0] + ')', d[1], None)
+            if name in ('log', 'log10'):
+                if len (values) == 1:
+                    values, d = [printer.number (10)] + values, [None] + d
+                if d[0] is not None:
+                    raise RuntimeError('A logarithm with a base that depends on the state is not supported')
+                return _divide (d[1], '(' + values[1] + ' * ' + call ('ln', values[0]) + ')')
+            if name in ('floor', 'ceil', 'ceiling', 'quotient'):
+                return None
+            if name == 'rem':
+                return _add ([d[0], _negate (_multiply ([printer.truncate ('(' + values[0] + ' / ' + values[1] + ')'), d[1]]))])
+            if name in ('max', 'min'):
+                zero = printer.number (0)
+                result, dresult = values[0], d[0]
+                for value, dvalue in zip (values[1:], d[1:]):
+                    if dresult is not None or dvalue is not None:
+                        op = ' >= ' if name == 'max' else ' <= '
+                        dresult = printer.where ('(' + result + op + value + ')', dresult or zero, dvalue or zero)
+                    result = printer.extreme (name, [result, value])
+                return dresult
+            if d[0] is None:
+                return None
+            x = values[0]
+            rules = {'exp': lambda: call ('exp', x),
+                     'ln': lambda: '(1.0 / ' + x + ')',
+                     'abs': lambda: printer.where ('(' + x + ' > 0)', '1.0', printer.where ('(' + x + ' < 0)', '-1.0', '0.0')),
+                     'sin': lambda: call ('cos', x),
+                     'cos': lambda: _negate (call ('sin', x)),
+                     'tan': lambda: '(1.0 / (' + call ('cos', x) + ' * ' + call ('cos', x) + '))',
+                     'sinh': lambda: call ('cosh', x),
+                     'cosh': lambda: call ('sinh', x),
+                     'tanh': lambda: '(1.0 - ' + call ('tanh', x) + ' * ' + call ('tanh', x) + ')',
+                     'arcsin': lambda: '(1.0 / ' + printer.power ('(1.0 - ' + x + ' * ' + x + ')', '0.5') + ')',
+                     'arccos': lambda: '(-1.0 / ' + printer.power ('(1.0 - ' + x + ' * ' + x + ')', '0.5') + ')',
+                     'arctan': lambda: '(1.0 / (1.0 + ' + x + ' * ' + x + '))',
+                     'arcsinh': lambda: '(1.0 / ' + printer.power ('(' + x + ' * ' + x + ' + 1.0)', '0.5') + ')',
+                     'arccosh': lambda: '(1.0 / ' + printer.power ('(' + x + ' * ' + x + ' - 1.0)', '0.5') + ')',
+                     'arctanh': lambda: '(1.0 / (1.0 - ' + x + ' * ' + x + '))',
+                     'sec': lambda: '(' + call ('sin', x) + ' / (' + call ('cos', x) + ' * ' + call ('cos', x) + '))',
+                     'csc': lambda: '(-' + call ('cos', x) + ' / (' + call ('sin', x) + ' * ' + call ('sin', x) + '))',
+                     'cot': lambda: '(-1.0 / (' + call ('sin', x) + ' * ' + call ('sin', x) + '))',
+                     'sech': lambda: '(-' + call ('sinh', x) + ' / (' + call ('cosh', x) + ' * ' + call ('cosh', x) + '))',
+                     'csch': lambda: '(-' + call ('cosh', x) + ' / (' + call ('sinh', x) + ' * ' + call ('sinh', x) + '))',
+                     'coth': lambda: '(-1.0 / (' + call ('sinh', x) + ' * ' + call ('sinh', x) + '))'}
+            if name in rules:
+                return _multiply ([rules[name](), d[0]])
+        raise RuntimeError('The derivative of ' + str (name) + ' is not supported')
+
+def _getDependencies(system):
+    # The state variables each assignment, reaction and derivative depends on
+    states = set (system.stateIds)
+    dependencies = {}
+    def collect(names, local=()):
+        result = set()
+        for name in names:
+            if name in local:
+                continue
+            if name in states:
+                result.add (name)
+            elif name in dependencies:
+                result |= dependencies[name]
+        return result
+    for id, math in system.assignments:
+        dependencies[id] = collect (_getNames (math))
+    for rid, math, local in system.reactions:
+        dependencies[rid] = collect (_getNames (math), local)
+    rows = []
+    for kind, value, volume in system.derivatives:
+        rows.append (collect ([rid for rid, stoich in value] if kind == 'reactions' else _getNames (value)))
+    return dependencies, rows
+
+def _getCNames(system):
+    # The state and parameters are read straight from the buffers and the assignments and
+    # rates are kept in a work array. Large models compile much faster than with a local
+    # variable for each symbol.
+    names = {id: 'yb[' + str (i) + '*yStride]' for i, id in enumerate (system.stateIds)}
+    names.update ({id: 'pb[' + str (i) + '*pStride]' for i, id in enumerate (system.parameterIds)})
+    names.update ({id: 'w[' + str (i) + ']' for i, (id, math) in enumerate (system.assignments)})
+    names.update ({rid: 'w[' + str (len (system.assignments) + i) + ']' for i, (rid, math, local) in enumerate (system.reactions)})
+    return names
+
+def _getCValues(system, printer, names):
+    # The statements that compute the assignments and rates
+    lines = [names[id] + ' = ' + printer.toCode (math, names) + ';' for id, math in system.assignments]
+    for rid, math, local in system.reactions:
+        lines.append (names[rid] + ' = ' + printer.toCode (math, _getReactionNames (names, local, printer)) + ';')
+    return lines
+
+def _getReactionNames(names, local, printer):
+    if not local:
+        return names
+    reactionNames = dict (names)
+    reactionNames.update ({id: printer.number (value) for id, value in local.items()})
+    return reactionNames
+
+# Statements per generated C function. Compilers optimize one very long function in
+# much more than linear time, so large models are split into many short functions.
+_cChunkLines = 200
+
+def _getCChunks(name, statements):
+    # Definitions of functions that run the statements in order, and the calls to them
+    definitions, calls = [], []
+    chunks, chunk, size = [], [], 0
+    for statement in statements:
+        chunk.append (statement)
+        size += statement.count ('\n') + 1
+        if size >= _cChunkLines:
+            chunks.append (chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append (chunk)
+    for i, chunk in enumerate (chunks):
+        function = name + '_' + str (i)
+        definitions.append ('static NOINLINE void ' + function + '(double t, const double *yb, long yStride, const double *pb, long pStride,')
+        definitions.append ('        double *w, double *ob, long oStride, long oColumnStride)')
+        definitions.append ('{')
+        definitions.extend ('    ' + statement.replace ('\n', '\n    ') for statement in chunk)
+        definitions.append ('}')
+        definitions.append ('')
+        calls.append ('        ' + function + '(t, yb, yStride, pb, pStride, w, ob, oStride, oColumnStride);')
+    return definitions, calls
+
+def _getCSource(system):
+    if system.cSource is not None:
+        return system.cSource
+    printer = _CPrinter()
+    differentiator = _Differentiator (printer, system.functions)
+    names = _getCNames (system)
+    n = len (system.stateIds)
+    lines = ['/* Right hand side and Jacobian generated by teUtils.odePrint */', '#include <math.h>', '#include <stdlib.h>', '',
+             '#if defined(__GNUC__)', '#define NOINLINE __attribute__((noinline))', '#else', '#define NOINLINE', '#endif', '']
+    for id, args, body in system.functions:
+        lines.append ('static double f_' + id + '(' + ', '.join ('double a_' + arg for arg in args) + ')')
+        lines.append ('{')
+        lines.append ('    return ' + printer.toCode (body, _getFunctionNames (args)) + ';')
+        lines.append ('}')
+        lines.append ('')
+
+    values = _getCValues (system, printer, names)
+    rows = []
+    for i, (kind, value, volume) in enumerate (system.derivatives):
+        code = system.getRateSum (value, printer, names) if kind == 'reactions' else printer.toCode (value, names)
+        if volume is not None:
+            code += ' / ' + names[volume]
+        rows.append ('ob[' + str (i) + '*oStride] = ' + code + ';')
+
+    dependencies, rowDependencies = _getDependencies (system)
+    columns = []
+    # One block per column, only the terms that depend on that state are differentiated
+    for column, stateId in enumerate (system.stateIds):
+        block, dnames = [], {stateId: '1.0'}
+        for id, math in system.assignments:
+            if stateId in dependencies[id]:
+                code = differentiator.derivative (math, names, dnames)
+                if code is not None:
+                    dnames[id] = 'd' + str (len (block))
+                    block.append ('    const double ' + dnames[id] + ' = ' + code + ';')
+        for rid, math, local in system.reactions:
+            if stateId in dependencies[rid]:
+                reactionNames = _getReactionNames (names, local, printer)
+                reactionDNames = {id: code for id, code in dnames.items() if id not in local}
+                code = differentiator.derivative (math, reactionNames, reactionDNames)
+                if code is not None:
+                    dnames[rid] = 'd' + str (len (block))
+                    block.append ('    const double ' + dnames[rid] + ' = ' + code + ';')
+        for row, (kind, value, volume) in enumerate (system.derivatives):
+            if stateId not in rowDependencies[row]:
+                continue
+            if kind == 'reactions':
+                code = _add ([_multiply ([printer.number (stoich), dnames[rid]]) for rid, stoich in value
+                              if rid in dnames and stoich != 0])
+            else:
+                code = differentiator.derivative (value, names, dnames)
+            if code is None:
+                continue
+            if volume is not None:
+                code = '(' + code + ' / ' + names[volume] + ')'
+            block.append ('    ob[' + str (row) + '*oStride + ' + str (column) + '*oColumnStride] = ' + code + ';')
+        if block:
+            columns.append ('\n'.join (['{'] + block + ['}']))
+
+    valueDefinitions, valueCalls = _getCChunks ('values', values)
+    rowDefinitions, rowCalls = _getCChunks ('rows', rows)
+    columnDefinitions, columnCalls = _getCChunks ('columns', columns)
+    lines.extend (valueDefinitions + rowDefinitions + columnDefinitions)
+    loop = ['    double *w = (double *) malloc (' + str (len (system.assignments) + len (system.reactions) + 1) + '*sizeof (double));',
+            '    long b, i, j;', '    if (w == NULL)', '        return;',
+            '    for (b = 0; b < count; b++) {',
+            '        const double *yb = y + b*yStep;', '        const double *pb = p + b*pStep;']
+
+    lines.append ('void odeprint_rhs(long count, double t, const double *y, long yStep, long yStride,')
+    lines.append ('                  const double *p, long pStep, long pStride, double *dydt, long dStep, long dStride)')
+    lines.append ('{')
+    lines.extend (loop)
+    lines.append ('        double *ob = dydt + b*dStep;')
+    lines.append ('        long oStride = dStride, oColumnStride = 0;')
+    lines.extend (valueCalls + rowCalls)
+    lines.extend (['    }', '    free (w);', '}', ''])
+
+    lines.append ('void odeprint_jacobian(long count, double t, const double *y, long yStep, long yStride,')
+    lines.append ('                       const double *p, long pStep, long pStride, double *jac, long jStep,')
+    lines.append ('                       long jRowStride, long jColumnStride)')
+    lines.append ('{')
+    lines.extend (loop)
+    lines.append ('        double *ob = jac + b*jStep;')
+    lines.append ('        long oStride = jRowStride, oColumnStride = jColumnStride;')
+    lines.append ('        for (i = 0; i < ' + str (n) + '; i++)')
+    lines.append ('            for (j = 0; j < ' + str (n) + '; j++)')
+    lines.append ('                ob[i*oStride + j*oColumnStride] = 0.0;')
+    lines.extend (valueCalls + columnCalls)
+    lines.extend (['    }', '    free (w);', '}', ''])
+    system.cSource = '\n'.join (lines)
+    return system.cSource
+
+def _buildLibrary(source, directory, compiler, flags):
+    # Libraries are named by a hash of everything that goes into them, so an existing
+    # library with the right name can be loaded without compiling
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    key = _hashlib.sha256 (repr ((source, compiler, flags, sys.platform)).encode()).hexdigest()[:24]
+    path = _os.path.join (directory, 'odeprint_' + key + ('.dll' if sys.platform == 'win32' else '.so'))
+    if _os.path.exists (path):
+        return path
+    if shutil.which (compiler) is None:
+        raise RuntimeError('The C compiler ' + compiler + ' was not found, set compiler or the CC environment variable')
+    _os.makedirs (directory, exist_ok=True)
+    workDirectory = tempfile.mkdtemp (dir=directory)
+    try:
+        sourceFile = _os.path.join (workDirectory, 'odeprint.c')
+        with open (sourceFile, 'w') as f:
+            f.write (source)
+        library = _os.path.join (workDirectory, _os.path.basename (path))
+        command = [compiler] + flags + ['-shared', '-fPIC', '-o', library, sourceFile, '-lm']
+        result = subprocess.run (command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError('Compiling the ODEs failed:\n' + result.stderr)
+        # Moved into place in one step so other processes never load a partly written file
+        _os.replace (library, path)
+    finally:
+        shutil.rmtree (workDirectory, ignore_errors=True)
+    return path
+
+def _asBuffer(values, length, name):
+    values = _np.asarray (values, dtype=float)
+    if values.ndim == 0 or values.ndim > 2 or values.shape[0] != length:
+        raise ValueError(name + ' should have shape (' + str (length) + ',) or (' + str (length) + ', k), not ' + str (values.shape))
+    if any (stride % values.itemsize for stride in values.strides):
+        values = _np.ascontiguousarray (values)
+    return values
+
+def _getOutput(out, shape):
+    if out is None:
+        return _np.empty (shape)
+    if out.shape != shape or out.dtype != _np.float64 or not out.flags.writeable or any (stride % 8 for stride in out.strides):
+        raise ValueError('out should be a writeable float64 array of shape ' + str (shape))
+    return out
+
+def _getSteps(values):
+    # Pointer, step between batch items and stride between elements, in doubles
+    step = values.strides[1]//8 if values.ndim == 2 and values.shape[1] > 1 else 0
+    return values.ctypes.data, step, values.strides[0]//8
+
 
 def testme():
     """ Run this method to try out the odePrint function"""
 
     import teUtils as _teUtils
+    import tellurium as _te
 
     r = _te.loada('''
         S9' = 999
@@ -220,6 +1265,7 @@ def testme():
 
 if __name__ == "__main__":
     import teUtils as _teUtils
+    import tellurium as _te
 
     r = _te.loada('''
         S9' = 999
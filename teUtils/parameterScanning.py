@@ -1,10 +1,13 @@
 
-import tellurium as _te
-import matplotlib.pyplot as _plt
 import numpy as _np
+import os as _os
+
+from teUtils import workerPool as _workerPool
+from teUtils import telemetry as _telemetry
 
 def simpleTimeCourseScan(r, parameter, variable, lowRange, highRange, numberOfScans,
-      timeEnd=10, numberOfPoints=100, formatStr='{:10.6f}', legendLoc='upper right'):
+      timeEnd=10, numberOfPoints=100, formatStr='{:10.6f}', legendLoc='upper right',
+      steadyStateTolerance=None, steadyStateWindow=10, cache=None, telemetry=None):
     
     """ Run a time course simulation at different parameter values, observe a single variable
     
@@ -18,11 +21,20 @@ def simpleTimeCourseScan(r, parameter, variable, lowRange, highRange, numberOfSc
       timeEnd (float): Optional: Simulate a time course up to this time
       numberOfPoints: (integer): Optional: Generate this number of points for each time course
       formatStr (string): Optional: The format string for values listed in the plot legend
+      steadyStateTolerance (float): Optional: If set, stop integrating a time course once the norm of the
+          rates of change stays below this value for steadyStateWindow points, the rest is padded with the final values
+      steadyStateWindow (integer): Optional: Number of consecutive points below steadyStateTolerance
+      cache (SimulationCache): Optional: A teUtils.simulationCache.SimulationCache, repeated calls with unchanged
+          inputs are then read from the cache instead of being simulated again
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry that records the time spent in each
+          simulation and in plotting
          
     Return:
       numpy array:
          first column being time
          remaining columns correspond to each parameter scan.
+      If steadyStateTolerance is set a tuple (data, savedTime) is returned where savedTime is a numpy
+      array with the simulated time skipped in each run.
     
     Example:
    
@@ -47,28 +59,392 @@ def simpleTimeCourseScan(r, parameter, variable, lowRange, highRange, numberOfSc
         tu.parameterScanning.simpleTimeCourseScan(r, 'k20', 'S1', 
                 3, 12, 7, timeEnd=6, numberOfPoints=200, formatStr='{:4.1f}')
     """   
-    r[parameter] = lowRange
+    import tellurium as _te
+    import matplotlib.pyplot as _plt
+
     stepSize = (highRange - lowRange)/(numberOfScans-1)
-    for h in range (numberOfScans):
-        r.reset()
-        m = r.simulate (0, timeEnd, numberOfPoints, ["Time", variable])
-        _te.plotArray (m, resetColorCycle=False, label=parameter + ' = ' + formatStr.format (r[parameter]), show=False)
-        r[parameter] = r[parameter] + stepSize
-
-    _plt.ylabel('Concentration (' + variable + ')')
-    _plt.xlabel ('Time')
-    _plt.legend(loc=legendLoc)
-    # A bit of a hack to extract the data out of the plot and construct a
-    # numpy array of time in first column and scans in remaining columns
-    data = _np.empty([numberOfPoints, 0]) # Create an empty array
-    g = _plt.gca()
-    # Collect the time column first
-    xdata = g.lines[0].get_xdata()
-    xdata = xdata.reshape (len (xdata), 1)  # Reshape to make arrays compatible when we use hstack 
-    data = _np.hstack ((data, xdata))
-    # Now collect the y columns
-    for i in range (len (g.lines)):
-        ydata = g.lines[i].get_ydata()
-        ydata = ydata.reshape (len (ydata), 1)  
-        data = _np.hstack (((data, ydata)))
+    key = None
+    result = None
+    if cache is not None:
+       key = cache.getKey (r, 'simpleTimeCourseScan', parameter, variable, lowRange, highRange, numberOfScans,
+             timeEnd, numberOfPoints, steadyStateTolerance, steadyStateWindow, exclude=[parameter])
+       result = cache.get (key)
+
+    recorder = _telemetry.getRecorder (telemetry)
+    if result is None:
+       r[parameter] = lowRange
+       columns = []
+       savedTime = []
+       for h in range (numberOfScans):
+           with recorder.simulation (index=h, value=r[parameter]):
+              if steadyStateTolerance is None:
+                 m = _workerPool.simulateTimeCourse (r, [], [], timeEnd, numberOfPoints, ["Time", variable],
+                       telemetry=telemetry)
+              else:
+                 m, saved = _workerPool.simulateTimeCourseToSteadyState (r, [], [], timeEnd, numberOfPoints, 
+                       ["Time", variable], steadyStateTolerance, steadyStateWindow, telemetry=telemetry)
+                 savedTime.append (saved)
+           columns.append (m[:,1])
+           r[parameter] = r[parameter] + stepSize
+       # Construct a numpy array of time in first column and scans in remaining columns
+       result = (_np.column_stack ([m[:,0]] + columns), _np.array (savedTime))
+       if cache is not None:
+          cache.put (key, result)
+    else:
+       r[parameter] = lowRange + numberOfScans*stepSize
+    data, savedTime = result
+
+    with recorder.phase ('plot'):
+       for h in range (numberOfScans):
+           _te.plotArray (data[:,[0,h+1]], resetColorCycle=False, 
+                 label=parameter + ' = ' + formatStr.format (lowRange + h*stepSize), show=False)
+       _plt.ylabel('Concentration (' + variable + ')')
+       _plt.xlabel ('Time')
+       _plt.legend(loc=legendLoc)
+    if steadyStateTolerance is not None:
+       return data, savedTime
     return data
+
+
+def multiVariableTimeCourseScan(r, parameter, selections, lowRange, highRange, numberOfScans,
+      timeEnd=10, numberOfPoints=100, steadyStateTolerance=None, steadyStateWindow=10, cache=None,
+      telemetry=None):
+
+    """ Run a time course simulation at different parameter values, observe many variables
+
+    All selections are recorded from a single simulation per parameter value, so
+    observing N variables costs the same as observing one.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameter (string): The name of the parameter to change
+      selections (list of strings): The variables to record, these can be species, fluxes,
+          rates of change (eg "S1'") or parameters, eg ['S1', 'S2', 'J1']
+      lowRange (float): The starting value for the parameter
+      highRange (float): The final value for the parameter
+      numberOfScans (integer): The number of values of the parameter to try
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints: (integer): Optional: Generate this number of points for each time course
+      steadyStateTolerance (float): Optional: If set, stop integrating a time course once the norm of the
+          rates of change stays below this value for steadyStateWindow points, the rest is padded with the final values
+      steadyStateWindow (integer): Optional: Number of consecutive points below steadyStateTolerance
+      cache (SimulationCache): Optional: A teUtils.simulationCache.SimulationCache to read and store the results
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry that records the time spent in each simulation
+
+    Return:
+      tuple: (time, values, data, labels)
+         time is a numpy array of the time points, values the parameter values,
+         data a numpy array of shape (numberOfPoints, numberOfScans, len (selections))
+         and labels the names of the selections along the last axis of data.
+         If steadyStateTolerance is set, a numpy array with the simulated time skipped in
+         each run is added as a fifth element.
+
+    Example:
+
+     .. code-block:: python
+
+        time, values, data, labels = tu.parameterScanning.multiVariableTimeCourseScan(r, 'k20',
+                ['S1', 'S2', 'J1'], 3, 12, 7, timeEnd=6, numberOfPoints=200)
+        plt.plot (time, data[:,:,labels.index ('S2')])
+    """
+    if numberOfScans < 1:
+       raise ValueError ('numberOfScans must be at least 1, not ' + str (numberOfScans))
+    selections = list (selections)
+    values = _np.linspace (lowRange, highRange, numberOfScans)
+    if cache is not None:
+       key = cache.getKey (r, 'multiVariableTimeCourseScan', parameter, selections, lowRange, highRange,
+                           numberOfScans, timeEnd, numberOfPoints, steadyStateTolerance, steadyStateWindow,
+                           exclude=[parameter])
+       result = cache.get (key)
+       if result is not None:
+          r[parameter] = values[-1]
+          return result
+
+    data = _np.empty ((numberOfPoints, numberOfScans, len (selections)))
+    savedTime = _np.zeros (numberOfScans)
+    recorder = _telemetry.getRecorder (telemetry)
+    for h, value in enumerate (values):
+       with recorder.simulation (index=h, value=float (value)):
+          if steadyStateTolerance is None:
+             m = _simulateAt (r, parameter, value, timeEnd, numberOfPoints, ['time'] + selections, telemetry)
+          else:
+             m, savedTime[h] = _workerPool.simulateTimeCourseToSteadyState (r, [parameter], [value], timeEnd,
+                   numberOfPoints, ['time'] + selections, steadyStateTolerance, steadyStateWindow,
+                   telemetry=telemetry)
+       data[:, h, :] = m[:, 1:]
+    result = (m[:, 0], values, data, selections)
+    if steadyStateTolerance is not None:
+       result = result + (savedTime,)
+    if cache is not None:
+       cache.put (key, result)
+    return result
+
+
+def _simulateAt(r, parameter, value, timeEnd, numberOfPoints, selections, telemetry=None):
+    return _workerPool.simulateTimeCourse (r, [parameter], [value], timeEnd, numberOfPoints, selections,
+                                           telemetry=telemetry)
+
+
+def timeCourseScanToFile(r, parameter, selections, lowRange, highRange, numberOfScans, directory,
+      timeEnd=10, numberOfPoints=100, shardSize=1000, telemetry=None):
+
+    """ Run a time course simulation at different parameter values and stream each
+    finished simulation to disk. Use this when the scan results are larger than memory.
+
+    Results are written with teUtils.fileUtils.ScanWriter, the returned ScanReader
+    loads slices lazily via memory mapping.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameter (string): The name of the parameter to change
+      selections (list of strings): The names of the variables to record, eg ['time', 'S1', 'S2']
+      lowRange (float): The starting value for the parameter
+      highRange (float): The final value for the parameter
+      numberOfScans (integer): The number of values of the parameter to try
+      directory (string): The directory to write the results into
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints: (integer): Optional: Generate this number of points for each time course
+      shardSize (integer): Optional: Number of simulations stored in each shard file
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry that records the time spent in each
+          simulation and in writing the results
+
+    Return:
+      ScanReader: reader for the results stored in directory
+
+    Example:
+
+     .. code-block:: python
+
+        results = tu.parameterScanning.timeCourseScanToFile(r, 'k20', ['time', 'S1'],
+                3, 12, 100000, 'scanResults', timeEnd=6, numberOfPoints=1000)
+        print (results.parameterValues[:10])
+        s1 = results.getSelection ('S1', slice (0, 100))
+    """
+    from teUtils.fileUtils import ScanWriter, ScanReader
+
+    recorder = _telemetry.getRecorder (telemetry)
+    with ScanWriter (directory, selections, [parameter], numberOfPoints, shardSize=shardSize) as writer:
+       for index, value in enumerate (_np.linspace (lowRange, highRange, numberOfScans)):
+          with recorder.simulation (index=index, value=float (value)):
+             m = _simulateAt (r, parameter, value, timeEnd, numberOfPoints, selections, telemetry)
+             with recorder.phase ('write'):
+                writer.append ([value], m)
+    return ScanReader (directory)
+
+
+def _simulateParameterChunk(r, parameters, valueSets, timeEnd, numberOfPoints, selections, firstIndex=0,
+      telemetry=None):
+    recorder = _telemetry.getRecorder (telemetry)
+    results = []
+    for index, values in enumerate (valueSets):
+       with recorder.simulation (index=firstIndex + index):
+          results.append (_workerPool.simulateTimeCourse (r, parameters, values, timeEnd, numberOfPoints, selections,
+                                                          telemetry=telemetry))
+    return _np.array (results)
+
+
+def simulateParameterSets(r, parameters, valueSets, selections, timeEnd=10, numberOfPoints=100,
+      maxWorkers=None, executor=None, chunkSize=None, pool=None, telemetry=None):
+
+    """ Run one time course simulation for each row of a table of parameter values, in parallel.
+
+    This is the batch engine used by the sensitivity analysis functions. The rows are split
+    into chunks that are simulated on a teUtils.workerPool.ModelPool, so the model is compiled
+    once and not for every simulation.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The names of the parameters to set
+      valueSets (numpy array): Array of shape (number of sets, len (parameters)), one row per simulation
+      selections (list of strings): The variables to record, eg ['time', 'S1']
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints: (integer): Optional: Generate this number of points for each time course
+      maxWorkers (integer): Optional: Number of worker processes, use 1 to simulate in this process
+      executor (concurrent.futures.Executor): Optional: Executor to run the simulations on instead of a new process pool
+      chunkSize (integer): Optional: Number of simulations sent to a worker at a time
+      pool (ModelPool): Optional: An existing pool for this model, reusing a pool avoids starting new workers
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry, the workers record their simulations
+          and the records are merged into it as the chunks finish
+
+    Return:
+      numpy array: of shape (number of sets, numberOfPoints, len (selections))
+
+    Example:
+
+     .. code-block:: python
+
+        values = np.random.uniform (0.5, 2, size=(1000, 2))
+        data = tu.parameterScanning.simulateParameterSets (r, ['k10', 'k20'], values, ['time', 'S1'])
+    """
+    valueSets = _np.atleast_2d (valueSets)
+    if maxWorkers == 1 and executor is None and pool is None:
+       return _simulateParameterChunk (r, parameters, valueSets, timeEnd, numberOfPoints, selections,
+                                       telemetry=telemetry).reshape (len (valueSets), numberOfPoints, len (selections))
+
+    ownPool = pool is None
+    if ownPool:
+       pool = _workerPool.ModelPool (r, maxWorkers=maxWorkers, executor=executor)
+    if chunkSize is None:
+       workers = maxWorkers or _os.cpu_count() or 1
+       chunkSize = max (1, int (_np.ceil (len (valueSets)/(4*workers))))
+    starts = range (0, len (valueSets), chunkSize)
+    try:
+       if telemetry is None:
+          return _np.concatenate (pool.map (_simulateParameterChunk,
+                                            [(parameters, valueSets[i:i + chunkSize], timeEnd, numberOfPoints,
+                                              selections) for i in starts]))
+       futures = [pool.submit (_telemetry.runRecorded, _simulateParameterChunk, parameters, valueSets[i:i + chunkSize],
+                               timeEnd, numberOfPoints, selections, i) for i in starts]
+       results = []
+       for i, future in zip (starts, futures):
+          try:
+             result, records = future.result()
+          except Exception as error:
+             telemetry.recordFailure (error, index=i)
+             raise
+          telemetry.merge (records)
+          results.append (result)
+       return _np.concatenate (results)
+    finally:
+       if ownPool:
+          pool.shutdown()
+
+
+async def asyncTimeCourseScan(r, parameter, selections, lowRange, highRange, numberOfScans,
+      timeEnd=10, numberOfPoints=100, executor=None, maxWorkers=None, maxPending=None, pool=None):
+
+    """ Asynchronous time course parameter scan for use inside an asyncio event loop.
+
+    The simulations are handed to an executor so the event loop is never blocked. Results
+    are yielded as they complete, which is not necessarily in parameter order. At most
+    maxPending simulations are in flight at any time and new simulations are only
+    submitted as the caller consumes results. Cancelling the consuming task, or leaving
+    the async for loop early, cancels the simulations that have not started yet.
+
+    The simulations run on a teUtils.workerPool.ModelPool so the model is not recompiled.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameter (string): The name of the parameter to change
+      selections (list of strings): The names of the variables to record, eg ['time', 'S1']
+      lowRange (float): The starting value for the parameter
+      highRange (float): The final value for the parameter
+      numberOfScans (integer): The number of values of the parameter to try
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints: (integer): Optional: Generate this number of points for each time course
+      executor (concurrent.futures.Executor): Optional: Executor to run the simulations on. Pass a
+          shared executor to run many concurrent scans. By default a process pool is created for this scan.
+      maxWorkers (integer): Optional: Number of processes used when the executor is created by this call
+      maxPending (integer): Optional: Maximum number of simulations in flight, default is twice the number of workers
+      pool (ModelPool): Optional: An existing pool for this model to run the simulations on
+
+    Yields:
+      tuple: (index, parameter value, numpy array of the selections)
+
+    Example:
+
+     .. code-block:: python
+
+        async def runScan (r):
+            async for index, value, m in tu.parameterScanning.asyncTimeCourseScan (
+                    r, 'k20', ['time', 'S1'], 3, 12, 50):
+                print (index, value, m[-1])
+    """
+    import asyncio
+
+    ownPool = pool is None
+    if ownPool:
+       pool = _workerPool.ModelPool (r, maxWorkers=maxWorkers, executor=executor)
+    if maxPending is None:
+       maxPending = 2*(maxWorkers or _os.cpu_count() or 1)
+
+    values = iter (enumerate (_np.linspace (lowRange, highRange, numberOfScans)))
+    pending = {}
+    try:
+       while True:
+          for index, value in values:
+             future = asyncio.wrap_future (pool.submit (_simulateAt, parameter, value, timeEnd,
+                                                        numberOfPoints, selections))
+             pending[future] = (index, value)
+             if len (pending) >= maxPending:
+                break
+          if not pending:
+             break
+          done, _ = await asyncio.wait (pending, return_when=asyncio.FIRST_COMPLETED)
+          for future in done:
+             index, value = pending.pop (future)
+             yield index, value, future.result()
+    finally:
+       for future in pending:
+          future.cancel()
+       if ownPool:
+          pool.shutdown (wait=False)
+
+
+def adaptiveTimeCourseScan(r, parameter, variable, lowRange, highRange, initialScans=5, tolerance=0.1,
+      maxScans=50, timeEnd=10, numberOfPoints=100):
+
+    """ Time course parameter scan that places the parameter values where the output changes most.
+
+    The scan starts with initialScans evenly spaced values. Neighbouring values whose
+    time courses differ by more than tolerance (the largest absolute difference over the time
+    course) are split by simulating the midpoint, largest difference first, until every pair of
+    neighbours is within tolerance or maxScans simulations have been run. Sharp transitions
+    such as switches are resolved with far fewer simulations than a uniform scan.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameter (string): The name of the parameter to change
+      variable (string): The name of the variable to record during the scan
+      lowRange (float): The starting value for the parameter
+      highRange (float): The final value for the parameter
+      initialScans (integer): Optional: The number of evenly spaced values to start with
+      tolerance (float): Optional: Largest allowed difference between neighbouring time courses
+      maxScans (integer): Optional: The maximum number of simulations to run
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints: (integer): Optional: Generate this number of points for each time course
+
+    Return:
+      tuple: (values, data)
+         values is a numpy array of the sorted parameter values that were simulated,
+         data is a numpy array with time in the first column and the remaining
+         columns corresponding to each value.
+
+    Example:
+
+     .. code-block:: python
+
+        values, data = tu.parameterScanning.adaptiveTimeCourseScan(r, 'k20', 'S1',
+                3, 12, tolerance=0.05, maxScans=40)
+    """
+    import heapq
+
+    results = {}
+    def simulate(value):
+       results[value] = _simulateAt (r, parameter, value, timeEnd, numberOfPoints, ['time', variable])
+
+    def difference(low, high):
+       return _np.max (_np.abs (results[high][:, 1] - results[low][:, 1]))
+
+    values = _np.linspace (lowRange, highRange, max (initialScans, 2))
+    for value in values:
+       simulate (value)
+    # Heap of neighbouring intervals, largest difference first
+    intervals = [(-difference (low, high), low, high) for low, high in zip (values[:-1], values[1:])]
+    heapq.heapify (intervals)
+    minWidth = abs (highRange - lowRange)*1E-9
+    while intervals and len (results) < maxScans:
+       diff, low, high = heapq.heappop (intervals)
+       if -diff <= tolerance:
+          break
+       if high - low <= minWidth:
+          continue
+       middle = (low + high)/2
+       simulate (middle)
+       heapq.heappush (intervals, (-difference (low, middle), low, middle))
+       heapq.heappush (intervals, (-difference (middle, high), middle, high))
+
+    values = _np.array (sorted (results))
+    time = results[values[0]][:, 0]
+    data = _np.column_stack ([time] + [results[value][:, 1] for value in values])
+    return values, data
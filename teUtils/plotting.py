@@ -8,12 +8,13 @@
 # Plotting Utilities
 # ---------------------------------------------------------------------
 
-import tellurium as _te
-
-from mpl_toolkits.mplot3d import Axes3D as _Axes3D
 import numpy as _np
 import matplotlib.pyplot as _plt 
-import random
+
+from teUtils import workerPool as _workerPool
+from teUtils import telemetry as _telemetry
+from teUtils import controlAnalysis as _controlAnalysis
+from teUtils import monitor as _monitor
 
 def plotAsciiConcentrationsBar (r, scale=5):
     '''
@@ -27,14 +28,8 @@ def plotAsciiConcentrationsBar (r, scale=5):
        >>> teUtils.plotting.plotAsciiConcentrationsBar (r, scale=20)
     '''
     
-    import math
-    c = r.getFloatingSpeciesConcentrations()
-    ids = r.getFloatingSpeciesIds()
-
-    maxString = len (max(ids, key=len))
-
-    for value in range (len (c)):
-        print ('{:{X}.{Y}}'.format (ids[value], X=maxString, Y=maxString), ':', math.trunc (scale*c[value])*'*')
+    for line in _monitor._asciiBarLines (r.getFloatingSpeciesIds(), r.getFloatingSpeciesConcentrations(), scale):
+        print (line)
 
 
 def plotAsciiReactionRatesBar (r, scale=5):
@@ -49,20 +44,30 @@ def plotAsciiReactionRatesBar (r, scale=5):
        >>> teUtils.plotting.plotAsciiReactionRatesBar (r, scale=20)
     '''
 
-    import math
-    c = r.getReactionRates()
-    ids = r.getReactionIds()
+    for line in _monitor._asciiBarLines (r.getReactionIds(), r.getReactionRates(), scale):
+        print (line)
 
-    maxString = len (max(ids, key=len))
 
-    for value in range (len (c)):
-        print ('{:{X}.{Y}}'.format (ids[value], X=maxString, Y=maxString), ':', math.trunc (scale*c[value])*'*')
+# Below this number of cells plotRandSimGrid simulates in this process by default, starting
+# worker processes and compiling the model in each costs more than it saves
+_minPoolSimulations = 100
 
+def _simulateCell (r, simulate, index, *args, telemetry=None):
+    with _telemetry.getRecorder (telemetry).simulation (index=index):
+       return simulate (r, *args, telemetry=telemetry)
 
-def plotRandSimGrid  (r, species=[], pdfExport=None, figsize=(11,8), maxRange=10, endTime=200, numPoints=500, ngrid=20):
+def plotRandSimGrid  (r, species=[], pdfExport=None, figsize=(11,8), maxRange=10, endTime=200, numPoints=500, ngrid=20, pool=None,
+                      steadyStateTolerance=None, steadyStateWindow=10, randomSeed=None, cache=None, telemetry=None, maxWorkers=None):
     '''
     Plots a grid of simulations, each simulation is based on the same model
     but randomly drawn parameter values. 
+
+    Grids of 100 cells or more run in parallel on a teUtils.workerPool.ModelPool. Smaller
+    grids are simulated in this process unless maxWorkers or pool is given, since starting the
+    worker processes would take longer than the simulations. Each cell draws its parameter
+    values from its own random stream derived from randomSeed, so a cell gets the same values
+    however the simulations are scheduled. The curves of each cell are drawn as a single
+    LineCollection on the axes created by subplots.
     
     Args:
         r : roadrunner instance
@@ -72,55 +77,136 @@ def plotRandSimGrid  (r, species=[], pdfExport=None, figsize=(11,8), maxRange=10
         ngrid : (integer) optional: the size of the grid, default is 20 x 20 plots
         maxRange: (double) optional: upper range for randomly drawn parameter values
         pdfExport : (string) optional parameter, indicates the filename to export the plot as a pdf file
+        pool : (ModelPool) optional: run the simulations on an existing teUtils.workerPool.ModelPool created for r
+        steadyStateTolerance : (double) optional: if set, stop each simulation once the norm of the rates of change
+                    stays below this value for steadyStateWindow points and pad the rest with the final values
+        steadyStateWindow : (integer) optional: number of consecutive points below steadyStateTolerance
+        randomSeed : (integer) optional: seed for the randomly drawn parameter values, makes the grid repeatable
+        cache : (SimulationCache) optional: a teUtils.simulationCache.SimulationCache, used when randomSeed is set
+                    so that redrawing the same grid does not simulate again
+        telemetry : (Telemetry) optional: a teUtils.telemetry.Telemetry that records the time spent in each
+                    simulation and in laying out, drawing and exporting the grid
+        maxWorkers : (integer) optional: number of worker processes when no pool is given, use 1 to simulate in this process.
+                    The default is the number of cpus for grids of 100 cells or more, otherwise 1
+
+    Returns:
+        If steadyStateTolerance is set, a (ngrid x ngrid) numpy array with the simulated time skipped in each cell
 
     Example:
-      >>> teUtils.plotting.plotPhasePortraitGrid (r)
+      >>> teUtils.plotting.plotRandSimGrid (r, ngrid=10, randomSeed=42)
     '''
+    from matplotlib.collections import LineCollection
+
     print ("Starting....")
-    slist = sorted (r.getFloatingSpeciesIds())
     if species == []:
-       n = r.getNumFloatingSpecies()
+       slist = sorted (r.getFloatingSpeciesIds())
     else:
-       slist = species
-       n = len (species) + 1
+       slist = list (species)
     slist = ['time'] + slist
-    print ('Creating subplots (will take a while for a large grid)...')
-    fig, axarr = _plt.subplots(ngrid, ngrid, figsize=figsize)
-    print ("Adjust subplots...")
-    fig.subplots_adjust (wspace=0.15, hspace=0.15)
+    recorder = _telemetry.getRecorder (telemetry)
+    print ('Creating subplots...')
+    with recorder.phase ('layout'):
+       fig, axarr = _plt.subplots(ngrid, ngrid, figsize=figsize, squeeze=False)
+       fig.subplots_adjust (wspace=0.15, hspace=0.15)
 
     print ("Run simulations and populate grid....")
-    count = 0
-    for i in range(ngrid):
-        for j in range(ngrid):
-            r.reset()
-            for k in r.getGlobalParameterIds():
-                r[k] = random.random()*maxRange
-             
-            m = r.simulate (0, endTime, numPoints, slist)
-            count += 1
-            ax = _plt.subplot2grid ((ngrid,ngrid), (i,j))
-            if i==n-1:
-               ax.set_xlabel ('Time') 
-               ax.set_xticklabels([])
-            else:
-               ax.set_xticklabels([])
-               ax.set_xticks([])
-            if j == 0:
-            
-               ax.set_yticklabels([])
-            else:
-               ax.set_yticks([])
-
-            for k in range (n-1):
-                ax.plot (m[:,0],m[:,k+1])
+    parameterIds = r.getGlobalParameterIds()
+    key = None
+    results = None
+    if cache is not None and randomSeed is not None:
+       key = cache.getKey (r, 'plotRandSimGrid', slist, maxRange, endTime, numPoints, ngrid, randomSeed,
+             steadyStateTolerance, steadyStateWindow, exclude=parameterIds)
+       results = cache.get (key)
+    if results is None:
+       seeds = _np.random.SeedSequence (randomSeed).spawn (ngrid*ngrid)
+       tasks = [(parameterIds, list (_np.random.default_rng (seed).random (len (parameterIds))*maxRange),
+                 endTime, numPoints, slist) for seed in seeds]
+       simulate = _workerPool.simulateTimeCourse
+       if steadyStateTolerance is not None:
+          simulate = _workerPool.simulateTimeCourseToSteadyState
+          tasks = [task + (steadyStateTolerance, steadyStateWindow) for task in tasks]
+       if maxWorkers is None and len (tasks) < _minPoolSimulations:
+          maxWorkers = 1
+       ownPool = pool is None and maxWorkers != 1
+       if ownPool:
+          pool = _workerPool.ModelPool (r, maxWorkers=maxWorkers)
+       try:
+          if pool is None:
+             results = [_simulateCell (r, simulate, index, *task, telemetry=telemetry) for index, task in enumerate (tasks)]
+          elif telemetry is None:
+             results = pool.map (simulate, tasks)
+          else:
+             results = []
+             for result, records in pool.map (_telemetry.runRecorded, [(_simulateCell, simulate, index) + task
+                                                                       for index, task in enumerate (tasks)]):
+                 telemetry.merge (records)
+                 results.append (result)
+       finally:
+          if ownPool:
+             pool.shutdown()
+       if key is not None:
+          cache.put (key, results)
+    if steadyStateTolerance is not None:
+       savedTime = _np.array ([result[1] for result in results]).reshape (ngrid, ngrid)
+       results = [result[0] for result in results]
+
+    with recorder.phase ('plot'):
+       colors = _plt.rcParams['axes.prop_cycle'].by_key()['color']
+       for count, m in enumerate (results):
+           i, j = divmod (count, ngrid)
+           ax = axarr[i, j]
+           # tick_params is much cheaper than setting empty tick labels on every axis
+           ax.tick_params (labelbottom=False, labelleft=False, bottom=(i == ngrid-1), left=(j == 0))
+           if i == ngrid-1:
+              ax.set_xlabel ('Time') 
+           # One collection per cell holding a curve for every species
+           segments = _np.stack ([_np.broadcast_to (m[:,[0]], m[:,1:].shape), m[:,1:]], axis=-1).transpose (1, 0, 2)
+           ax.add_collection (LineCollection (segments, colors=colors, linewidths=1))
+           ax.autoscale_view()
                 
     if pdfExport != None:
-        fig.savefig(pdfExport)                
-
-def plotPhasePortraitGrid  (r, pdfExport=None, figsize=(11,8), endTime=200, numPoints=500):
+        with recorder.phase ('savefig'):
+           fig.savefig(pdfExport)                
+    if steadyStateTolerance is not None:
+       return savedTime
+
+def _phasePortraitCells (n, uniquePairs, rows=None):
+    # The (row, column) cells to draw, the lower triangle only holds each pair of species once
+    rows = _phasePortraitRows (n, uniquePairs) if rows is None else rows
+    return [(i, j) for i in rows for j in range (n) if not uniquePairs or j < i]
+
+def _phasePortraitRows (n, uniquePairs):
+    # The lower triangle has no cells in the first row or the last column, so its grid is (n-1) x (n-1)
+    # and cell (i, j) is placed at [i-1, j]
+    return range (1, n) if uniquePairs else range (n)
+
+def _renderPhasePortraitTile (m, rows, n, cellPixels, uniquePairs):
+    # Runs in a worker process, renders a band of rows with the Agg backend and returns the RGBA pixels
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    dpi = 100
+    columns = n - 1 if uniquePairs else n
+    fig = Figure (figsize=(columns*cellPixels/dpi, len (rows)*cellPixels/dpi), dpi=dpi)
+    canvas = FigureCanvasAgg (fig)
+    for i, j in _phasePortraitCells (n, uniquePairs, rows):
+        ax = fig.add_axes ([j/columns, 1 - (i - rows[0] + 1)/len (rows), 1/columns, 1/len (rows)])
+        ax.plot (m[:,j], m[:,i], linewidth=0.8)
+        ax.set_xticks ([])
+        ax.set_yticks ([])
+    canvas.draw()
+    return _np.asarray (canvas.buffer_rgba()).copy()
+
+def plotPhasePortraitGrid  (r, pdfExport=None, figsize=(11,8), endTime=200, numPoints=500, uniquePairs=False,
+                            rasterized=None, renderToImage=False, maxWorkers=None, cellPixels=60):
     '''
     Plots a grid of phase portraits of the floating species concentrations.
+
+    For models with many species use uniquePairs=True, which draws each pair of species once
+    (the lower triangle) on an (n-1) x (n-1) grid and does not create axes for the rest of it. Dense trajectories
+    are rasterized so that exported PDF files stay small. With renderToImage=True the grid is
+    rendered in bands of rows with the Agg backend in worker processes and the bands are tiled
+    into one image, which is then shown in a single axis.
     
     Args:
         r : roadrunner instance
@@ -128,113 +214,229 @@ def plotPhasePortraitGrid  (r, pdfExport=None, figsize=(11,8), endTime=200, numP
         endtime : (double) optional: time to simulate to
         numPoints: (double) optional: numberof points to generate for the plot
         pdfExport : (string) optional parameter, indicates the filename to export the plot as a pdf file
+        uniquePairs : (boolean) optional: only draw the lower triangle of the grid
+        rasterized : (boolean) optional: rasterize the trajectories, by default done when numPoints is 1000 or more
+        renderToImage : (boolean) optional: render the grid as an image in worker processes
+        maxWorkers : (integer) optional: number of worker processes used by renderToImage, default is the number of cpus
+        cellPixels : (integer) optional: size in pixels of each cell when renderToImage is set
+
+    Returns:
+        If renderToImage is set, the RGBA image of the grid as a numpy array
 
     Example:
       >>> teUtils.plotting.plotPhasePortraitGrid (r)
+      >>> teUtils.plotting.plotPhasePortraitGrid (r, uniquePairs=True, renderToImage=True)
     '''
     print ("Starting....")
     slist = sorted (r.getFloatingSpeciesIds())
     r.reset()
     print ('Run simulation...')
     m = r.simulate (0, endTime, numPoints, slist)
-    n = r.getNumFloatingSpecies()
-    print ('Creating subplots (will take a while for a large grid)...')
-    fig, axarr = _plt.subplots(n, n, figsize=figsize)
-    print ("Adjust subplots...")
-    fig.subplots_adjust (wspace=0.15, hspace=0.15)
-
-    count = 0
-    for i in range(n):
-        for j in range(n):
-            count += 1
-            ax = _plt.subplot2grid ((n,n), (i,j))
-            if i==n-1:
-               ax.set_xlabel (slist[j]) 
-               ax.set_xticklabels([])
-            else:
-               ax.set_xticklabels([])
-               ax.set_xticks([])
-            if j == 0:
-               ax.set_ylabel (slist[i])              
-               ax.set_yticklabels([])
-            else:
-               ax.set_yticklabels([])
-               ax.set_yticks([])
-
-            ax.plot (m[:,i], m[:,j])
+    n = len (slist)
+    if uniquePairs and n < 2:
+       raise ValueError ('uniquePairs needs a model with at least two floating species')
+    rows = _phasePortraitRows (n, uniquePairs)
+    xlist = slist[:-1] if uniquePairs else slist
+    if rasterized is None:
+       rasterized = numPoints >= 1000
+
+    if renderToImage:
+       import concurrent.futures
+       import os
+       workers = min (maxWorkers or os.cpu_count() or 1, len (rows))
+       bands = [list (band) for band in _np.array_split (rows, workers) if len (band) > 0]
+       m = _np.array (m)
+       print ('Render tiles...')
+       with concurrent.futures.ProcessPoolExecutor (workers) as executor:
+          tiles = list (executor.map (_renderPhasePortraitTile, [m]*len (bands), bands, [n]*len (bands),
+                                      [cellPixels]*len (bands), [uniquePairs]*len (bands)))
+       image = _np.concatenate (tiles, axis=0)
+       fig, ax = _plt.subplots (figsize=figsize)
+       ax.imshow (image, interpolation='nearest')
+       centers = (_np.arange (len (rows)) + 0.5)*cellPixels
+       ax.set_xticks (centers)
+       ax.set_xticklabels (xlist, rotation=90)
+       ax.set_yticks (centers)
+       ax.set_yticklabels ([slist[i] for i in rows])
+       if pdfExport != None:
+           fig.savefig(pdfExport)
+       return image
+
+    print ('Creating subplots...')
+    fig = _plt.figure (figsize=figsize)
+    grid = fig.add_gridspec (len (rows), len (xlist), wspace=0.15, hspace=0.15)
+    for i, j in _phasePortraitCells (n, uniquePairs):
+        ax = fig.add_subplot (grid[i - rows[0], j])
+        # tick_params is much cheaper than setting empty tick labels on every axis
+        ax.tick_params (labelbottom=False, labelleft=False, bottom=(i == n-1), left=(j == 0))
+        if i==n-1:
+           ax.set_xlabel (slist[j]) 
+        if j == 0:
+           ax.set_ylabel (slist[i])              
+        ax.plot (m[:,j], m[:,i], rasterized=rasterized)
 
     if pdfExport != None:
         fig.savefig(pdfExport)
         
-def plotConcentrationControlHeatMap (r, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1):
+def _getControlAnalysis (r):
+    # The control plots accept either a roadrunner instance or a ControlAnalysis
+    if isinstance (r, _controlAnalysis.ControlAnalysis):
+       return r
+    return _controlAnalysis.ControlAnalysis (r)
+
+def _clusterOrder (values):
+    # Leaf order of an average linkage hierarchical clustering of the rows
+    from scipy.cluster import hierarchy
+    if len (values) < 3:
+       return _np.arange (len (values))
+    return hierarchy.leaves_list (hierarchy.linkage (_np.nan_to_num (values), method='average', optimal_ordering=True))
+
+def _drawHeatMap (df, ax, annotations, vmin, vmax, cluster=False, maxAnnotatedCells=400, rasterThreshold=10000):
+    # Small matrices use the seaborn heat map. Above rasterThreshold cells the matrix is drawn as a single
+    # image, which stays fast for thousands of rows and columns, with tick labels that follow the zoom.
+    if cluster:
+       df = df.iloc[_clusterOrder (df.values), _clusterOrder (df.values.T)]
+    if df.size <= rasterThreshold:
+       import seaborn as sns
+       annotate = annotations and df.size <= maxAnnotatedCells
+       sns.heatmap(df, annot=annotate, fmt="5.2f", linewidths=.5 if annotate else 0, vmin=vmin, vmax=vmax, ax=ax, cmap='bwr')
+       return df
+
+    from matplotlib.ticker import FuncFormatter, MaxNLocator
+    image = ax.imshow (df.values, cmap='bwr', vmin=vmin, vmax=vmax, aspect='auto', interpolation='nearest')
+    ax.figure.colorbar (image, ax=ax)
+    for axis, labels in [(ax.xaxis, list (df.columns)), (ax.yaxis, list (df.index))]:
+        axis.set_major_locator (MaxNLocator (nbins=min (len (labels), 40), integer=True))
+        axis.set_major_formatter (FuncFormatter (
+              lambda value, position, labels=labels: str (labels[int (value)]) if 0 <= value < len (labels) else ''))
+    return df
+
+def plotConcentrationControlHeatMap (r, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1,
+                                     cluster=False, maxAnnotatedCells=400, rasterThreshold=10000):
     '''
     Display the concentation control coefficients as a heat map
     
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         pdfExport : (string) optional: indicates the filename to export the heat map image to in the form of pdf
         annotations (boolean) optional : used to draw values on teh heatmap cells
         figsize : (tutle of double) optional: sets the size of the plot, eg figsize=(10,5)
         vmin : (double) optional: set the lower limit for the range
         vmac : (double) optional: set the upper limit for the range
+        cluster : (boolean) optional: reorder rows and columns by hierarchical clustering so similar ones are adjacent
+        maxAnnotatedCells : (integer) optional: values are only drawn on the cells of matrices up to this size
+        rasterThreshold : (integer) optional: matrices with more cells are drawn as a single image
 
     Example:
       >>> teUtils.plotting.plotConcentrationControlHeatMap (r, pdfExport='heapmap.pdf')
     '''
 
-    import seaborn as sns
     import pandas as pd
-    hist = r.getScaledConcentrationControlCoefficientMatrix()
+    ca = _getControlAnalysis (r)
+    hist = ca.concentrationControl
 
-    ss = r.getFloatingSpeciesIds()
-    rr = ["E" + str(x) for x in range (r.getNumReactions())]
+    ss = ca.speciesIds
+    rr = ["E" + str(x) for x in range (len (ca.reactionIds))]
 
     df = pd.DataFrame (hist, columns=rr, index=ss)
 
     f, ax = _plt.subplots(figsize=figsize)
-    hp = sns.heatmap(df, annot=annotations, fmt="5.2f", linewidths=.5, ax=ax,cmap='bwr', vmin=vmin, vmax=vmax)
+    _drawHeatMap (df, ax, annotations, vmin, vmax, cluster, maxAnnotatedCells, rasterThreshold)
     if pdfExport != None:
         f.savefig(pdfExport)
 
     
-def plotFluxControlHeatMap (r, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1):
+def plotFluxControlHeatMap (r, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1,
+                            cluster=False, maxAnnotatedCells=400, rasterThreshold=10000):
     '''
     Display the flux control coefficients as a heat map
     
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         pdfExport : (string) optional parameter, if present it should indicate the filename to export the heat map image to in the form of pdf
         annotations : (boolean) used to draw values on teh heatmap cells
         figsize : (tuple of double) sets the size of the plot, eg figsize=(10,5)
         vmin : (double) set the lower limit for the range
         vmax : (double) set the upper limit for the range
+        cluster : (boolean) optional: reorder rows and columns by hierarchical clustering so similar ones are adjacent
+        maxAnnotatedCells : (integer) optional: values are only drawn on the cells of matrices up to this size
+        rasterThreshold : (integer) optional: matrices with more cells are drawn as a single image
 
     Example:
        >>> teUtils.plotting.plotFluxControlHeatMap (r, pdfExport='heapmap.pdf')
     '''
 
-    import seaborn as sns
     import pandas as pd
     
-    hist = r.getScaledFluxControlCoefficientMatrix()
-    ss = r.getReactionIds()
-    rr = ["E" + str(x) for x in range (r.getNumReactions())]
+    ca = _getControlAnalysis (r)
+    hist = ca.fluxControl
+    ss = ca.fluxIds
+    rr = ["E" + str(x) for x in range (len (ca.reactionIds))]
 
     df = pd.DataFrame (hist, columns=rr, index=ss)
 
     f, ax = _plt.subplots(figsize=figsize)
-    hp = sns.heatmap(df, annot=annotations, fmt="5.2f", linewidths=.5, vmin=vmin, vmax=vmax, ax=ax, cmap='bwr')
+    _drawHeatMap (df, ax, annotations, vmin, vmax, cluster, maxAnnotatedCells, rasterThreshold)
 
     if pdfExport != None:
         f.savefig(pdfExport)
         
+
+def plotControlCoefficientSummary (result, kind='flux', pdfExport=None, annotations=True, figsize=(16,7), vmin=-1, vmax=1,
+                                   cluster=False, maxAnnotatedCells=400, rasterThreshold=10000):
+    '''
+    Display the mean and the standard deviation of control coefficients computed for many parameter sets
+    as two heat maps. Sets without a steady state are left out.
+    
+    Args:
+        result : (dictionary) the result of teUtils.controlAnalysis.batchControlCoefficients
+        kind : (string) optional: 'flux' or 'concentration'
+        pdfExport : (string) optional parameter, indicates the filename to export the plot as a pdf file
+        annotations : (boolean) used to draw values on the heatmap cells
+        figsize : (tuple of double) sets the size of the plot, eg figsize=(10,5)
+        vmin : (double) set the lower limit for the range of the mean
+        vmax : (double) set the upper limit for the range of the mean
+        cluster : (boolean) optional: reorder rows and columns of the mean by hierarchical clustering, the
+                    standard deviation uses the same order
+        maxAnnotatedCells : (integer) optional: values are only drawn on the cells of matrices up to this size
+        rasterThreshold : (integer) optional: matrices with more cells are drawn as a single image
+
+    Returns:
+        The figure
+
+    Example:
+       >>> result = teUtils.controlAnalysis.batchControlCoefficients (r, ['k1', 'k2'], values)
+       >>> teUtils.plotting.plotControlCoefficientSummary (result, kind='concentration')
+    '''
+    import pandas as pd
+
+    if kind == 'flux':
+       data, rows = result['fluxControl'], result['fluxIds']
+    elif kind == 'concentration':
+       data, rows = result['concentrationControl'], result['speciesIds']
+    else:
+       raise ValueError ("kind must be 'flux' or 'concentration'")
+    data = data[result['converged']]
+    columns = result['reactionIds']
+    mean = pd.DataFrame (_np.mean (data, axis=0), index=rows, columns=columns)
+    std = pd.DataFrame (_np.std (data, axis=0), index=rows, columns=columns)
+
+    fig, (meanAx, stdAx) = _plt.subplots (1, 2, figsize=figsize)
+    mean = _drawHeatMap (mean, meanAx, annotations, vmin, vmax, cluster, maxAnnotatedCells, rasterThreshold)
+    std = std.loc[mean.index, mean.columns]
+    _drawHeatMap (std, stdAx, annotations, 0, None, False, maxAnnotatedCells, rasterThreshold)
+    meanAx.set_title ('Mean (' + str (len (data)) + ' sets)')
+    stdAx.set_title ('Standard deviation')
+    if pdfExport != None:
+        fig.savefig(pdfExport)
+    return fig
        
 def plotFluxControlBar (r, reactionId, figsize=(13,7)):
     '''
     Plots a graph bar graph of the flux control coefficients
     
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         reactionid (string) reactionId for the flux control 
         figsize : (tuple of float) optional width and heigh of plot in inches
 
@@ -243,9 +445,10 @@ def plotFluxControlBar (r, reactionId, figsize=(13,7)):
     '''
     import matplotlib.pyplot as plt
     
-    cc = r.getScaledFluxControlCoefficientMatrix()
-    rIds = r.getReactionIds()
-    index = rIds.index (reactionId)
+    ca = _getControlAnalysis (r)
+    cc = ca.fluxControl
+    rIds = ca.reactionIds
+    index = ca.fluxIds.index (reactionId)
     row = cc[index,:]
     
     _plt.figure(figsize=figsize)    
@@ -258,7 +461,7 @@ def plotConcentrationControlBar (r, speciesId, figsize=(13,7)):
     Plots a graph bar graph of the concentration control coefficients
     
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         speciesid : (string) speciesId for the concentration control 
         figsize : (tuple of float) optional: width and heigh of plot in inches
 
@@ -268,9 +471,10 @@ def plotConcentrationControlBar (r, speciesId, figsize=(13,7)):
     import matplotlib.pyplot as plt
     
 
-    cc = r.getScaledConcentrationControlCoefficientMatrix()
-    spIds = r.getFloatingSpeciesIds()
-    rIds = r.getReactionIds()
+    ca = _getControlAnalysis (r)
+    cc = ca.concentrationControl
+    spIds = ca.speciesIds
+    rIds = ca.reactionIds
     index = spIds.index (speciesId)
     row = cc[index,:]
     print (row)
@@ -282,7 +486,8 @@ def plotConcentrationControlBar (r, speciesId, figsize=(13,7)):
     _plt.legend()
 
 
-def plotArrayHeatMap (data, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1):
+def plotArrayHeatMap (data, pdfExport=None, annotations=True, figsize=(13,7), vmin=-1, vmax=1,
+                      cluster=False, maxAnnotatedCells=400, rasterThreshold=10000):
     '''
     Display the flux control coefficients as a heat map
     
@@ -293,12 +498,14 @@ def plotArrayHeatMap (data, pdfExport=None, annotations=True, figsize=(13,7), vm
         figsize : (tuple) sets the size of the plot, eg figsize=(10,5)
         vmin : (double) set the lower limit for the range
         vmax : (double) set the upper limit for the range
+        cluster : (boolean) optional: reorder rows and columns by hierarchical clustering so similar ones are adjacent
+        maxAnnotatedCells : (integer) optional: values are only drawn on the cells of matrices up to this size
+        rasterThreshold : (integer) optional: matrices with more cells are drawn as a single image
 
     Example:
        >>> teUtils.plotting.plotFluxControlHeatMap (r, pdfExport='heapmap.pdf')
     '''
 
-    import seaborn as sns
     import pandas as pd
     
     #ss = r.getReactionIds()
@@ -307,7 +514,7 @@ def plotArrayHeatMap (data, pdfExport=None, annotations=True, figsize=(13,7), vm
     df = pd.DataFrame (data)
 
     f, ax = _plt.subplots(figsize=figsize)
-    hp = sns.heatmap(df, annot=annotations, fmt="5.2f", linewidths=.5, vmin=vmin, vmax=vmax, ax=ax, cmap='bwr')
+    _drawHeatMap (df, ax, annotations, vmin, vmax, cluster, maxAnnotatedCells, rasterThreshold)
 
     if pdfExport != None:
        f.savefig(pdfExport)
@@ -318,7 +525,7 @@ def plotConcentrationControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(10, 8
     Display the concentation control coefficients as a 3D plot
     
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         upperlimit : (float) optional parameter, sets the lower z axis limit
         upperlimit : (float) optional parameter, sets the upper z axis limit
         figsize : (tuble of float)  optional: width and heigh of plot in inches
@@ -331,10 +538,14 @@ def plotConcentrationControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(10, 8
     import matplotlib.pyplot as plt
     import matplotlib.cm as cm
     
+    # Registers the 3d projection with older versions of matplotlib
+    from mpl_toolkits.mplot3d import Axes3D
+
     fig = _plt.figure(figsize=figsize)
     ax = fig.add_subplot(111, projection='3d')
     
-    hist = r.getScaledConcentrationControlCoefficientMatrix()
+    ca = _getControlAnalysis (r)
+    hist = ca.concentrationControl
     
     xedges = _np.arange (float (hist.shape[0]) + 1)
     yedges = _np.arange (float (hist.shape[1]) + 1)
@@ -363,10 +574,10 @@ def plotConcentrationControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(10, 8
     ax.set_xlabel('Species')
     ax.set_ylabel('Enzymes')
     ax.xaxis.set_ticks(_np.arange (float (hist.shape[0])))
-    ax.xaxis.set_ticklabels(r.getFloatingSpeciesIds())
+    ax.xaxis.set_ticklabels(ca.speciesIds)
     ax.yaxis.set_ticks(_np.arange (float (hist.shape[1])))
     #ax.yaxis.set_ticks(ypos + dy/2.)
-    ax.yaxis.set_ticklabels(r.getReactionIds())
+    ax.yaxis.set_ticklabels(ca.reactionIds)
 
     ax.bar3d (xpos, ypos, zpos, dx, dy, dz, color=colors, zsort='average') 
     
@@ -376,7 +587,7 @@ def plotFluxControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(9, 7)):
     Display the flux control coefficients as a 3D plot
 
     Args:
-        r : roadrunner instance
+        r : roadrunner instance or teUtils.controlAnalysis.ControlAnalysis
         upperlimit : (float) optional parameter, sets the lower z axis limit
         upperlimit : (float) optional parameter, sets the upper z axis limit
         figsize : (tuble of float) optional: width and heigh of plot in inches
@@ -388,10 +599,14 @@ def plotFluxControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(9, 7)):
     import matplotlib.cm as cm
     import matplotlib.colors as colors
         
+    # Registers the 3d projection with older versions of matplotlib
+    from mpl_toolkits.mplot3d import Axes3D
+
     fig = _plt.figure(figsize=figsize)
     ax = fig.add_subplot(111, projection='3d')
     
-    hist = r.getScaledFluxControlCoefficientMatrix()
+    ca = _getControlAnalysis (r)
+    hist = ca.fluxControl
     
     xedges = _np.arange (float (hist.shape[0]) + 1)
     yedges = _np.arange (float (hist.shape[1]) + 1)
@@ -420,10 +635,10 @@ def plotFluxControlIn3D (r, upperLimit=1, lowerLimit=-1, figsize=(9, 7)):
     ax.set_xlabel('Fluxes')
     ax.set_ylabel('Enzymes')
     ax.xaxis.set_ticks(_np.arange (float (hist.shape[0])))
-    ax.xaxis.set_ticklabels(r.getReactionIds())
+    ax.xaxis.set_ticklabels(ca.fluxIds)
     ax.yaxis.set_ticks(_np.arange (float (hist.shape[1])))
     print (hist.shape)
-    ax.yaxis.set_ticklabels(r.getReactionIds())
+    ax.yaxis.set_ticklabels(ca.reactionIds)
 
     ax.bar3d (xpos, ypos, zpos, dx, dy, dz, color=colors, zsort='average') 
     
@@ -469,9 +684,40 @@ def plotFloatingSpecies (r, figsize=(12,6)):
     _plt.xticks(range (len (xlabels)), xlabels,  ha='right', rotation=45)    
 
 
+def _minMaxDownsample (x, y, buckets):
+    # Keep the smallest and largest point of each bucket, in time order, so peaks survive
+    n = len (x)
+    size = -(-n//buckets)
+    padded = _np.concatenate ([y, _np.repeat (y[-1:], size*buckets - n)]).reshape (buckets, size)
+    offsets = _np.arange (buckets)*size
+    low = offsets + _np.argmin (padded, axis=1)
+    high = offsets + _np.argmax (padded, axis=1)
+    index = _np.unique (_np.concatenate ([[0, n-1], _np.minimum (low, n-1), _np.minimum (high, n-1)]))
+    return x[index], y[index]
+
+def _lttbDownsample (x, y, threshold):
+    # Largest triangle three buckets (Steinarsson 2013), keeps the point of each bucket that forms the
+    # largest triangle with the previously kept point and the average of the next bucket
+    n = len (x)
+    edges = _np.linspace (1, n-1, threshold-1).astype (int)
+    selected = _np.empty (threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n-1
+    a = 0
+    for i in range (threshold-2):
+        start, end = edges[i], edges[i+1]
+        if i == threshold-3:
+           averageX, averageY = x[-1], y[-1]
+        else:
+           averageX, averageY = x[end:edges[i+2]].mean(), y[end:edges[i+2]].mean()
+        area = _np.abs ((x[a] - averageX)*(y[start:end] - y[a]) - (x[a] - x[start:end])*(averageY - y[a]))
+        a = start + _np.argmax (area)
+        selected[i+1] = a
+    return x[selected], y[selected]
+
 def plotArray(result, loc='upper right', show=True, resetColorCycle=True,
              xlabel=None, ylabel=None, title=None, xlim=None, ylim=None,
-             xscale='linear', yscale="linear", grid=False, labels=None, **kwargs):
+             xscale='linear', yscale="linear", grid=False, labels=None, downsample='minmax', maxPoints=None, **kwargs):
     ''' Plot a 2D graph based on an array where the first column is the x-axis
 
     The first column of the array must be the x-axis and remaining columns the y-axis.  
@@ -481,8 +727,14 @@ def plotArray(result, loc='upper right', show=True, resetColorCycle=True,
     Make sure you include as many labels as there are curves to plot!
     Use show=False to add multiple curves. Use color='red' to use the same color for every curve.
 
+    Columns longer than the point budget are downsampled before plotting. The budget is two
+    points per pixel of the axis width, so the plotted curve looks the same as the full data.
+
     Args:
-        r : roadrunner instance
+        result : numpy array with the x-axis in the first column
+        downsample : (string) optional: 'minmax' keeps the extremes of each pixel bucket, 'lttb' uses the
+                    largest triangle three buckets method, None plots every point
+        maxPoints : (integer) optional: point budget for each column, default is derived from the axis width
 
     Returns:
        Returns a handle to the plotting object.
@@ -505,12 +757,22 @@ def plotArray(result, loc='upper right', show=True, resetColorCycle=True,
     if labels is None:
         labels = result.dtype.names
 
+    x = _np.asarray(result[:, 0])
+    if maxPoints is None:
+        maxPoints = max(int(2*_plt.gca().get_window_extent().width), 4)
     for k in range(1, Ncol):
+        xk, yk = x, _np.asarray(result[:, k])
+        if downsample == 'minmax' and len(xk) > maxPoints:
+            xk, yk = _minMaxDownsample(xk, yk, maxPoints//2)
+        elif downsample == 'lttb' and len(xk) > maxPoints:
+            xk, yk = _lttbDownsample(xk, yk, maxPoints)
+        elif downsample not in ['minmax', 'lttb', None]:
+            raise ValueError('Unknown downsample method: ' + str(downsample))
         if loc is None or labels is None:
             # no legend or labels
-            p = _plt.plot(result[:, 0], result[:, k], **kwargs)
+            p = _plt.plot(xk, yk, **kwargs)
         else:
-            p = _plt.plot(result[:, 0], result[:, k], label=labels[k-1], **kwargs)
+            p = _plt.plot(xk, yk, label=labels[k-1], **kwargs)
 
     # labels
     if xlabel is not None:
@@ -537,12 +799,219 @@ def plotArray(result, loc='upper right', show=True, resetColorCycle=True,
     return p
 
 
+def plotStreamingTimeCourse (r, endTime=100, numberOfPoints=1000, selections=None, chunkPoints=50, figsize=(12,6), loc='upper right'):
+    '''
+    Simulates a time course in segments and draws the trajectories as they are computed.
+
+    The simulation continues from the current state of the model, as r.simulate does. Results
+    go into preallocated arrays and after each segment only the lines are redrawn on a saved
+    copy of the background (blitting), so the plot stays responsive with many species. The
+    whole figure is only redrawn when the y axis has to grow. Backends that cannot blit, such
+    as PDF, redraw the whole figure after each segment instead.
+
+    Args:
+        r : roadrunner instance
+        endTime : (double) optional: time to simulate to
+        numberOfPoints : (integer) optional: number of points in the time course
+        selections : (list of strings) optional: variables to plot, default is all floating species
+        chunkPoints : (integer) optional: number of points simulated between redraws
+        figsize : (tuple of float) optional: width and heigh of plot in inches
+        loc : (string) optional: location of the legend, None for no legend
+
+    Returns:
+        numpy array with time in the first column and the selections in the remaining columns
+
+    Example:
+       >>> m = teUtils.plotting.plotStreamingTimeCourse (r, endTime=1000, numberOfPoints=100000)
+    '''
+    if selections is None:
+       selections = r.getFloatingSpeciesIds()
+    selections = list (selections)
+    numberOfPoints = max (numberOfPoints, 2)
+    times = _np.linspace (0, endTime, numberOfPoints)
+    data = _np.empty ((numberOfPoints, len (selections) + 1))
+    data[:,0] = times
+
+    fig, ax = _plt.subplots (figsize=figsize)
+    canvas = fig.canvas
+    blit = canvas.supports_blit
+    lines = [ax.plot ([], [], label=selection, animated=blit)[0] for selection in selections]
+    ax.set_xlim (0, endTime)
+    ax.set_xlabel ('Time')
+    if loc is not None:
+       ax.legend (loc=loc)
+    if _plt.get_backend().lower() != 'agg' and blit:
+       _plt.show (block=False)
+    low, high = 0.0, 1.0
+    boundaries = list (range (0, numberOfPoints - 1, chunkPoints)) + [numberOfPoints - 1]
+    for start, end in zip (boundaries[:-1], boundaries[1:]):
+        m = _np.array (r.simulate (times[start], times[end], end - start + 1, selections))
+        # Each segment starts where the last one ended, so its first row is already stored
+        first = 0 if start == 0 else 1
+        data[start + first:end + 1, 1:] = m[first:]
+        segmentLow, segmentHigh = _np.min (m), _np.max (m)
+        if start == 0 or segmentLow < low or segmentHigh > high:
+           # The axis has to grow, redraw everything and save the new background
+           low, high = min (low, segmentLow), max (high, segmentHigh)
+           margin = 0.1*(high - low) if high > low else 1.0
+           low, high = low - margin, high + margin
+           ax.set_ylim (low, high)
+           if blit:
+              canvas.draw()
+              background = canvas.copy_from_bbox (fig.bbox)
+        for k, line in enumerate (lines):
+            line.set_data (times[:end + 1], data[:end + 1, k + 1])
+        if blit:
+           canvas.restore_region (background)
+           for line in lines:
+               ax.draw_artist (line)
+           canvas.blit (fig.bbox)
+        else:
+           canvas.draw_idle()
+        canvas.flush_events()
+    for line in lines:
+        line.set_animated (False)
+    return data
+
+
+def plotEnsembleBands (stats, lowerQuantile=0.05, upperQuantile=0.95, showMean=True, figsize=(12,6), alpha=0.3, pdfExport=None):
+    '''
+    Plots the quantile bands and mean of a time course ensemble as shaded regions.
+    
+    Args:
+        stats : teUtils.ensembles.EnsembleStatistics object
+        lowerQuantile : (float) optional: lower edge of the band, must be one of the tracked quantiles
+        upperQuantile : (float) optional: upper edge of the band, must be one of the tracked quantiles
+        showMean : (boolean) optional: draw the mean as a line
+        figsize : (tuple of float) optional: width and heigh of plot in inches
+        alpha : (float) optional: transparency of the bands
+        pdfExport : (string) optional parameter, indicates the filename to export the plot as a pdf file
+
+    Example:
+       >>> stats = teUtils.ensembles.randomEnsemble (r, 1000)
+       >>> teUtils.plotting.plotEnsembleBands (stats)
+    '''
+    lower = stats.getQuantile (lowerQuantile)
+    upper = stats.getQuantile (upperQuantile)
+    labels = stats.labels
+    if labels is None:
+       labels = ['Variable ' + str (k + 1) for k in range (lower.shape[1])]
+
+    fig, ax = _plt.subplots (figsize=figsize)
+    for k in range (lower.shape[1]):
+        band = ax.fill_between (stats.time, lower[:,k], upper[:,k], alpha=alpha, label=labels[k])
+        if showMean:
+           ax.plot (stats.time, stats.mean[:,k], color=band.get_facecolor()[0], alpha=1)
+    ax.set_xlabel ('Time')
+    ax.legend (loc='upper right')
+    if pdfExport != None:
+        fig.savefig(pdfExport)
+    return fig
+
+
+class _SavedModel:
+    # Stands in for a roadrunner instance in a plot job sent to a worker process
+    def __init__ (self, r):
+        self.state = r.saveStateS()
+
+def _startExportWorker ():
+    _plt.switch_backend ('Agg')
+
+def _restoreArgument (value):
+    if isinstance (value, _SavedModel):
+       import roadrunner
+       r = roadrunner.RoadRunner()
+       r.loadStateS (value.state)
+       return r
+    return value
+
+def _renderPlotJob (function, args, kwargs, fileName, dpi):
+    # Runs in a worker process, saves the figure to fileName or returns it pickled
+    import pickle
+    try:
+       function (*[_restoreArgument (arg) for arg in args],
+                 **{name: _restoreArgument (value) for name, value in kwargs.items()})
+       fig = _plt.gcf()
+       if fileName is None:
+          return pickle.dumps (fig)
+       fig.savefig (fileName, dpi=dpi)
+       return fileName
+    finally:
+       _plt.close ('all')
+
+def batchExport (jobs, pdfFile=None, maxWorkers=None, dpi=None):
+    '''
+    Renders many figures in worker processes with the Agg backend and writes them to files.
+
+    Each job is a tuple (fileName, function, args) or (fileName, function, args, kwargs). The
+    worker calls function (\\*args, \\*\\*kwargs) and saves the current figure to fileName, the
+    format follows the file extension. Roadrunner instances in args or kwargs are sent as
+    saved state and restored in the worker. If pdfFile is given every figure is written as
+    one page of a single PDF file, in job order, and the fileNames in the jobs are ignored.
+    Figures are closed as soon as they are written, so memory does not grow with the number
+    of jobs.
+
+    Args:
+        jobs : (list of tuples) the plots to make
+        pdfFile : (string) optional: write all figures to this multi-page PDF file
+        maxWorkers : (integer) optional: number of worker processes, default is the number of cpus
+        dpi : (float) optional: resolution of raster output
+
+    Returns:
+        The list of files written
+
+    Example:
+       >>> teUtils.plotting.batchExport ([('fcc.pdf', teUtils.plotting.plotFluxControlHeatMap, (r,)),
+       ...                                ('species.png', teUtils.plotting.plotFloatingSpecies, (r,), {'figsize': (8,4)})])
+       >>> teUtils.plotting.batchExport (jobs, pdfFile='report.pdf')
+    '''
+    import concurrent.futures
+    import os
+    import pickle
+
+    def prepare (value):
+        return _SavedModel (value) if hasattr (value, 'saveStateS') else value
+
+    workers = maxWorkers or os.cpu_count() or 1
+    jobs = list (jobs)
+    pdf = None
+    written = []
+    if pdfFile is not None:
+       from matplotlib.backends.backend_pdf import PdfPages
+       pdf = PdfPages (pdfFile)
+       written.append (pdfFile)
+    try:
+       with concurrent.futures.ProcessPoolExecutor (workers, initializer=_startExportWorker) as executor:
+          # Keep a bounded number of figures in flight and collect them in job order
+          pending = []
+          for index in range (len (jobs) + 1):
+              if index < len (jobs):
+                 job = jobs[index]
+                 kwargs = job[3] if len (job) > 3 else {}
+                 pending.append (executor.submit (_renderPlotJob, job[1], tuple (prepare (arg) for arg in job[2]),
+                                                  {name: prepare (value) for name, value in kwargs.items()},
+                                                  None if pdf is not None else job[0], dpi))
+              while pending and (len (pending) > 2*workers or index == len (jobs)):
+                  result = pending.pop (0).result()
+                  if pdf is None:
+                     written.append (result)
+                  else:
+                     fig = pickle.loads (result)
+                     pdf.savefig (fig, dpi=dpi)
+                     _plt.close (fig)
+    finally:
+       if pdf is not None:
+          pdf.close()
+    return written
+
+
 def plotWithLegend(r, result=None, loc='upper left', show=True, **kwargs):
     return r.plot(result=result, loc=loc, show=show, **kwargs)
 
 def testme():
     """ Call this method to try out the methods in this module"""
 
+    import tellurium as _te
     r = _te.loada("""
          J1: $Xo -> S1;  k1*Xo - k11*S1;
          J2:  S1 -> S2;  k2*S1 - k22*S2;
@@ -577,6 +1046,7 @@ def testme():
 if __name__ == "__main__":
 
     import teUtils
+    import tellurium as _te
     r = _te.loada("""
          J1: $Xo -> S1;  k1*Xo - k11*S1;
          J2:  S1 -> S2;  k2*S1 - k22*S2;
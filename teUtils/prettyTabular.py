@@ -5,7 +5,6 @@ Created on Tue Jan 16 09:43:05 2018
 """
 
 from tabulate import tabulate as _tabulate
-import tellurium as _te
 
 def tabulateConcentrations(r, fmt='psql'):
     '''
@@ -80,6 +79,7 @@ def testme():
     """ Run this to try out the methods"""
 
     import teUtils
+    import tellurium as _te
     r = _te.loada("""
          J1: $Xo -> S1;  k1*Xo - k11*S1;
          J2:  S1 -> S2;  k2*S1 - k22*S2;
@@ -106,6 +106,7 @@ def testme():
 if __name__ == "__main__":
 
     import teUtils
+    import tellurium as _te
     r = _te.loada("""
          J1: $Xo -> S1;  k1*Xo - k11*S1;
          J2:  S1 -> S2;  k2*S1 - k22*S2;
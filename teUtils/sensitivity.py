@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+""" Global sensitivity analysis (Sobol indices and Morris elementary effects)
+
+The sample designs are simulated in parallel with parameterScanning.simulateParameterSets
+and the indices are computed with vectorized numpy estimators. Passing timeResolved=True
+returns the indices at every time point of the time course instead of only at the end.
+"""
+
+import numpy as _np
+import warnings as _warnings
+
+from teUtils import parameterScanning as _parameterScanning
+
+__all__ = ['getSaltelliSample', 'getMorrisSample', 'sobolIndices', 'morrisElementaryEffects']
+
+
+def _scaleToBounds(unit, bounds):
+    bounds = _np.asarray(bounds, dtype=float)
+    return bounds[:, 0] + unit*(bounds[:, 1] - bounds[:, 0])
+
+
+def getSaltelliSample(bounds, numberOfSamples, seed=None):
+    """ Return the Saltelli sample design used to estimate Sobol indices
+
+    Args:
+      bounds (list of pairs): Lower and upper limit for each parameter, eg [[0.5, 2], [1, 10]]
+      numberOfSamples (integer): Number of base samples N
+      seed (integer or numpy SeedSequence): Optional: Seed for the random number generator
+
+    Returns:
+      numpy array of shape (N*(k+2), k) where k is the number of parameters. The rows are
+      the A matrix, the B matrix and then the k AB matrices (A with column i taken from B).
+    """
+    k = len(bounds)
+    rng = _np.random.default_rng(seed)
+    a = rng.random((numberOfSamples, k))
+    b = rng.random((numberOfSamples, k))
+    ab = _np.repeat(a[_np.newaxis], k, axis=0)
+    for i in range(k):
+        ab[i, :, i] = b[:, i]
+    return _scaleToBounds(_np.concatenate([a, b, ab.reshape(-1, k)]), bounds)
+
+
+def getMorrisSample(bounds, numberOfTrajectories, numberOfLevels=4, seed=None):
+    """ Return the Morris one-at-a-time trajectory design
+
+    Args:
+      bounds (list of pairs): Lower and upper limit for each parameter
+      numberOfTrajectories (integer): Number of trajectories r
+      numberOfLevels (integer): Optional: Number of grid levels p, should be even
+      seed (integer or numpy SeedSequence): Optional: Seed for the random number generator
+
+    Returns:
+      tuple: (samples, steps)
+         samples is a numpy array of shape (r*(k+1), k). Each block of k+1 rows is one trajectory in
+         which consecutive rows differ in a single parameter. steps is an array of shape (r, k, 2)
+         holding, for each move of each trajectory, the parameter index and the signed step in unit space.
+    """
+    k = len(bounds)
+    rng = _np.random.default_rng(seed)
+    delta = numberOfLevels/(2.0*(numberOfLevels - 1))
+    levels = _np.arange(numberOfLevels)/(numberOfLevels - 1.0)
+    levels = levels[levels <= 1 - delta + 1E-12]
+    unit = _np.empty((numberOfTrajectories, k + 1, k))
+    steps = _np.empty((numberOfTrajectories, k, 2))
+    for t in range(numberOfTrajectories):
+        x = rng.choice(levels, size=k)
+        unit[t, 0] = x
+        for j, factor in enumerate(rng.permutation(k)):
+            step = delta if rng.random() < 0.5 else -delta
+            if not 0 <= x[factor] + step <= 1:
+                step = -step
+            x = x.copy()
+            x[factor] += step
+            unit[t, j + 1] = x
+            steps[t, j] = factor, step
+    return _scaleToBounds(unit.reshape(-1, k), bounds), steps
+
+
+def _getOutputs(r, parameters, samples, variable, timeEnd, numberOfPoints, timeResolved, maxWorkers):
+    # Returns the time points and the outputs with shape (samples, times)
+    data = _parameterScanning.simulateParameterSets(r, parameters, samples, ['time', variable],
+                                                    timeEnd=timeEnd, numberOfPoints=numberOfPoints,
+                                                    maxWorkers=maxWorkers)
+    if timeResolved:
+        return data[0, :, 0], data[:, :, 1]
+    return data[0, -1:, 0], data[:, -1:, 1]
+
+
+def _sobolEstimates(fA, fB, fAB):
+    # Saltelli (2010) first order and Jansen total order estimators
+    # fA, fB have shape (N, T), fAB has shape (k, N, T)
+    variance = _np.var(_np.concatenate([fA, fB]), axis=0)
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        first = _np.mean(fB*(fAB - fA), axis=1)/variance
+        total = 0.5*_np.mean((fA - fAB)**2, axis=1)/variance
+    return first, total
+
+
+def sobolIndices(r, parameters, bounds, variable, numberOfSamples=1000, timeEnd=10, numberOfPoints=100,
+      timeResolved=False, numberOfBootstraps=100, confidenceLevel=0.95, seed=None, maxWorkers=None):
+    """ Compute first order and total Sobol indices of a model output
+
+    The output is the value of variable at timeEnd, or at every time point when timeResolved
+    is True. N*(k+2) simulations are run in parallel.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The k parameters to vary
+      bounds (list of pairs): Lower and upper limit for each parameter
+      variable (string): The model variable used as the output, eg 'S1'
+      numberOfSamples (integer): Optional: Number of base samples N
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints (integer): Optional: Number of points in each time course
+      timeResolved (boolean): Optional: Set True to compute the indices at every time point
+      numberOfBootstraps (integer): Optional: Number of bootstrap resamples for the confidence intervals, 0 to skip
+      confidenceLevel (float): Optional: Confidence level of the intervals
+      seed (integer): Optional: Seed for the random number generator
+      maxWorkers (integer): Optional: Number of worker processes, use 1 to run in this process
+
+    Returns:
+      dictionary with keys
+         'time': the time points, 'S1' and 'ST': first order and total indices, 'S1_conf' and 'ST_conf':
+         lower and upper confidence limits (leading axis of length 2). Indices have shape (k,),
+         or (numberOfPoints, k) when timeResolved is True.
+
+    Example:
+
+     .. code-block:: python
+
+        result = tu.sensitivity.sobolIndices (r, ['k10', 'k20'], [[0.5, 2], [0.5, 2]], 'S2', numberOfSamples=500)
+        print (result['S1'], result['ST'])
+    """
+    k = len(parameters)
+    n = numberOfSamples
+    # Independent streams for the sample and the bootstrap, reusing the seed would correlate them
+    sampleSeed, bootstrapSeed = _np.random.SeedSequence(seed).spawn(2)
+    samples = getSaltelliSample(bounds, n, seed=sampleSeed)
+    time, y = _getOutputs(r, parameters, samples, variable, timeEnd, numberOfPoints, timeResolved, maxWorkers)
+    fA, fB, fAB = y[:n], y[n:2*n], y[2*n:].reshape(k, n, -1)
+    first, total = _sobolEstimates(fA, fB, fAB)
+
+    result = {'time': time, 'S1': first.T, 'ST': total.T}
+    if numberOfBootstraps > 0:
+        rng = _np.random.default_rng(bootstrapSeed)
+        firstSamples = _np.empty((numberOfBootstraps,) + first.shape)
+        totalSamples = _np.empty((numberOfBootstraps,) + total.shape)
+        for b in range(numberOfBootstraps):
+            index = rng.integers(0, n, n)
+            firstSamples[b], totalSamples[b] = _sobolEstimates(fA[index], fB[index], fAB[:, index])
+        limits = [50*(1 - confidenceLevel), 50*(1 + confidenceLevel)]
+        with _warnings.catch_warnings():
+            # Outputs with zero variance (eg at time zero) give undefined indices
+            _warnings.simplefilter('ignore', RuntimeWarning)
+            result['S1_conf'] = _np.swapaxes(_np.nanpercentile(firstSamples, limits, axis=0), 1, 2)
+            result['ST_conf'] = _np.swapaxes(_np.nanpercentile(totalSamples, limits, axis=0), 1, 2)
+    if not timeResolved:
+        for key in ['S1', 'ST']:
+            result[key] = result[key][0]
+            if key + '_conf' in result:
+                result[key + '_conf'] = result[key + '_conf'][:, 0]
+    return result
+
+
+def _morrisEstimates(effects):
+    # effects has shape (r, k, T)
+    return _np.mean(effects, axis=0), _np.mean(_np.abs(effects), axis=0), _np.std(effects, axis=0, ddof=1)
+
+
+def morrisElementaryEffects(r, parameters, bounds, variable, numberOfTrajectories=20, numberOfLevels=4,
+      timeEnd=10, numberOfPoints=100, timeResolved=False, numberOfBootstraps=100, confidenceLevel=0.95,
+      seed=None, maxWorkers=None):
+    """ Screen parameters with the Morris elementary effects method
+
+    r*(k+1) simulations are run in parallel. Elementary effects are computed in unit
+    parameter space so they can be compared between parameters with different ranges.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The k parameters to vary
+      bounds (list of pairs): Lower and upper limit for each parameter
+      variable (string): The model variable used as the output, eg 'S1'
+      numberOfTrajectories (integer): Optional: Number of trajectories r
+      numberOfLevels (integer): Optional: Number of grid levels
+      timeEnd (float): Optional: Simulate a time course up to this time
+      numberOfPoints (integer): Optional: Number of points in each time course
+      timeResolved (boolean): Optional: Set True to compute the statistics at every time point
+      numberOfBootstraps (integer): Optional: Number of bootstrap resamples for the mu_star confidence interval, 0 to skip
+      confidenceLevel (float): Optional: Confidence level of the interval
+      seed (integer): Optional: Seed for the random number generator
+      maxWorkers (integer): Optional: Number of worker processes, use 1 to run in this process
+
+    Returns:
+      dictionary with keys
+         'time', 'mu', 'mu_star', 'sigma' and 'mu_star_conf'. Statistics have shape (k,),
+         or (numberOfPoints, k) when timeResolved is True.
+
+    Example:
+
+     .. code-block:: python
+
+        result = tu.sensitivity.morrisElementaryEffects (r, ['k10', 'k20'], [[0.5, 2], [0.5, 2]], 'S2')
+        print (result['mu_star'])
+    """
+    k = len(parameters)
+    sampleSeed, bootstrapSeed = _np.random.SeedSequence(seed).spawn(2)
+    samples, steps = getMorrisSample(bounds, numberOfTrajectories, numberOfLevels, seed=sampleSeed)
+    time, y = _getOutputs(r, parameters, samples, variable, timeEnd, numberOfPoints, timeResolved, maxWorkers)
+    y = y.reshape(numberOfTrajectories, k + 1, -1)
+    # Each move changes one factor, scatter the differences into (r, k, T) by factor
+    differences = (y[:, 1:] - y[:, :-1])/steps[:, :, 1:2]
+    effects = _np.empty_like(differences)
+    rows = _np.arange(numberOfTrajectories)[:, _np.newaxis]
+    effects[rows, steps[:, :, 0].astype(int)] = differences
+    mu, muStar, sigma = _morrisEstimates(effects)
+
+    result = {'time': time, 'mu': mu.T, 'mu_star': muStar.T, 'sigma': sigma.T}
+    if numberOfBootstraps > 0:
+        rng = _np.random.default_rng(bootstrapSeed)
+        index = rng.integers(0, numberOfTrajectories, (numberOfBootstraps, numberOfTrajectories))
+        bootstrap = _np.mean(_np.abs(effects[index]), axis=1)
+        limits = [50*(1 - confidenceLevel), 50*(1 + confidenceLevel)]
+        result['mu_star_conf'] = _np.swapaxes(_np.percentile(bootstrap, limits, axis=0), 1, 2)
+    if not timeResolved:
+        for key in ['mu', 'mu_star', 'sigma']:
+            result[key] = result[key][0]
+        if 'mu_star_conf' in result:
+            result['mu_star_conf'] = result['mu_star_conf'][:, 0]
+    return result
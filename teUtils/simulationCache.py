@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+""" Cache of simulation results keyed by the content of the model and the simulation inputs
+
+A key is a hash of the model SBML, the parameter values, the initial conditions, the
+integrator settings and the arguments of the call (selections, time span and so on).
+Results are kept in an in-memory least recently used tier and, optionally, in a size
+capped directory on disk so they survive between sessions.
+
+Note that the disk tier stores results with pickle, only point it at a directory you trust.
+"""
+
+import collections as _collections
+import copy as _copy
+import hashlib as _hashlib
+import os as _os
+import pickle as _pickle
+
+import numpy as _np
+
+__all__ = ['SimulationCache']
+
+
+class SimulationCache:
+    """ Two tier (memory and disk) cache of simulation results.
+
+    Pass an instance with the cache argument of the scanning and plotting functions.
+
+    Args:
+      maxMemoryEntries (integer): Optional: Number of results kept in memory
+      directory (string): Optional: Directory for the disk tier, no disk tier if not given
+      maxDiskBytes (integer): Optional: Size limit of the disk tier, the least recently used files are removed first
+
+    Example:
+
+     .. code-block:: python
+
+        cache = tu.simulationCache.SimulationCache (directory='scanCache')
+        tu.parameterScanning.simpleTimeCourseScan (r, 'k20', 'S1', 3, 12, 7, cache=cache)
+        # The second call comes straight from the cache
+        tu.parameterScanning.simpleTimeCourseScan (r, 'k20', 'S1', 3, 12, 7, cache=cache)
+        print (cache.info())
+        cache.purge()
+    """
+
+    def __init__(self, maxMemoryEntries=128, directory=None, maxDiskBytes=1024**3):
+        self.maxMemoryEntries = maxMemoryEntries
+        self.directory = directory
+        self.maxDiskBytes = maxDiskBytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = _collections.OrderedDict()
+        if directory is not None:
+            _os.makedirs(directory, exist_ok=True)
+
+    def getKey(self, r, *args, exclude=()):
+        """ Return the key for a simulation of r with the given call arguments
+
+        Args:
+          r (reference): Roadrunner instance
+          args: Any other values that change the result, eg the function name, selections and time span
+          exclude (list of strings): Optional: Ids whose current values do not matter, eg a parameter that is being scanned
+        """
+        h = _hashlib.sha256()
+        h.update(r.getSBML().encode())
+        for ids, values in [(r.getGlobalParameterIds(), r.model.getGlobalParameterValues()),
+                            (r.getFloatingSpeciesIds(), r.model.getFloatingSpeciesInitConcentrations()),
+                            (r.getBoundarySpeciesIds(), r.model.getBoundarySpeciesConcentrations()),
+                            (r.getCompartmentIds(), r.model.getCompartmentVolumes())]:
+            for id, value in zip(ids, values):
+                if id not in exclude:
+                    h.update(repr((id, float(value))).encode())
+        integrator = r.getIntegrator()
+        h.update(repr([integrator.getName()] +
+                      [(name, integrator.getValue(name)) for name in integrator.getSettings()]).encode())
+        h.update(repr(args).encode())
+        return h.hexdigest()
+
+    def _fileName(self, key):
+        return _os.path.join(self.directory, key + '.pkl')
+
+    def get(self, key):
+        """ Return the result stored under key, or None if there is none """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return _copy.deepcopy(self._memory[key])
+        if self.directory is not None and _os.path.exists(self._fileName(key)):
+            with open(self._fileName(key), 'rb') as f:
+                value = _pickle.load(f)
+            # Mark as recently used for the disk size limit
+            _os.utime(self._fileName(key))
+            self._putMemory(key, value)
+            self.hits += 1
+            return _copy.deepcopy(value)
+        self.misses += 1
+        return None
+
+    def _putMemory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxMemoryEntries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, value):
+        """ Store a result under key """
+        value = _copy.deepcopy(value)
+        self._putMemory(key, value)
+        if self.directory is not None:
+            temporary = self._fileName(key) + '.tmp'
+            with open(temporary, 'wb') as f:
+                _pickle.dump(value, f, protocol=_pickle.HIGHEST_PROTOCOL)
+            _os.replace(temporary, self._fileName(key))
+            self._trimDisk()
+
+    def _diskFiles(self):
+        if self.directory is None:
+            return []
+        files = [_os.path.join(self.directory, name) for name in _os.listdir(self.directory) if name.endswith('.pkl')]
+        return sorted(files, key=_os.path.getmtime)
+
+    def _trimDisk(self):
+        files = self._diskFiles()
+        sizes = [_os.path.getsize(name) for name in files]
+        total = sum(sizes)
+        for name, size in zip(files, sizes):
+            if total <= self.maxDiskBytes:
+                break
+            _os.remove(name)
+            total -= size
+
+    def remove(self, key):
+        """ Remove one result from both tiers """
+        self._memory.pop(key, None)
+        if self.directory is not None and _os.path.exists(self._fileName(key)):
+            _os.remove(self._fileName(key))
+
+    def purge(self, memory=True, disk=True):
+        """ Remove all results
+
+        Args:
+          memory (boolean): Optional: Clear the memory tier
+          disk (boolean): Optional: Clear the disk tier
+        """
+        if memory:
+            self._memory.clear()
+        if disk:
+            for name in self._diskFiles():
+                _os.remove(name)
+
+    def info(self):
+        """ Return a dictionary describing the contents of the cache and the hit counts """
+        files = self._diskFiles()
+        return {'memoryEntries': len(self._memory), 'maxMemoryEntries': self.maxMemoryEntries,
+                'diskEntries': len(files), 'diskBytes': int(_np.sum([_os.path.getsize(name) for name in files])),
+                'maxDiskBytes': self.maxDiskBytes, 'hits': self.hits, 'misses': self.misses}
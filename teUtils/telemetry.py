@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+""" Per-simulation performance telemetry for scans and simulation grids
+
+Pass a Telemetry object with the telemetry argument of the scanning and plotting
+functions to record, for every simulation, the wall time spent in each phase (reset,
+integrate and so on) and whether the simulation failed. Work that is not tied to one
+simulation, such as plotting, is recorded as job phases. When no Telemetry object is
+passed a shared do-nothing recorder is used, so the cost of the instrumentation is a few
+attribute lookups per simulation.
+
+Integrator step counts are not recorded. Roadrunner does not report its solver
+statistics, and counting output rows only works with variable_step_size, which breaks the
+fixed grid of output points the scans rely on.
+"""
+
+import time as _time
+
+import numpy as _np
+
+__all__ = ['Telemetry', 'getRecorder', 'runRecorded']
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_nullContext = _NullContext()
+
+
+class _NullTelemetry:
+    """ Recorder used when telemetry is disabled, every method does nothing """
+    enabled = False
+
+    def phase(self, name):
+        return _nullContext
+
+    def simulation(self, **info):
+        return _nullContext
+
+    def setValue(self, name, value):
+        pass
+
+    def merge(self, records):
+        pass
+
+    def recordFailure(self, error, **info):
+        pass
+
+
+_nullTelemetry = _NullTelemetry()
+
+
+def getRecorder(telemetry):
+    """ Return telemetry, or the do-nothing recorder if telemetry is None """
+    return _nullTelemetry if telemetry is None else telemetry
+
+
+class _Phase:
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = _time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = _time.perf_counter() - self.start
+        target = self.telemetry._current
+        if target is None:
+            target = self.telemetry.jobPhases
+        target[self.name] = target.get(self.name, 0.0) + elapsed
+        return False
+
+
+class _Simulation:
+    def __init__(self, telemetry, info):
+        self.telemetry = telemetry
+        self.info = info
+
+    def __enter__(self):
+        record = dict(self.info)
+        record['start'] = _time.time()
+        record['failed'] = False
+        self.telemetry._current = record
+        self.start = _time.perf_counter()
+        return record
+
+    def __exit__(self, exceptionType, exception, traceback):
+        record = self.telemetry._current
+        record['total'] = _time.perf_counter() - self.start
+        record['end'] = record['start'] + record['total']
+        if exception is not None:
+            record['failed'] = True
+            record['error'] = repr(exception)
+        self.telemetry._current = None
+        self.telemetry.records.append(record)
+        return False
+
+
+class Telemetry:
+    """ Collects wall time per phase and failures for each simulation.
+
+    Example:
+
+     .. code-block:: python
+
+        telemetry = tu.telemetry.Telemetry()
+        tu.parameterScanning.simpleTimeCourseScan (r, 'k20', 'S1', 3, 12, 50, telemetry=telemetry)
+        print (telemetry.summary())
+        telemetry.toCSV ('scanTelemetry.csv')
+    """
+    enabled = True
+
+    def __init__(self):
+        self.records = []
+        self.jobPhases = {}
+        self._current = None
+
+    def phase(self, name):
+        """ Context manager that adds the time spent inside it to phase name of the current simulation,
+        or to the job phases if no simulation is being recorded """
+        return _Phase(self, name)
+
+    def simulation(self, **info):
+        """ Context manager that records one simulation, keyword arguments are stored in the record """
+        return _Simulation(self, info)
+
+    def setValue(self, name, value):
+        """ Store an extra value, eg the skipped time, in the record of the current simulation """
+        if self._current is not None:
+            self._current[name] = value
+
+    def recordFailure(self, error, **info):
+        """ Record a simulation that failed before it could be recorded, eg in a worker process """
+        now = _time.time()
+        record = dict(info, start=now, end=now, total=0.0, failed=True, error=repr(error))
+        self.records.append(record)
+
+    def merge(self, records):
+        """ Add records collected elsewhere, eg by runRecorded in a worker process """
+        self.records.extend(records)
+
+    def getPhaseNames(self):
+        """ Return the names of all phases recorded for simulations """
+        names = []
+        for record in self.records:
+            for name in record:
+                if name not in names and name not in _recordFields and isinstance(record[name], float):
+                    names.append(name)
+        return names
+
+    def getPhaseTimes(self, name):
+        """ Return a numpy array with the time spent in phase name for each simulation that recorded it """
+        return _np.array([record[name] for record in self.records if name in record])
+
+    def histogram(self, name, bins=10):
+        """ Return (counts, bin edges) of the time spent in phase name, name can also be 'total' """
+        return _np.histogram(self.getPhaseTimes(name), bins=bins)
+
+    def summary(self):
+        """ Return a dictionary with the number of simulations and failures, throughput in
+        simulations per second, statistics for each phase and the job phase totals """
+        count = len(self.records)
+        result = {'simulations': count,
+                  'failures': sum(1 for record in self.records if record['failed']),
+                  'wallTime': 0.0, 'throughput': 0.0, 'phases': {}, 'jobPhases': dict(self.jobPhases)}
+        if count > 0:
+            wallTime = max(record['end'] for record in self.records) - min(record['start'] for record in self.records)
+            result['wallTime'] = wallTime
+            result['throughput'] = count/wallTime if wallTime > 0 else float('inf')
+        for name in self.getPhaseNames() + ['total']:
+            times = self.getPhaseTimes(name)
+            if len(times) > 0:
+                result['phases'][name] = {'total': float(_np.sum(times)), 'mean': float(_np.mean(times)),
+                                          'max': float(_np.max(times)), 'count': len(times)}
+        return result
+
+    def toJSON(self, fileName):
+        """ Write the summary and all simulation records to a JSON file """
+        import json
+        with open(fileName, 'w') as f:
+            json.dump({'summary': self.summary(), 'simulations': self.records}, f, indent=1, default=float)
+
+    def toCSV(self, fileName):
+        """ Write one row per simulation to a CSV file """
+        import csv
+        columns = []
+        for record in self.records:
+            for name in record:
+                if name not in columns:
+                    columns.append(name)
+        with open(fileName, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+
+_recordFields = ['start', 'end', 'total', 'failed', 'error', 'skippedTime']
+
+
+def runRecorded(r, function, *args):
+    """ Worker task that calls function (r, \\*args, telemetry=recorder) with a fresh Telemetry
+    and returns (result, records), use Telemetry.merge to add the records in the parent """
+    recorder = Telemetry()
+    return function(r, *args, telemetry=recorder), recorder.records
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the cached control coefficient matrices
+"""
+
+from teUtils import controlAnalysis
+from teUtils import plotting
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import tellurium as te
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    J1: $Xo -> S1; k1*Xo - k11*S1;
+    J2: S1 -> S2; k2*S1 - k22*S2;
+    J3: S2 -> ; k3*S2;
+
+    k1 = 0.3; k11 = 0.26; k2 = 0.5; k22 = 0.41; k3 = 0.27;
+    Xo = 10;
+    """
+
+
+class _CountingModel:
+    # Passes everything to the roadrunner instance and counts the control coefficient calls
+    def __init__(self, r):
+        self._r = r
+        self.calls = 0
+        self.names = []
+
+    def __getattr__(self, name):
+        if name.startswith('getScaled'):
+            self.calls += 1
+            self.names.append(name)
+        return getattr(self._r, name)
+
+
+class TestControlAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.rr_model = te.loada(ANTIMONY_MODEL)
+
+    def tearDown(self):
+        plt.close('all')
+
+    def testCaching(self):
+        if IGNORE_TEST:
+            return
+        model = _CountingModel(self.rr_model)
+        ca = controlAnalysis.ControlAnalysis(model)
+        self.assertEqual(ca.speciesIds, ['S1', 'S2'])
+        self.assertEqual(ca.fluxIds, ['J1', 'J2', 'J3'])
+        self.assertEqual(ca.reactionIds, ['J1', 'J2', 'J3'])
+        self.assertTrue(np.allclose(ca.fluxControl, self.rr_model.getScaledFluxControlCoefficientMatrix()))
+        self.assertEqual(model.calls, 2)
+        # Summation theorem for the flux control coefficients
+        self.assertTrue(np.allclose(ca.fluxControl.sum(axis=1), 1))
+        ca.concentrationControl
+        self.assertEqual(model.calls, 2)
+        # A parameter change invalidates the matrices
+        self.rr_model['k3'] = 0.5
+        changed = ca.concentrationControl
+        self.assertEqual(model.calls, 3)
+        self.assertTrue(np.allclose(changed, self.rr_model.getScaledConcentrationControlCoefficientMatrix()))
+        ca.invalidate()
+        ca.fluxControl
+        self.assertEqual(model.calls, 4)
+
+    def testPlotsShareResults(self):
+        if IGNORE_TEST:
+            return
+        model = _CountingModel(self.rr_model)
+        ca = controlAnalysis.ControlAnalysis(model)
+        plotting.plotConcentrationControlHeatMap(ca)
+        plotting.plotFluxControlHeatMap(ca)
+        plotting.plotFluxControlBar(ca, 'J2')
+        plotting.plotConcentrationControlBar(ca, 'S1')
+        plotting.plotConcentrationControlIn3D(ca)
+        plotting.plotFluxControlIn3D(ca)
+        self.assertEqual(model.calls, 2)
+        # A roadrunner instance still works
+        plotting.plotFluxControlBar(self.rr_model, 'J2')
+
+    def testSingleMatrixPlots(self):
+        if IGNORE_TEST:
+            return
+        # A plot of one matrix from a roadrunner instance does not compute the other
+        model = _CountingModel(self.rr_model)
+        plotting.plotFluxControlHeatMap(model)
+        self.assertEqual(model.names.count('getScaledConcentrationControlCoefficientMatrix'), 0)
+        self.assertEqual(model.names.count('getScaledFluxControlCoefficientMatrix'), 1)
+        model = _CountingModel(self.rr_model)
+        plotting.plotConcentrationControlHeatMap(model)
+        self.assertEqual(model.names, ['getScaledConcentrationControlCoefficientMatrix'])
+
+    def testBatchControlCoefficients(self):
+        if IGNORE_TEST:
+            return
+        values = np.column_stack([np.linspace(0.2, 0.4, 6), np.linspace(0.3, 0.6, 6)])
+        serial = controlAnalysis.batchControlCoefficients(self.rr_model, ['k1', 'k3'], values, maxWorkers=1)
+        self.assertEqual(serial['fluxControl'].shape, (6, 3, 3))
+        self.assertEqual(serial['concentrationControl'].shape, (6, 2, 3))
+        self.assertTrue(np.all(serial['converged']))
+        self.assertEqual(self.rr_model['k1'], 0.3)
+        self.rr_model['k1'] = values[4, 0]
+        self.rr_model['k3'] = values[4, 1]
+        self.assertTrue(np.allclose(serial['fluxControl'][4], self.rr_model.getScaledFluxControlCoefficientMatrix()))
+        self.rr_model['k1'] = 0.3
+        self.rr_model['k3'] = 0.27
+        parallel = controlAnalysis.batchControlCoefficients(self.rr_model, ['k1', 'k3'], values, maxWorkers=2,
+                                                            chunkSize=2)
+        self.assertTrue(np.allclose(parallel['fluxControl'], serial['fluxControl']))
+        self.assertTrue(np.allclose(parallel['concentrationControl'], serial['concentrationControl']))
+        fig = plotting.plotControlCoefficientSummary(parallel, kind='concentration')
+        self.assertEqual(len(fig.axes), 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
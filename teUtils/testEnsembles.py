@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the streaming ensemble statistics
+"""
+
+from teUtils import ensembles
+from teUtils import workerPool
+
+import numpy as np
+import tellurium as te
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    $X0 -> S1; k1*X0;
+    S1 -> $X1; k2*S1;
+
+    k1 = 1; k2 = 0.5;
+    S1 = 0; X0 = 1; X1 = 0;
+    """
+
+
+class TestEnsembles(unittest.TestCase):
+
+    def testStatistics(self):
+        if IGNORE_TEST:
+            return
+        rng = np.random.default_rng(0)
+        time = np.linspace(0, 1, 4)
+        samples = rng.normal(size=(5000, 4, 2))*np.array([1, 3]) + np.array([2, -1])
+        stats = ensembles.EnsembleStatistics(['A', 'B'], quantiles=(0.1, 0.5, 0.9))
+        for x in samples:
+            stats.update(np.column_stack([time, x]))
+        self.assertEqual(stats.count, len(samples))
+        self.assertTrue(np.allclose(stats.time, time))
+        self.assertTrue(np.allclose(stats.mean, samples.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.variance, samples.var(axis=0, ddof=1)))
+        for quantile in [0.1, 0.5, 0.9]:
+            exact = np.quantile(samples, quantile, axis=0)
+            self.assertTrue(np.allclose(stats.getQuantile(quantile), exact, atol=0.15))
+        with self.assertRaises(ValueError):
+            stats.getQuantile(0.25)
+
+    def testFewSimulations(self):
+        if IGNORE_TEST:
+            return
+        stats = ensembles.EnsembleStatistics()
+        for value in [1, 2, 3]:
+            stats.update(np.array([[0, value], [1, value]]))
+        self.assertTrue(np.allclose(stats.getQuantile(0.5), 2))
+
+    def testRandomEnsemble(self):
+        if IGNORE_TEST:
+            return
+        r = te.loada(ANTIMONY_MODEL)
+        stats = ensembles.randomEnsemble(r, 20, maxRange=2, endTime=10, numPoints=11)
+        self.assertEqual(stats.mean.shape, (11, 1))
+        self.assertEqual(stats.labels, ['S1'])
+        with workerPool.ModelPool(r, maxWorkers=2) as pool:
+            stats = ensembles.randomEnsemble(r, 20, maxRange=2, endTime=10, numPoints=11, pool=pool)
+        self.assertEqual(stats.count, 20)
+        self.assertTrue(np.all(stats.getQuantile(0.05) <= stats.getQuantile(0.95)))
+
+
+if __name__ == '__main__':
+  unittest.main()
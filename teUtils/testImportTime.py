@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that importing teUtils stays cheap
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+
+IGNORE_TEST = False
+# Before submodules were loaded lazily this import took several seconds
+MAX_IMPORT_SECONDS = 0.5
+HEAVY_MODULES = ['tellurium', 'matplotlib', 'libsbml', 'roadrunner', 'pandas', 'seaborn', 'scipy']
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import teUtils
+import teUtils.fileUtils
+import teUtils.buildNetworks
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % HEAVY_MODULES
+
+
+class TestImportTime(unittest.TestCase):
+
+    def _run(self):
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([PACKAGE_ROOT] + [p for p in [environment.get('PYTHONPATH')] if p])
+        output = subprocess.check_output([sys.executable, '-c', SCRIPT], env=environment)
+        return json.loads(output.decode().strip().splitlines()[-1])
+
+    def testMinimalImport(self):
+        if IGNORE_TEST:
+            return
+        result = self._run()
+        self.assertEqual(result['loaded'], [])
+        # Best of three, the first run may be slowed down by a cold disk cache
+        elapsed = min([result['elapsed']] + [self._run()['elapsed'] for i in range(2)])
+        self.assertLess(elapsed, MAX_IMPORT_SECONDS)
+
+    def testLazyAttributes(self):
+        if IGNORE_TEST:
+            return
+        import teUtils
+        self.assertIn('plotting', dir(teUtils))
+        self.assertTrue(hasattr(teUtils.simulationCache, 'SimulationCache'))
+        with self.assertRaises(AttributeError):
+            teUtils.notAModule
+
+
+if __name__ == '__main__':
+  unittest.main()
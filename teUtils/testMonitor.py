@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the terminal monitor
+"""
+
+from teUtils import monitor
+from teUtils import parameterScanning
+from teUtils import telemetry
+
+import io
+import matplotlib
+matplotlib.use('Agg')
+import tellurium as te
+import time
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    J1: $X0 -> S1; k1*X0;
+    J2: S1 -> $X1; k2*S1;
+
+    k1 = 1; k2 = 0.5;
+    S1 = 0; X0 = 1; X1 = 0;
+    """
+
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.rr_model = te.loada(ANTIMONY_MODEL)
+
+    def testUpdates(self):
+        if IGNORE_TEST:
+            return
+        stream = io.StringIO()
+        with monitor.TerminalMonitor(total=10, refreshInterval=0.05, stream=stream) as terminal:
+            self.rr_model.simulate(0, 10, 10)
+            for i in range(4):
+                terminal.update(r=self.rr_model)
+            terminal.update(failed=1)
+            time.sleep(0.2)
+        text = stream.getvalue()
+        self.assertGreater(text.count('teUtils monitor'), 1)
+        final = terminal.render()
+        self.assertIn('5/10', final)
+        self.assertIn('Failures 1', final)
+        self.assertIn('S1 : ' + '*'*int(5*self.rr_model['S1']), final)
+        self.assertIn('J2 : ', final)
+
+    def testNonFiniteValues(self):
+        if IGNORE_TEST:
+            return
+        stream = io.StringIO()
+        terminal = monitor.TerminalMonitor(refreshInterval=0.02, stream=stream)
+        terminal.setValues(concentrations=(['S1', 'S2', 'S3'], [float('nan'), float('inf'), 1.0]))
+        time.sleep(0.1)
+        # The thread is still drawing and close draws the final state without raising
+        self.assertTrue(terminal._thread.is_alive())
+        terminal.close()
+        final = terminal.render()
+        self.assertIn('S1 : nan', final)
+        self.assertIn('S2 : inf', final)
+        self.assertIn('S3 : *****', final)
+        self.assertNotIn('could not draw', stream.getvalue())
+
+    def testOverhead(self):
+        if IGNORE_TEST:
+            return
+        terminal = monitor.TerminalMonitor(total=100000, refreshInterval=0.01, stream=io.StringIO())
+        start = time.perf_counter()
+        for i in range(100000):
+            terminal.update()
+        elapsed = time.perf_counter() - start
+        terminal.close()
+        self.assertEqual(terminal.completed, 100000)
+        # A few microseconds per simulation, well under 1% of even a one millisecond simulation
+        self.assertLess(elapsed/100000, 1E-5)
+
+    def testTelemetry(self):
+        if IGNORE_TEST:
+            return
+        recorder = telemetry.Telemetry()
+        with monitor.TerminalMonitor(total=3, telemetry=recorder, refreshInterval=0.05,
+                                     stream=io.StringIO()) as terminal:
+            parameterScanning.multiVariableTimeCourseScan(self.rr_model, 'k1', ['S1'], 1, 2, 3, telemetry=recorder)
+        self.assertIn('3/3 100.0%', terminal.render())
+
+
+if __name__ == '__main__':
+  unittest.main()
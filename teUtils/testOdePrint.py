@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for extracting the ODEs of a model as text
+"""
+
+from teUtils import odePrint
+
+import io
+import libsbml
+import numpy as np
+import os
+import shutil
+import tellurium as te
+import tempfile
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    x1 := 1 + 2
+    J0: $Xo -> 2 E; v;
+    J1: ES -> E + S1; k1*ES*E;
+    J2: S1 -> S2; k2*S1;
+    J3: S2 + 3 E -> 6 ES; k3*S2*E;
+    k1 = 0.1; k2 = 0.4; k3 = 0.6; v = 0;
+    S1 = 100; E = 20;
+    """
+EXPECTED = """x1 = 1 + 2
+
+vJ0 = v
+vJ1 = k1*ES*E
+vJ2 = k2*S1
+vJ3 = k3*S2*E
+
+dE/dt = 2.0*vJ0 + vJ1 - 3.0*vJ3
+dES/dt = -vJ1 + 6.0*vJ3
+dS1/dt = vJ1 - vJ2
+dS2/dt = vJ2 - vJ3
+"""
+RULES_MODEL = """
+    function mm(v, s, km)
+        v*s/(km + s)
+    end
+    compartment c = 2;
+    species S1 in c, S2 in c, S3 in c;
+    J0: $X0 -> S1; k0*X0*piecewise(1.5, time < 2, 1);
+    J1: S1 -> 2 S2; mm(Vm, S1, Km);
+    J2: S2 -> S3; k2*S2^h;
+    J3: S3 -> ; kd*S3 + x1;
+    x1 := 0.01*S1 + sqrt(k0);
+    Z' = -0.1*Z + log10(S2 + 1);
+    k0 = 1; X0 = 2; Vm = 3; Km = 0.5; k2 = 0.4; h = 1.5; kd = 0.2; Z = 1;
+    S1 = 1; S2 = 0.5; S3 = 0.1;
+    """
+
+
+def _makeChainModel(numberOfReactions):
+    # Written with libsbml directly, compiling a model this size would take much longer than the test
+    doc = libsbml.SBMLDocument(3, 1)
+    model = doc.createModel()
+    compartment = model.createCompartment()
+    compartment.setId('c')
+    compartment.setConstant(True)
+    compartment.setSize(1)
+    for i in range(numberOfReactions + 1):
+        species = model.createSpecies()
+        species.setId('S%d' % i)
+        species.setCompartment('c')
+        species.setInitialConcentration(1)
+        species.setBoundaryCondition(False)
+        species.setHasOnlySubstanceUnits(False)
+        species.setConstant(False)
+    for i in range(numberOfReactions):
+        reaction = model.createReaction()
+        reaction.setId('J%d' % i)
+        reaction.setReversible(False)
+        reactant = reaction.createReactant()
+        reactant.setSpecies('S%d' % i)
+        reactant.setStoichiometry(1)
+        reactant.setConstant(True)
+        product = reaction.createProduct()
+        product.setSpecies('S%d' % (i + 1))
+        product.setStoichiometry(1)
+        product.setConstant(True)
+        reaction.createKineticLaw().setMath(libsbml.parseL3Formula('k*S%d' % i))
+    return libsbml.writeSBMLToString(doc)
+
+
+class TestOdePrint(unittest.TestCase):
+
+    def setUp(self):
+        self.rr_model = te.loada(ANTIMONY_MODEL)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testGetODEsFromModel(self):
+        if IGNORE_TEST:
+            return
+        self.assertEqual(odePrint.getODEsFromModel(self.rr_model), EXPECTED)
+        self.assertEqual(odePrint.getODEsFromSBMLString(self.rr_model.getSBML()), EXPECTED)
+        with self.assertRaises(RuntimeError):
+            odePrint.getODEsFromModel(self.rr_model.getSBML())
+
+    def testOutputFile(self):
+        if IGNORE_TEST:
+            return
+        sbmlFile = os.path.join(self.directory, 'model.xml')
+        with open(sbmlFile, 'w') as f:
+            f.write(self.rr_model.getSBML())
+        outputFile = os.path.join(self.directory, 'odes.txt')
+        self.assertIsNone(odePrint.getODEsFromSBMLFile(sbmlFile, outputFile=outputFile))
+        with open(outputFile) as f:
+            self.assertEqual(f.read(), EXPECTED)
+        stream = io.StringIO()
+        odePrint.getODEsFromModel(self.rr_model, outputFile=stream)
+        self.assertEqual(stream.getvalue(), EXPECTED)
+
+    def testCache(self):
+        if IGNORE_TEST:
+            return
+        odePrint.clearCache()
+        before = odePrint.getCacheInfo()
+        first = odePrint.getODEsFromModel(self.rr_model)
+        self.assertIs(odePrint.getODEsFromModel(self.rr_model), first)
+        self.assertEqual(odePrint.getODEsFromSBMLString(self.rr_model.getSBML()), EXPECTED)
+        info = odePrint.getCacheInfo()
+        self.assertEqual((info['hits'] - before['hits'], info['misses'] - before['misses'], info['entries']), (2, 1, 1))
+        # Changing a value does not change the ODEs, changing the structure does
+        self.rr_model['k1'] = 0.5
+        self.assertEqual(odePrint.getODEsFromModel(self.rr_model), EXPECTED)
+        other = te.loada('J0: S1 -> S2; k1*S1; k1 = 1; S1 = 1')
+        self.assertEqual(odePrint.getODEsFromModel(other).splitlines()[-1], 'dS2/dt = vJ0')
+        # Files are found again by path, modification time and size
+        sbmlFile = os.path.join(self.directory, 'model.xml')
+        with open(sbmlFile, 'w') as f:
+            f.write(self.rr_model.getSBML())
+        odePrint.clearCache()
+        odePrint.getODEsFromSBMLFile(sbmlFile)
+        hits = odePrint.getCacheInfo()['hits']
+        self.assertEqual(odePrint.getODEsFromSBMLFile(sbmlFile), EXPECTED)
+        self.assertEqual(odePrint.getCacheInfo()['hits'], hits + 1)
+        with open(sbmlFile, 'w') as f:
+            f.write(other.getSBML())
+        os.utime(sbmlFile, ns=(0, 0))
+        self.assertEqual(odePrint.getODEsFromSBMLFile(sbmlFile), odePrint.getODEsFromModel(other))
+        try:
+            odePrint.setCacheLimits(maxEntries=1)
+            odePrint.getODEsFromModel(self.rr_model)
+            self.assertEqual(odePrint.getCacheInfo()['entries'], 1)
+            odePrint.setCacheLimits(maxEntries=0)
+            odePrint.getODEsFromModel(self.rr_model)
+            self.assertEqual(odePrint.getCacheInfo()['entries'], 0)
+        finally:
+            odePrint.setCacheLimits()
+
+    def testODEFunction(self):
+        if IGNORE_TEST:
+            return
+        from scipy.integrate import solve_ivp
+        r = te.loada(RULES_MODEL)
+        r['k2'] = 0.3
+        f = odePrint.getODEFunctionFromModel(r)
+        self.assertEqual(f.stateIds, ['S1', 'S2', 'S3', 'Z'])
+        self.assertEqual(f.parameterValues[f.parameterIds.index('k2')], 0.3)
+        # Amount rates from roadrunner divided by the volume
+        dydt = f(0, f.initialState)
+        self.assertTrue(np.allclose(dydt, [r["S1'"]/2, r["S2'"]/2, r["S3'"]/2, r["Z'"]]))
+        times = np.linspace(0, 10, 11)
+        solution = solve_ivp(f, (0, 10), f.initialState, vectorized=True, t_eval=times, rtol=1e-9, atol=1e-12)
+        expected = r.simulate(0, 10, 11, ['[S1]', '[S2]', '[S3]', 'Z'])
+        self.assertTrue(np.allclose(solution.y.T, expected, rtol=1e-4, atol=1e-4))
+        # A batch of parameter sets gives the same rates as one set at a time
+        p = np.tile(f.parameterValues[:, None], 50)
+        p[f.parameterIds.index('Vm')] = np.linspace(0.5, 5, 50)
+        batch = f(1, f.initialState, p)
+        self.assertEqual(batch.shape, (4, 50))
+        self.assertTrue(np.allclose(batch[:, 7], f(1, f.initialState, p[:, 7])))
+        # From the SBML the values are the ones declared in the model
+        f = odePrint.getODEFunctionFromSBMLString(r.getSBML())
+        self.assertEqual(f.parameterValues[f.parameterIds.index('k2')], 0.4)
+        with self.assertRaises(RuntimeError):
+            odePrint.getODEFunctionFromSBMLString(te.loada('J0: S1 -> S2; k*delay(S1, 1); k = 1; S1 = 1').getSBML())
+
+    def testCompiledODEFunction(self):
+        if IGNORE_TEST or shutil.which(os.environ.get('CC', 'cc')) is None:
+            return
+        from scipy.integrate import solve_ivp
+        r = te.loada(RULES_MODEL)
+        f = odePrint.getODEFunctionFromModel(r)
+        compiled = odePrint.compileODEFunction(f, directory=self.directory)
+        self.assertIn('void odeprint_jacobian', compiled.cSource)
+        modified = os.path.getmtime(compiled.library)
+        # The second time the library is loaded from the directory
+        self.assertEqual(odePrint.compileODEFunction(f, directory=self.directory).library, compiled.library)
+        self.assertEqual(os.path.getmtime(compiled.library), modified)
+        y = f.initialState
+        self.assertTrue(np.allclose(compiled(0.5, y), f(0.5, y)))
+        # Batches in either memory layout, with shared or separate parameter values
+        states = np.random.default_rng(1).uniform(0.1, 2, size=(4, 20))
+        p = np.tile(f.parameterValues[:, None], 20)
+        p[f.parameterIds.index('Vm')] = np.linspace(0.5, 5, 20)
+        self.assertTrue(np.allclose(compiled(1, states, p), f(1, states, p)))
+        self.assertTrue(np.allclose(compiled(1, np.asfortranarray(states)), f(1, states)))
+        self.assertTrue(np.allclose(compiled(1, y, p), f(1, y, p)))
+        out = np.empty((4, 20))
+        self.assertIs(compiled(1, states, p, out=out), out)
+        with self.assertRaises(ValueError):
+            compiled(1, y[:3])
+        # The analytic Jacobian against central differences of the NumPy function
+        eps = 1e-6
+        numeric = np.array([(f(0.5, y + eps*e) - f(0.5, y - eps*e))/(2*eps) for e in np.eye(4)]).T
+        self.assertTrue(np.allclose(compiled.jacobian(0.5, y), numeric, atol=1e-6))
+        batch = compiled.jacobian(1, states, p)
+        self.assertEqual(batch.shape, (4, 4, 20))
+        self.assertTrue(np.allclose(batch[:, :, 3], compiled.jacobian(1, states[:, 3], p[:, 3])))
+        solution = solve_ivp(compiled, (0, 10), y, method='BDF', jac=compiled.jacobian, t_eval=[10],
+                             rtol=1e-9, atol=1e-12)
+        expected = r.simulate(0, 10, 2, ['[S1]', '[S2]', '[S3]', 'Z'])[-1]
+        self.assertTrue(np.allclose(solution.y[:, -1], expected, rtol=1e-4))
+
+    def testLargeModel(self):
+        if IGNORE_TEST:
+            return
+        size = 5000
+        odes = odePrint.getODEsFromSBMLString(_makeChainModel(size))
+        lines = odes.splitlines()
+        # A blank line, the rate laws, a blank line and one ODE per species
+        self.assertEqual(len(lines), 2*size + 3)
+        self.assertEqual(lines[1], 'vJ0 = k*S0')
+        self.assertEqual(lines[size + 2], 'dS0/dt = -vJ0')
+        self.assertEqual(lines[-1], 'dS%d/dt = vJ%d' % (size, size - 1))
+
+
+if __name__ == '__main__':
+  unittest.main()
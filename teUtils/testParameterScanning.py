@@ -7,9 +7,17 @@ Created on Aug 8, 2020
 """
 
 from teUtils import parameterScanning
+from teUtils import simulationCache
+from teUtils import telemetry
+from teUtils import workerPool
 
+import asyncio
+import concurrent.futures
 import numpy as np
+import os
+import shutil
 import tellurium as te
+import tempfile
 import unittest
 
 
@@ -39,7 +47,208 @@ class TestScanning(unittest.TestCase):
               self.rr_model, 'k2', 'S1', 3, 12, 3)
         self.assertTrue(isinstance(result, np.ndarray))
         self.assertEqual(np.shape(result)[1], NUM_SCAN+1)
-        
+
+    def testMultiVariableTimeCourseScan(self):
+        if IGNORE_TEST:
+            return
+        NUM_SCAN = 4
+        selections = ['S1', 'S2', self.rr_model.getReactionIds()[1], "S1'", 'k2']
+        time, values, data, labels = parameterScanning.multiVariableTimeCourseScan(
+              self.rr_model, 'k2', selections, 3, 12, NUM_SCAN, numberOfPoints=50)
+        self.assertEqual(data.shape, (50, NUM_SCAN, len(selections)))
+        self.assertEqual(labels, selections)
+        self.assertEqual(len(time), 50)
+        self.assertTrue(np.allclose(data[:, :, labels.index('k2')], values))
+        single = parameterScanning.simpleTimeCourseScan(
+              self.rr_model, 'k2', 'S2', 3, 12, NUM_SCAN, numberOfPoints=50)
+        self.assertTrue(np.allclose(single[:, 1:], data[:, :, labels.index('S2')]))
+        with self.assertRaises(ValueError):
+            parameterScanning.multiVariableTimeCourseScan(self.rr_model, 'k2', selections, 3, 12, 0)
+
+    def testTimeCourseScanToFile(self):
+        if IGNORE_TEST:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            results = parameterScanning.timeCourseScanToFile(
+                  self.rr_model, 'k2', ['time', 'S1'], 3, 12, 5,
+                  os.path.join(directory, 'scan'), numberOfPoints=20, shardSize=2)
+            self.assertEqual(len(results), 5)
+            self.assertTrue(np.allclose(results.parameterValues[:, 0], np.linspace(3, 12, 5)))
+            self.assertEqual(results[4].shape, (20, 2))
+            self.assertEqual(results[1:4].shape, (3, 20, 2))
+            self.assertEqual(results.getSelection('S1').shape, (20, 5))
+            # Reads that span several shards match reading one simulation at a time
+            single = np.array([results[i] for i in range(5)])
+            self.assertTrue(np.array_equal(results[::-2], single[::-2]))
+            self.assertTrue(np.array_equal(results.getSelection('S1'), single[:, :, 1].T))
+            self.assertTrue(np.array_equal(results.getSelection('S1', [4, 0, 3]), single[[4, 0, 3], :, 1].T))
+            self.rr_model.reset()
+            self.rr_model['k2'] = 12
+            m = self.rr_model.simulate(0, 10, 20, ['time', 'S1'])
+            self.assertTrue(np.allclose(results[-1], m))
+        finally:
+            shutil.rmtree(directory)
+
+    def testAsyncTimeCourseScan(self):
+        if IGNORE_TEST:
+            return
+        NUM_SCAN = 6
+        async def runScan(executor, maxPending):
+            results = {}
+            async for index, value, m in parameterScanning.asyncTimeCourseScan(
+                  self.rr_model, 'k2', ['time', 'S1'], 3, 12, NUM_SCAN,
+                  executor=executor, maxPending=maxPending):
+                results[index] = (value, m)
+            return results
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            results = asyncio.run(runScan(executor, 2))
+        self.assertEqual(sorted(results.keys()), list(range(NUM_SCAN)))
+        value, m = results[NUM_SCAN-1]
+        self.assertEqual(value, 12)
+        self.rr_model.reset()
+        self.rr_model['k2'] = 12
+        self.assertTrue(np.allclose(m, self.rr_model.simulate(0, 10, 100, ['time', 'S1'])))
+        # Default process pool
+        results = asyncio.run(runScan(None, None))
+        self.assertEqual(len(results), NUM_SCAN)
+
+    def testAdaptiveTimeCourseScan(self):
+        if IGNORE_TEST:
+            return
+        MAX_SCANS = 12
+        values, data = parameterScanning.adaptiveTimeCourseScan(
+              self.rr_model, 'k2', 'S1', 0.1, 12, initialScans=3,
+              tolerance=0.01, maxScans=MAX_SCANS)
+        self.assertEqual(len(values), MAX_SCANS)
+        self.assertEqual(data.shape, (100, MAX_SCANS+1))
+        self.assertTrue(np.all(np.diff(values) > 0))
+        # Output changes fastest at small k2 so more points end up there
+        self.assertGreater(np.sum(values < 6), np.sum(values > 6))
+        # A loose tolerance needs no refinement
+        values, data = parameterScanning.adaptiveTimeCourseScan(
+              self.rr_model, 'k2', 'S1', 0.1, 12, initialScans=3, tolerance=100)
+        self.assertEqual(len(values), 3)
+
+    def testModelPool(self):
+        if IGNORE_TEST:
+            return
+        tasks = [(['k2'], [value], 10, 20, ['time', 'S1']) for value in [3, 6, 12]]
+        expected = [workerPool.simulateTimeCourse(self.rr_model, *task) for task in tasks]
+        with workerPool.ModelPool(self.rr_model, maxWorkers=2) as pool:
+            results = pool.map(workerPool.simulateTimeCourse, tasks)
+        for result, m in zip(results, expected):
+            self.assertTrue(np.allclose(result, m))
+        # The state is shipped with each task when an executor is supplied
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            pool = workerPool.ModelPool(self.rr_model, executor=executor)
+            results = pool.map(workerPool.simulateTimeCourse, tasks)
+        self.assertTrue(np.allclose(results[-1], expected[-1]))
+
+    def testModelPoolReuse(self):
+        if IGNORE_TEST:
+            return
+        # Values set by one task must not leak into the next task on the same worker
+        task = (['k2'], [1.0], 10, 20, ['time', 'S1'])
+        expected = workerPool.simulateTimeCourse(te.loada(ANTIMONY_MODEL), *task)
+        with workerPool.ModelPool(self.rr_model, maxWorkers=1) as pool:
+            first = pool.submit(workerPool.simulateTimeCourse, *task).result()
+            pool.submit(workerPool.simulateTimeCourse, ['k1', 'v0', 'init(X0)'], [5.0, 3.0, 2.0], 10, 20,
+                        ['time', 'S1']).result()
+            second = pool.submit(workerPool.simulateTimeCourse, *task).result()
+        self.assertTrue(np.allclose(first, expected))
+        self.assertTrue(np.allclose(second, expected))
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            pool = workerPool.ModelPool(self.rr_model, executor=executor)
+            pool.submit(workerPool.simulateTimeCourse, ['k1'], [5.0], 10, 20, ['time', 'S1']).result()
+            self.assertTrue(np.allclose(pool.submit(workerPool.simulateTimeCourse, *task).result(), expected))
+            # Only a few model states are kept by each worker
+            for i in range(workerPool._maxWorkerModels + 3):
+                self.rr_model['k3'] = 3.0 + i
+                workerPool.ModelPool(self.rr_model, executor=executor).submit(
+                    workerPool.simulateTimeCourse, [], [], 1, 2, ['time']).result()
+            counts = executor.submit(lambda: len(workerPool._workerModels.models)).result()
+        self.assertLessEqual(counts, workerPool._maxWorkerModels)
+
+    def testSteadyStateTermination(self):
+        if IGNORE_TEST:
+            return
+        NUM_SCAN = 3
+        full = parameterScanning.simpleTimeCourseScan(
+              self.rr_model, 'k2', 'S1', 3, 12, NUM_SCAN, timeEnd=100, numberOfPoints=500)
+        data, savedTime = parameterScanning.simpleTimeCourseScan(
+              self.rr_model, 'k2', 'S1', 3, 12, NUM_SCAN, timeEnd=100, numberOfPoints=500,
+              steadyStateTolerance=1E-8)
+        self.assertEqual(data.shape, full.shape)
+        self.assertTrue(np.allclose(data, full, atol=1E-4))
+        self.assertEqual(len(savedTime), NUM_SCAN)
+        self.assertTrue(np.all(savedTime > 40))
+        result = parameterScanning.multiVariableTimeCourseScan(
+              self.rr_model, 'k2', ['S1', 'S2'], 3, 12, NUM_SCAN, timeEnd=100,
+              numberOfPoints=500, steadyStateTolerance=1E-8)
+        self.assertEqual(len(result), 5)
+        self.assertTrue(np.allclose(result[2][:, :, 0], full[:, 1:], atol=1E-4))
+
+    def testSimulationCache(self):
+        if IGNORE_TEST:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            cache = simulationCache.SimulationCache(maxMemoryEntries=1, directory=directory)
+            first = parameterScanning.simpleTimeCourseScan(
+                  self.rr_model, 'k2', 'S1', 3, 12, 3, cache=cache)
+            second = parameterScanning.simpleTimeCourseScan(
+                  self.rr_model, 'k2', 'S1', 3, 12, 3, cache=cache)
+            self.assertTrue(np.allclose(first, second))
+            self.assertEqual(cache.info()['hits'], 1)
+            # A different model parameter value is a different key
+            self.rr_model['k1'] = 5
+            third = parameterScanning.simpleTimeCourseScan(
+                  self.rr_model, 'k2', 'S1', 3, 12, 3, cache=cache)
+            self.assertFalse(np.allclose(first, third))
+            self.assertEqual(cache.info()['misses'], 2)
+            self.assertEqual(cache.info()['memoryEntries'], 1)
+            self.assertEqual(cache.info()['diskEntries'], 2)
+            # The first result is now only on disk
+            self.rr_model['k1'] = 2
+            parameterScanning.simpleTimeCourseScan(
+                  self.rr_model, 'k2', 'S1', 3, 12, 3, cache=cache)
+            self.assertEqual(cache.info()['hits'], 2)
+            cache.purge()
+            self.assertEqual(cache.info()['diskEntries'], 0)
+            self.assertEqual(cache.info()['memoryEntries'], 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def testTelemetry(self):
+        if IGNORE_TEST:
+            return
+        recorder = telemetry.Telemetry()
+        parameterScanning.simpleTimeCourseScan(
+              self.rr_model, 'k2', 'S1', 3, 12, 4, telemetry=recorder)
+        summary = recorder.summary()
+        self.assertEqual(summary['simulations'], 4)
+        self.assertEqual(summary['failures'], 0)
+        self.assertGreater(summary['throughput'], 0)
+        self.assertEqual(summary['phases']['integrate']['count'], 4)
+        self.assertIn('plot', summary['jobPhases'])
+        counts, edges = recorder.histogram('total', bins=3)
+        self.assertEqual(counts.sum(), 4)
+        # Records made in the workers are merged
+        parameterScanning.simulateParameterSets(self.rr_model, ['k2'], [[1.0], [2.0], [3.0]], ['time', 'S1'],
+              maxWorkers=2, chunkSize=1, telemetry=recorder)
+        self.assertEqual(len(recorder.records), 7)
+        self.assertEqual(sorted(record['index'] for record in recorder.records[4:]), [0, 1, 2])
+        self.assertEqual(recorder.summary()['phases']['integrate']['count'], 7)
+        directory = tempfile.mkdtemp()
+        try:
+            recorder.toJSON(os.path.join(directory, 'telemetry.json'))
+            recorder.toCSV(os.path.join(directory, 'telemetry.csv'))
+            with open(os.path.join(directory, 'telemetry.csv')) as f:
+                self.assertEqual(len(f.readlines()), 8)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
   unittest.main()
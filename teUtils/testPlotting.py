@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the plotting functions
+"""
+
+from teUtils import plotting
+
+import os
+import shutil
+import tempfile
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import tellurium as te
+import unittest
+from unittest import mock
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    $X0 -> S1; k1*X0;
+    S1 -> S2; k2*S1;
+    S2 -> $X1; k3*S2;
+
+    k1 = 1; k2 = 0.5; k3 = 0.2;
+    S1 = 0; S2 = 0; X0 = 1; X1 = 0;
+    """
+
+
+class TestPlotting(unittest.TestCase):
+
+    def setUp(self):
+        self.rr_model = te.loada(ANTIMONY_MODEL)
+
+    def tearDown(self):
+        plt.close('all')
+
+    def _gridData(self, fig):
+        return [np.array(ax.collections[0].get_segments()) for ax in fig.axes]
+
+    def testPlotRandSimGrid(self):
+        if IGNORE_TEST:
+            return
+        plotting.plotRandSimGrid(self.rr_model, ngrid=3, numPoints=20, randomSeed=3, maxWorkers=1)
+        fig = plt.gcf()
+        self.assertEqual(len(fig.axes), 9)
+        first = self._gridData(fig)
+        # One collection per cell with a curve for every floating species
+        self.assertTrue(all(len(ax.collections) == 1 and len(ax.lines) == 0 for ax in fig.axes))
+        self.assertEqual(first[0].shape, (2, 20, 2))
+        # The same seed gives the same grid when the simulations run in worker processes
+        plotting.plotRandSimGrid(self.rr_model, ngrid=3, numPoints=20, randomSeed=3, maxWorkers=2)
+        second = self._gridData(plt.gcf())
+        self.assertTrue(all(np.allclose(a, b) for a, b in zip(first, second)))
+        # Cells keep their values when the grid grows
+        plotting.plotRandSimGrid(self.rr_model, ngrid=4, numPoints=20, randomSeed=3, maxWorkers=1)
+        self.assertTrue(np.allclose(self._gridData(plt.gcf())[5], first[5]))
+
+    def testPlotRandSimGridInProcess(self):
+        if IGNORE_TEST:
+            return
+        # Small grids do not start worker processes unless asked to
+        with mock.patch.object(plotting._workerPool, 'ModelPool', side_effect=AssertionError('pool started')):
+            plotting.plotRandSimGrid(self.rr_model, ngrid=3, numPoints=20, randomSeed=3)
+            with self.assertRaises(AssertionError):
+                plotting.plotRandSimGrid(self.rr_model, ngrid=3, numPoints=20, randomSeed=3, maxWorkers=2)
+        self.assertEqual(len(plt.gcf().axes), 9)
+
+    def testPlotPhasePortraitGrid(self):
+        if IGNORE_TEST:
+            return
+        plotting.plotPhasePortraitGrid(self.rr_model, numPoints=50)
+        self.assertEqual(len(plt.gcf().axes), 4)
+        plotting.plotPhasePortraitGrid(self.rr_model, numPoints=50, uniquePairs=True)
+        axes = plt.gcf().axes
+        self.assertEqual(len(axes), 1)
+        # The lower triangle of a 2 x 2 grid is a single cell that fills the figure
+        self.assertEqual(axes[0].get_subplotspec().get_gridspec().get_geometry(), (1, 1))
+        # The only unique pair is S2 against S1
+        x, y = axes[0].lines[0].get_data()
+        self.rr_model.reset()
+        m = self.rr_model.simulate(0, 200, 50, ['S1', 'S2'])
+        self.assertTrue(np.allclose(x, m[:, 0]))
+        self.assertTrue(np.allclose(y, m[:, 1]))
+        image = plotting.plotPhasePortraitGrid(self.rr_model, numPoints=50, renderToImage=True, maxWorkers=2,
+                                               cellPixels=40)
+        self.assertEqual(image.shape, (80, 80, 4))
+        image = plotting.plotPhasePortraitGrid(self.rr_model, numPoints=50, uniquePairs=True, renderToImage=True,
+                                               maxWorkers=2, cellPixels=40)
+        self.assertEqual(image.shape, (40, 40, 4))
+        self.assertLess(image[..., :3].min(), 255)
+
+    def testPlotArrayDownsampling(self):
+        if IGNORE_TEST:
+            return
+        time = np.linspace(0, 100, 1000001)
+        y = np.sin(time)
+        y[123457] = 5
+        plt.figure(figsize=(8, 4), dpi=100)
+        plotting.plotArray(np.column_stack([time, y]), show=False)
+        x, plotted = plt.gca().lines[0].get_data()
+        budget = 2*plt.gca().get_window_extent().width
+        self.assertLessEqual(len(x), budget + 2)
+        self.assertEqual(plotted.max(), 5)
+        self.assertAlmostEqual(plotted.min(), -1, places=6)
+        self.assertEqual(x[0], 0)
+        self.assertEqual(x[-1], 100)
+        plotting.plotArray(np.column_stack([time, y]), show=False, downsample='lttb', maxPoints=500)
+        x, plotted = plt.gca().lines[-1].get_data()
+        self.assertEqual(len(x), 500)
+        self.assertEqual(plotted.max(), 5)
+        self.assertTrue(np.all(np.diff(x) > 0))
+        plotting.plotArray(np.column_stack([time[:100], y[:100]]), show=False)
+        self.assertEqual(len(plt.gca().lines[-1].get_data()[0]), 100)
+
+    def testPlotStreamingTimeCourse(self):
+        if IGNORE_TEST:
+            return
+        data = plotting.plotStreamingTimeCourse(self.rr_model, endTime=20, numberOfPoints=201, chunkPoints=30)
+        self.assertEqual(data.shape, (201, 3))
+        self.rr_model.reset()
+        expected = self.rr_model.simulate(0, 20, 201, ['time', 'S1', 'S2'])
+        self.assertTrue(np.allclose(data, expected, rtol=1e-4, atol=1e-6))
+        ax = plt.gca()
+        x, y = ax.lines[1].get_data()
+        self.assertEqual(len(x), 201)
+        self.assertTrue(np.array_equal(y, data[:, 2]))
+        low, high = ax.get_ylim()
+        self.assertLessEqual(low, data[:, 1:].min())
+        self.assertGreaterEqual(high, data[:, 1:].max())
+        self.assertEqual(plt.get_backend().lower(), 'agg')
+        # A backend that cannot blit redraws the whole figure instead
+        plt.switch_backend('pdf')
+        try:
+            self.rr_model.reset()
+            other = plotting.plotStreamingTimeCourse(self.rr_model, endTime=20, numberOfPoints=201, chunkPoints=30)
+            self.assertFalse(plt.gcf().canvas.supports_blit)
+            self.assertTrue(np.allclose(other, data))
+            self.assertTrue(np.array_equal(plt.gca().lines[1].get_data()[1], data[:, 2]))
+        finally:
+            plt.close('all')
+            plt.switch_backend('agg')
+
+    def testLargeHeatMap(self):
+        if IGNORE_TEST:
+            return
+        rng = np.random.default_rng(1)
+        plotting.plotArrayHeatMap(rng.uniform(-1, 1, size=(10, 10)))
+        self.assertEqual(len(plt.gca().texts), 100)
+        plotting.plotArrayHeatMap(rng.uniform(-1, 1, size=(30, 30)))
+        self.assertEqual(len(plt.gca().texts), 0)
+        plotting.plotArrayHeatMap(rng.uniform(-1, 1, size=(300, 200)))
+        self.assertEqual(len(plt.gca().images), 1)
+        self.assertEqual(len(plt.gca().texts), 0)
+        # Two groups of rows in random order end up next to each other
+        groups = rng.permutation(np.repeat([0, 1], 20))
+        data = np.where(groups[:, np.newaxis] == 0, 0.8, -0.8) + rng.normal(0, 0.05, size=(40, 50))
+        plotting.plotArrayHeatMap(data, cluster=True, rasterThreshold=0)
+        shown = np.asarray(plt.gca().images[0].get_array())
+        self.assertEqual(np.count_nonzero(np.diff(shown[:, 0] > 0)), 1)
+
+    def testBatchExport(self):
+        if IGNORE_TEST:
+            return
+        directory = tempfile.mkdtemp()
+        try:
+            data = np.column_stack([np.linspace(0, 1, 10), np.arange(10.0)])
+            jobs = [(os.path.join(directory, 'array.png'), plotting.plotArray, (data,), {'show': False}),
+                    (os.path.join(directory, 'species.pdf'), plotting.plotFloatingSpecies, (self.rr_model,)),
+                    (os.path.join(directory, 'rates.svg'), plotting.plotReactionRates, (self.rr_model,))]
+            written = plotting.batchExport(jobs, maxWorkers=2)
+            self.assertEqual(written, [job[0] for job in jobs])
+            self.assertTrue(all(os.path.getsize(name) > 0 for name in written))
+            report = os.path.join(directory, 'report.pdf')
+            self.assertEqual(plotting.batchExport(jobs, pdfFile=report, maxWorkers=2), [report])
+            with open(report, 'rb') as f:
+                self.assertIn(b'/Count 3', f.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+  unittest.main()
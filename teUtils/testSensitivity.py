@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the global sensitivity analysis module
+"""
+
+from teUtils import sensitivity
+
+import numpy as np
+import tellurium as te
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    J1: $X0 -> S1; k1 + k2*k3;
+    J2: S1 -> $X1; k4*S1;
+
+    k1 = 1; k2 = 0.1; k3 = 1; k4 = 0;
+    S1 = 0; X0 = 0; X1 = 0;
+    """
+PARAMETERS = ['k1', 'k2', 'k4']
+BOUNDS = [[0, 1], [0, 0.1], [0, 1E-6]]
+
+
+class TestSensitivity(unittest.TestCase):
+
+    def setUp(self):
+        self.rr_model = te.loada(ANTIMONY_MODEL)
+
+    def testSaltelliSample(self):
+        if IGNORE_TEST:
+            return
+        samples = sensitivity.getSaltelliSample(BOUNDS, 8, seed=1)
+        self.assertEqual(samples.shape, (8*(len(BOUNDS) + 2), len(BOUNDS)))
+        self.assertTrue(np.all(samples >= np.array(BOUNDS)[:, 0]))
+        self.assertTrue(np.all(samples <= np.array(BOUNDS)[:, 1]))
+
+    def testSobolIndices(self):
+        if IGNORE_TEST:
+            return
+        # S1 at time 10 is close to 10*(k1 + k2) so k1 dominates and k4 has no effect
+        result = sensitivity.sobolIndices(self.rr_model, PARAMETERS, BOUNDS, 'S1',
+              numberOfSamples=512, numberOfBootstraps=20, seed=3, maxWorkers=1)
+        self.assertEqual(result['S1'].shape, (len(PARAMETERS),))
+        self.assertEqual(result['ST_conf'].shape, (2, len(PARAMETERS)))
+        # The first order estimate of k1 (about 0.99) varies from 0.67 to 1 across seeds at this sample size
+        self.assertGreater(result['S1'][0], 0.6)
+        self.assertGreater(result['ST'][0], 0.9)
+        self.assertLess(abs(result['ST'][2]), 0.01)
+        self.assertTrue(np.all(result['ST_conf'][0] <= result['ST_conf'][1]))
+        # The seed fixes both the sample and the bootstrap
+        again = sensitivity.sobolIndices(self.rr_model, PARAMETERS, BOUNDS, 'S1',
+              numberOfSamples=512, numberOfBootstraps=20, seed=3, maxWorkers=1)
+        self.assertTrue(np.array_equal(again['ST_conf'], result['ST_conf']))
+
+    def testTimeResolvedSobolIndices(self):
+        if IGNORE_TEST:
+            return
+        result = sensitivity.sobolIndices(self.rr_model, PARAMETERS, BOUNDS, 'S1',
+              numberOfSamples=64, numberOfPoints=5, timeResolved=True, numberOfBootstraps=5, maxWorkers=2)
+        self.assertEqual(len(result['time']), 5)
+        self.assertEqual(result['ST'].shape, (5, len(PARAMETERS)))
+        self.assertEqual(result['S1_conf'].shape, (2, 5, len(PARAMETERS)))
+
+    def testMorrisElementaryEffects(self):
+        if IGNORE_TEST:
+            return
+        result = sensitivity.morrisElementaryEffects(self.rr_model, PARAMETERS, BOUNDS, 'S1',
+              numberOfTrajectories=10, numberOfBootstraps=10, seed=2, maxWorkers=1)
+        self.assertEqual(result['mu_star'].shape, (len(PARAMETERS),))
+        # A unit change of k1 over its range changes S1(10) by about 10
+        self.assertAlmostEqual(result['mu_star'][0], 10, places=2)
+        self.assertLess(result['mu_star'][2], 1E-3)
+        self.assertEqual(result['mu_star_conf'].shape, (2, len(PARAMETERS)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the TCP work queue executor, everything runs on localhost
+"""
+
+from teUtils import parameterScanning
+from teUtils import workQueue
+
+import concurrent.futures
+import numpy as np
+import os
+import shutil
+import tellurium as te
+import tempfile
+import time
+import unittest
+
+
+IGNORE_TEST = False
+ANTIMONY_MODEL = """
+    $X0 -> S1; k1*X0;
+    S1 -> $X1; k2*S1;
+
+    k1 = 1; k2 = 0.5;
+    S1 = 0; X0 = 1; X1 = 0;
+    """
+
+
+def _square(x):
+    return x*x
+
+def _failOnce(path):
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        raise ValueError('First attempt fails')
+    return 'ok'
+
+def _alwaysFail():
+    raise ValueError('Always fails')
+
+def _sleepAndSquare(x, seconds):
+    time.sleep(seconds)
+    return x*x
+
+def _exitOnce(path):
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        os._exit(1)
+    return 'ok'
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testScanOnWorkQueue(self):
+        if IGNORE_TEST:
+            return
+        r = te.loada(ANTIMONY_MODEL)
+        values = np.linspace(0.5, 2, 10).reshape(-1, 1)
+        expected = parameterScanning.simulateParameterSets(r, ['k2'], values, ['time', 'S1'], maxWorkers=1)
+        with workQueue.WorkQueueExecutor(numberOfLocalWorkers=2) as executor:
+            self.assertEqual(list(executor.map(_square, range(5))), [0, 1, 4, 9, 16])
+            data = parameterScanning.simulateParameterSets(r, ['k2'], values, ['time', 'S1'],
+                  executor=executor, chunkSize=3)
+        self.assertTrue(np.allclose(data, expected))
+
+    def testRetries(self):
+        if IGNORE_TEST:
+            return
+        with workQueue.WorkQueueExecutor(numberOfLocalWorkers=2, maxRetries=1) as executor:
+            self.assertEqual(executor.submit(_failOnce, os.path.join(self.directory, 'fail')).result(), 'ok')
+            with self.assertRaises(ValueError):
+                executor.submit(_alwaysFail).result()
+            # A worker that dies loses its lease and the task goes to the other worker
+            self.assertEqual(executor.submit(_exitOnce, os.path.join(self.directory, 'exit')).result(), 'ok')
+
+    def testLeaseExpiry(self):
+        if IGNORE_TEST:
+            return
+        executor = workQueue.WorkQueueExecutor(leaseTime=0.2, maxRetries=0)
+        future = executor.submit(_square, 3)
+        # Take the task without ever returning a result
+        connection = workQueue._Client(executor.address, authkey=executor.authkey)
+        connection.send(('get',))
+        self.assertEqual(connection.recv()[0], 'task')
+        error = future.exception(timeout=10)
+        self.assertIsInstance(error, TimeoutError)
+        self.assertEqual(str(error), 'Task lease expired')
+        connection.close()
+        executor.shutdown()
+
+
+    def testLeaseRenewal(self):
+        if IGNORE_TEST:
+            return
+        # The task takes several lease times, the worker's heartbeat keeps the lease
+        with workQueue.WorkQueueExecutor(numberOfLocalWorkers=1, leaseTime=0.3, maxRetries=0) as executor:
+            self.assertEqual(executor.submit(_sleepAndSquare, 3, 1.5).result(timeout=60), 9)
+
+    def testStaleDisconnect(self):
+        if IGNORE_TEST:
+            return
+        executor = workQueue.WorkQueueExecutor(leaseTime=0.2, maxRetries=1)
+        future = executor.submit(_square, 3)
+        first = workQueue._Client(executor.address, authkey=executor.authkey)
+        first.send(('get',))
+        taskId = first.recv()[1]
+        # The lease of the first connection expires and the task goes to the second
+        second = workQueue._Client(executor.address, authkey=executor.authkey)
+        second.send(('get',))
+        message = second.recv()
+        self.assertEqual(message[:2], ('task', taskId))
+        # Losing the first connection must not take the task away from the second
+        first.close()
+        time.sleep(0.1)
+        self.assertFalse(future.done())
+        second.send(('result', taskId, True, 9))
+        self.assertEqual(future.result(timeout=10), 9)
+        second.close()
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+  unittest.main()
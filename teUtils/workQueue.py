@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+""" A simple TCP work queue for running scans on several machines
+
+WorkQueueExecutor is a concurrent.futures.Executor, so it can be passed anywhere the
+scanning functions accept an executor (or to workerPool.ModelPool) and the same scan
+runs unchanged on a local process pool or on the work queue.
+
+The executor runs a coordinator that hands tasks to worker processes over TCP. Each task
+is leased to one worker at a time. While a task runs the worker sends a heartbeat that
+renews the lease, so a lease only runs out when the worker has died or hung. A task whose
+lease runs out, or whose worker disconnects, is handed to another worker. A task that
+raises an exception is retried up to maxRetries times before the exception is returned
+to the caller.
+
+Start a worker on another machine with::
+
+    TEUTILS_AUTHKEY=<key> python -m teUtils.workQueue <coordinator host> <coordinator port>
+
+Task functions must be importable module level functions, and teUtils must be installed
+on the worker machines.
+"""
+
+import collections as _collections
+import concurrent.futures as _futures
+import itertools as _itertools
+import os as _os
+import pickle as _pickle
+import sys as _sys
+import threading as _threading
+import time as _time
+from multiprocessing.connection import Listener as _Listener, Client as _Client
+
+__all__ = ['WorkQueueExecutor', 'runWorker', 'startLocalWorkers']
+
+AUTHKEY_VARIABLE = 'TEUTILS_AUTHKEY'
+
+
+class _Task:
+    def __init__(self, taskId, future, function, args, kwargs):
+        self.id = taskId
+        self.future = future
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+        self.leaseDeadline = None
+        # Identifies the current lease, so a worker that lost the task cannot act on it
+        self.lease = None
+
+
+class WorkQueueExecutor(_futures.Executor):
+    """ Executor that runs tasks on worker processes connected over TCP.
+
+    Args:
+      address (tuple): Optional: (host, port) the coordinator listens on, port 0 picks a free port.
+          Use ('0.0.0.0', port) to accept workers from other machines.
+      authkey (bytes): Optional: Shared secret the workers must present, a random key is made if not given
+      numberOfLocalWorkers (integer): Optional: Number of worker processes to start on this machine
+      leaseTime (float): Optional: Seconds without a heartbeat from a worker before its task is handed to another worker
+      maxRetries (integer): Optional: Number of times a failed or lost task is tried again
+
+    Example:
+
+     .. code-block:: python
+
+        with tu.workQueue.WorkQueueExecutor (numberOfLocalWorkers=4) as executor:
+            data = tu.parameterScanning.simulateParameterSets (r, ['k1'], values, ['time', 'S1'],
+                  executor=executor)
+    """
+
+    def __init__(self, address=('localhost', 0), authkey=None, numberOfLocalWorkers=0, leaseTime=600, maxRetries=2):
+        if authkey is None:
+            authkey = _os.urandom(16)
+        self.authkey = authkey
+        self.leaseTime = leaseTime
+        self.maxRetries = maxRetries
+        self._listener = _Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._queue = _collections.deque()
+        self._tasks = {}
+        self._ids = _itertools.count()
+        self._leases = _itertools.count()
+        self._condition = _threading.Condition()
+        self._closed = False
+        self._acceptThread = _threading.Thread(target=self._accept, daemon=True)
+        self._acceptThread.start()
+        _threading.Thread(target=self._watchLeases, daemon=True).start()
+        self._localWorkers = startLocalWorkers(self.address, authkey, numberOfLocalWorkers)
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queue fn (\\*args, \\**kwargs) and return a concurrent.futures.Future """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Cannot submit tasks after shutdown')
+            task = _Task(next(self._ids), _futures.Future(), fn, args, kwargs)
+            self._tasks[task.id] = task
+            self._queue.append(task.id)
+            self._condition.notify_all()
+        return task.future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        """ Stop accepting tasks, tell the workers to exit and close the coordinator """
+        if cancel_futures:
+            with self._condition:
+                for task in self._tasks.values():
+                    task.future.cancel()
+        if wait:
+            _futures.wait([task.future for task in list(self._tasks.values())])
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        # Wake the accept loop so it sees the executor is closed
+        try:
+            _Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self._acceptThread.join()
+        self._listener.close()
+        for process in self._localWorkers:
+            if wait:
+                process.wait()
+            else:
+                process.terminate()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                continue
+            if self._closed:
+                connection.close()
+                return
+            _threading.Thread(target=self._serve, args=(connection,), daemon=True).start()
+
+    def _watchLeases(self):
+        with self._condition:
+            while not self._closed:
+                now = _time.time()
+                for task in list(self._tasks.values()):
+                    if task.leaseDeadline is not None and task.leaseDeadline < now:
+                        self._retry(task, TimeoutError('Task lease expired'))
+                self._condition.wait(min(self.leaseTime/2, 1.0))
+
+    def _nextTask(self, timeout):
+        # Called with the condition held, returns a leased task or None
+        deadline = _time.time() + timeout
+        while not self._closed:
+            now = _time.time()
+            while self._queue:
+                task = self._tasks.get(self._queue.popleft())
+                if task is None:
+                    continue
+                if task.attempts == 0 and not task.future.set_running_or_notify_cancel():
+                    del self._tasks[task.id]
+                    continue
+                task.attempts += 1
+                task.leaseDeadline = now + self.leaseTime
+                task.lease = next(self._leases)
+                return task
+            if now >= deadline:
+                return None
+            self._condition.wait(min(deadline - now, 1.0))
+        return None
+
+    def _retry(self, task, exception):
+        # Called with the condition held
+        task.leaseDeadline = None
+        task.lease = None
+        if task.attempts <= self.maxRetries:
+            self._queue.append(task.id)
+            self._condition.notify_all()
+        else:
+            del self._tasks[task.id]
+            task.future.set_exception(exception)
+
+    def _renew(self, taskId, lease):
+        with self._condition:
+            task = self._tasks.get(taskId)
+            if task is not None and task.lease == lease:
+                task.leaseDeadline = _time.time() + self.leaseTime
+
+    def _finish(self, taskId, lease, ok, value):
+        with self._condition:
+            task = self._tasks.get(taskId)
+            if task is None or task.leaseDeadline is None:
+                # Result of a task that has already been finished or is waiting in the queue
+                return
+            if ok:
+                # A late result is as good as the one the current worker would return
+                del self._tasks[taskId]
+                task.future.set_result(value)
+            elif task.lease == lease:
+                self._retry(task, value)
+
+    def _serve(self, connection):
+        # Lease of each task this connection holds, by task id
+        leased = {}
+        try:
+            while True:
+                message = connection.recv()
+                if message[0] == 'get':
+                    with self._condition:
+                        task = self._nextTask(timeout=1.0)
+                        closed = self._closed
+                    if task is not None:
+                        leased[task.id] = task.lease
+                        # Pickled separately so the worker's heartbeat covers unpickling, which
+                        # can import slow modules
+                        payload = _pickle.dumps((task.function, task.args, task.kwargs))
+                        connection.send(('task', task.id, self.leaseTime/3, payload))
+                    elif closed:
+                        connection.send(('stop',))
+                        return
+                    else:
+                        connection.send(('wait',))
+                elif message[0] == 'ping':
+                    if message[1] in leased:
+                        self._renew(message[1], leased[message[1]])
+                elif message[0] == 'result':
+                    lease = leased.pop(message[1], None)
+                    self._finish(message[1], lease, message[2], message[3])
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            # The worker went away, hand the tasks it still holds to someone else. A task whose
+            # lease expired may already be running on another worker and is left alone.
+            with self._condition:
+                for taskId, lease in leased.items():
+                    task = self._tasks.get(taskId)
+                    if task is not None and task.lease == lease:
+                        self._retry(task, RuntimeError('Worker disconnected while running the task'))
+
+
+def runWorker(address, authkey):
+    """ Connect to a coordinator and run tasks until it shuts down
+
+    Args:
+      address (tuple): (host, port) of the coordinator
+      authkey (bytes): Shared secret of the coordinator
+    """
+    connection = _Client(tuple(address), authkey=authkey)
+    # The heartbeat thread and this thread both send on the connection
+    sendLock = _threading.Lock()
+
+    def send(message):
+        with sendLock:
+            connection.send(message)
+
+    def heartbeat(taskId, interval, done):
+        try:
+            while not done.wait(interval):
+                send(('ping', taskId))
+        except (EOFError, OSError):
+            pass
+
+    try:
+        while True:
+            send(('get',))
+            message = connection.recv()
+            if message[0] == 'stop':
+                return
+            if message[0] == 'wait':
+                continue
+            _, taskId, interval, payload = message
+            done = _threading.Event()
+            pinger = _threading.Thread(target=heartbeat, args=(taskId, interval, done), daemon=True)
+            pinger.start()
+            try:
+                function, args, kwargs = _pickle.loads(payload)
+                result = (True, function(*args, **kwargs))
+            except Exception as error:
+                result = (False, error)
+            finally:
+                done.set()
+                pinger.join()
+            try:
+                send(('result', taskId) + result)
+            except Exception as error:
+                # The result or the exception could not be pickled
+                send(('result', taskId, False, RuntimeError(repr(error))))
+    except (EOFError, OSError):
+        pass
+    finally:
+        connection.close()
+
+
+def startLocalWorkers(address, authkey, numberOfWorkers):
+    """ Start worker processes on this machine, returns the list of subprocess.Popen objects
+
+    Args:
+      address (tuple): (host, port) of the coordinator
+      authkey (bytes): Shared secret of the coordinator
+      numberOfWorkers (integer): Number of workers to start
+    """
+    import subprocess
+    environment = dict(_os.environ)
+    environment[AUTHKEY_VARIABLE] = authkey.hex()
+    # Make sure the workers import this copy of teUtils
+    packageRoot = _os.path.dirname(_os.path.dirname(_os.path.abspath(__file__)))
+    environment['PYTHONPATH'] = _os.pathsep.join([packageRoot] + [p for p in [environment.get('PYTHONPATH')] if p])
+    return [subprocess.Popen([_sys.executable, '-m', 'teUtils.workQueue', str(address[0]), str(address[1])],
+                             env=environment)
+            for i in range(numberOfWorkers)]
+
+
+if __name__ == '__main__':
+    if len(_sys.argv) != 3 or AUTHKEY_VARIABLE not in _os.environ:
+        print('Usage: ' + AUTHKEY_VARIABLE + '=<key> python -m teUtils.workQueue <host> <port>')
+        _sys.exit(1)
+    runWorker((_sys.argv[1], int(_sys.argv[2])), bytes.fromhex(_os.environ[AUTHKEY_VARIABLE]))
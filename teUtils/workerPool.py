@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+""" Run simulations of one compiled model in worker processes
+
+A ModelPool compiles nothing in the workers. The model is compiled once in the calling
+process, its state is serialized with saveStateS and restored in each worker with
+loadStateS. Workers keep the restored model, so the cost of compiling is paid once per
+job instead of once per simulation.
+"""
+
+import collections as _collections
+import hashlib as _hashlib
+import threading as _threading
+
+import numpy as _np
+
+from teUtils import telemetry as _telemetry
+
+__all__ = ['ModelPool', 'simulateTimeCourse', 'simulateTimeCourseToSteadyState']
+
+# Models restored in this worker, keyed by a hash of the saved state, with the values
+# needed to put them back in that state. Thread local so that thread pool workers never
+# share a roadrunner instance, and least recently used first out so that a long lived
+# executor that is sent many model states does not keep them all.
+_workerModels = _threading.local()
+_maxWorkerModels = 8
+
+# Value arrays of the executable model that tasks can change and reset() does not restore
+_stateArrays = ['GlobalParameterValues', 'CompartmentInitVolumes', 'CompartmentVolumes',
+                'BoundarySpeciesConcentrations', 'FloatingSpeciesInitConcentrations']
+
+
+def _takeSnapshot(r):
+    model = r.model
+    arrays = [(name, _np.array(getattr(model, 'get' + name)())) for name in _stateArrays]
+    # Initial values of parameters and boundary species have no array getter
+    initial = []
+    for id in list(r.getGlobalParameterIds()) + list(r.getBoundarySpeciesIds()):
+        selection = 'init(' + id + ')'
+        try:
+            value = r[selection]
+            r[selection] = value
+        except Exception:
+            # Eg a parameter set by an assignment rule
+            continue
+        initial.append((selection, value))
+    return arrays, initial
+
+
+def _restoreSnapshot(r, snapshot):
+    arrays, initial = snapshot
+    for selection, value in initial:
+        r[selection] = value
+    model = r.model
+    for name, values in arrays:
+        getattr(model, 'set' + name)(values)
+    r.reset()
+
+
+def _getWorkerModel(key, state=None):
+    models = _workerModels.__dict__.setdefault('models', _collections.OrderedDict())
+    if key in models:
+        models.move_to_end(key)
+    else:
+        if state is None:
+            raise RuntimeError('Model state ' + key + ' has not been sent to this worker')
+        import roadrunner
+        r = roadrunner.RoadRunner()
+        r.loadStateS(state)
+        models[key] = (r, _takeSnapshot(r))
+        while len(models) > _maxWorkerModels:
+            models.popitem(last=False)
+    return models[key]
+
+
+def _runTask(key, state, function, args):
+    # Each task starts from the state the pool was created with, whatever earlier tasks set
+    r, snapshot = _getWorkerModel(key, state)
+    _restoreSnapshot(r, snapshot)
+    return function(r, *args)
+
+
+def simulateTimeCourse(r, parameters, values, timeEnd, numberOfPoints, selections, telemetry=None):
+    """ Reset the model, set the parameters and run one time course simulation.
+
+    This is the standard task used by the scanning and plotting functions.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The names of the parameters to set
+      values (list of floats): The values of the parameters
+      timeEnd (float): Simulate a time course up to this time
+      numberOfPoints: (integer): Generate this number of points
+      selections (list of strings): The variables to record, eg ['time', 'S1']
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry that records the reset and integrate phases
+
+    Returns:
+      numpy array: of shape (numberOfPoints, len (selections))
+    """
+    recorder = _telemetry.getRecorder(telemetry)
+    with recorder.phase('reset'):
+        r.reset()
+        for parameter, value in zip(parameters, values):
+            r[parameter] = value
+    with recorder.phase('integrate'):
+        m = _np.array(r.simulate(0, timeEnd, numberOfPoints, selections))
+    return m
+
+
+def simulateTimeCourseToSteadyState(r, parameters, values, timeEnd, numberOfPoints, selections,
+      tolerance=1E-6, window=10, telemetry=None):
+    """ Like simulateTimeCourse but stop integrating once the model has reached steady state.
+
+    The time course is integrated in segments. Integration stops once the Euclidean norm of
+    the rates of change of the floating species has stayed below tolerance for window
+    consecutive output points. The remaining rows are filled with the final values (time
+    columns keep their time points), so the result has the same shape as a full simulation.
+
+    Args:
+      r (reference): Roadrunner instance
+      parameters (list of strings): The names of the parameters to set
+      values (list of floats): The values of the parameters
+      timeEnd (float): Simulate a time course up to this time
+      numberOfPoints: (integer): Generate this number of points
+      selections (list of strings): The variables to record, eg ['time', 'S1']
+      tolerance (float): Optional: Rates of change below this norm count as steady state
+      window (integer): Optional: Number of consecutive output points that must be below tolerance
+      telemetry (Telemetry): Optional: A teUtils.telemetry.Telemetry that records the reset and integrate phases
+
+    Returns:
+      tuple: (numpy array of shape (numberOfPoints, len (selections)), simulated time that was skipped)
+    """
+    recorder = _telemetry.getRecorder(telemetry)
+    with recorder.phase('reset'):
+        r.reset()
+        for parameter, value in zip(parameters, values):
+            r[parameter] = value
+    times = _np.linspace(0, timeEnd, numberOfPoints)
+    rates = [s + "'" for s in r.getFloatingSpeciesIds()]
+    columns = len(selections)
+    result = _np.empty((numberOfPoints, columns))
+    chunk = max(window, numberOfPoints//20, 1)
+    start = 0
+    steady = 0
+    while start < numberOfPoints - 1:
+        end = min(start + chunk, numberOfPoints - 1)
+        with recorder.phase('integrate'):
+            m = _np.array(r.simulate(times[start], times[end], end - start + 1, list(selections) + rates))
+        result[start:end + 1] = m[:, :columns]
+        below = _np.sqrt(_np.sum(m[0 if start == 0 else 1:, columns:]**2, axis=1)) < tolerance
+        if _np.all(below):
+            steady += len(below)
+        else:
+            steady = len(below) - 1 - _np.flatnonzero(~below)[-1]
+        start = end
+        if steady >= window:
+            break
+    if numberOfPoints == 1:
+        result[:] = _np.array(r.simulate(0, timeEnd, 1, list(selections)))
+    result[start + 1:] = result[start]
+    for k, selection in enumerate(selections):
+        if selection.lower() == 'time':
+            result[start + 1:, k] = times[start + 1:]
+    recorder.setValue('skippedTime', float(timeEnd - times[start]))
+    return result, timeEnd - times[start]
+
+
+class ModelPool:
+    """ Pool of worker processes that each hold a copy of a compiled model.
+
+    Tasks are plain functions called in the worker as function (r, \\*args) where r is the
+    worker's copy of the model. The state of the model at the time the pool is created is
+    used, later changes to r are not seen by the workers. Task functions and arguments must
+    be picklable, so use module level functions. Each task starts from that state, values
+    set by earlier tasks on the same worker are put back before the task runs.
+
+    When executor is given (for example a thread pool or a remote executor) the saved state
+    is sent along with each task and each worker restores it the first time it sees it.
+
+    Args:
+      r (reference): Roadrunner instance
+      maxWorkers (integer): Optional: Number of worker processes, default is the number of cpus
+      executor (concurrent.futures.Executor): Optional: Executor to use instead of creating a process pool
+
+    Example:
+
+     .. code-block:: python
+
+        with tu.workerPool.ModelPool (r) as pool:
+            results = pool.map (tu.workerPool.simulateTimeCourse,
+                  [(['k1'], [value], 10, 100, ['time', 'S1']) for value in values])
+    """
+
+    def __init__(self, r, maxWorkers=None, executor=None):
+        import concurrent.futures
+        self.state = r.saveStateS()
+        self.key = _hashlib.sha1(self.state).hexdigest()
+        self._ownExecutor = executor is None
+        if self._ownExecutor:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                maxWorkers, initializer=_getWorkerModel, initargs=(self.key, self.state))
+        else:
+            self.executor = executor
+
+    def submit(self, function, *args):
+        """ Run function (r, \\*args) in a worker, returns a concurrent.futures.Future """
+        state = None if self._ownExecutor else self.state
+        return self.executor.submit(_runTask, self.key, state, function, args)
+
+    def map(self, function, argsList):
+        """ Run function (r, \\*args) for every tuple of arguments in argsList, returns the results in order """
+        futures = [self.submit(function, *args) for args in argsList]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """ Stop the worker processes, a pool that uses a supplied executor leaves it running """
+        if self._ownExecutor:
+            self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()